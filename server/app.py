@@ -1,20 +1,262 @@
+import base64
+import csv
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import shutil
+import sqlite3
+import statistics
+import threading
+import time
+import tempfile
+import tracemalloc
 import uuid
-from flask import Flask, jsonify, request
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import click
+from flask import Flask, Response, has_request_context, jsonify, request, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
 from flask_cors import CORS
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import wraps
 from pytz import timezone
+from sqlalchemy import create_engine, event, exc, make_url
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql.util import find_tables
+from sqlalchemy.util import LRUCache
+from werkzeug.exceptions import HTTPException
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    from weasyprint import HTML as WeasyHTML  # Optional: enables PDF invoices
+except ImportError:
+    WeasyHTML = None
+
+try:
+    import pyarrow as pa  # Optional: enables Parquet ledger exports
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import numpy as np  # Optional: vectorized inventory analytics
+except ImportError:
+    np = None
+
+try:
+    import zstandard  # Optional: enables zstd response compression
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli  # Optional: enables Brotli response compression
+except ImportError:
+    brotli = None
+
 # Flask app initialization
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///shop.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///shop.db')  # or postgresql+psycopg2://...
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['INVOICE_NUMBER_BLOCK_SIZE'] = 50  # Invoice numbers reserved per worker per round trip
+app.config['INVOICE_NUMBER_PREFIXES'] = {'repair': 'REP', 'accessory': 'ACC'}
+app.config['INVOICE_RENDER_WORKERS'] = 2  # Background threads rendering invoice documents
+app.config['INVOICE_CACHE_DIR'] = os.path.join(app.instance_path, 'invoice_cache')
+app.config['JOB_QUEUE_ENABLED'] = True
+app.config['JOB_WORKERS'] = 2  # Threads executing background jobs
+app.config['JOB_POLL_INTERVAL'] = 2.0  # Seconds between scans for due or retried jobs
+app.config['JOB_MAX_ATTEMPTS'] = 5  # Attempts before a job is dead-lettered
+app.config['JOB_BACKOFF_BASE'] = 2.0  # Retry delay in seconds, doubled on every attempt
+app.config['JOB_BACKOFF_MAX'] = 300.0
+app.config['JOB_LEASE_SECONDS'] = 300  # Running jobs older than this are assumed lost and retried
+app.config['JOB_RETENTION_HOURS'] = 24  # Finished jobs are purged after this long
+app.config['LEDGER_EXPORT_CHUNK_SIZE'] = 2000  # Rows fetched per round trip and per Parquet row group
+app.config['ARCHIVE_DATABASE_PATH'] = os.path.join(app.instance_path, 'shop_archive.db')
+app.config['ARCHIVE_AFTER_DAYS'] = 365  # Settled records older than this move to the archive
+app.config['SHOP_PARTITIONING'] = False  # One SQLite file per shop for everything but users and shops
+app.config['SHOP_PARTITION_DIR'] = os.path.join(app.instance_path, 'shops')
+app.config['REPORT_SNAPSHOT_ENABLED'] = True  # Run reports against a backup-API copy of the database
+app.config['REPORT_SNAPSHOT_DIR'] = os.path.join(app.instance_path, 'snapshots')
+app.config['REPORT_SNAPSHOT_INTERVAL'] = 30  # Seconds between background refreshes
+app.config['REPORT_SNAPSHOT_MAX_AGE'] = 120  # Freshness bound: reports read the live file while a snapshot is older
+app.config['REPORT_SNAPSHOT_PAGES'] = 1024  # Pages copied per backup step
+app.config['BACKUP_ENABLED'] = True
+app.config['BACKUP_DIR'] = os.path.join(app.instance_path, 'backups')
+app.config['BACKUP_INTERVAL_HOURS'] = 24
+app.config['BACKUP_RETENTION'] = 14  # Backups kept per database file
+app.config['BACKUP_PAGES_PER_STEP'] = 256  # Small steps keep the live database responsive
+app.config['BACKUP_STEP_SLEEP'] = 0.02  # Seconds to yield to writers between steps
+app.config['IDEMPOTENCY_TTL_HOURS'] = 24  # Stored responses are replayed for this long
+app.config['IDEMPOTENCY_PENDING_TIMEOUT'] = 60  # Seconds before an unfinished first request is assumed lost
+app.config['IDEMPOTENCY_PURGE_INTERVAL'] = 300  # Seconds between purges of expired keys
+app.config['BATCH_MAX_OPERATIONS'] = 200
+app.config['SYNC_PAGE_SIZE'] = 1000  # Rows per entity per /sync response
+app.config['SYNC_OVERLAP_SECONDS'] = 10  # Longest expected write transaction; changes this recent are sent again
+app.config['SYNC_TOMBSTONE_RETENTION_DAYS'] = 90  # Older sync tokens must resync from scratch
+app.config['CHANGE_STREAM_BUFFER'] = 256  # Events a slow /events client may fall behind before it must resync
+app.config['CHANGE_STREAM_HISTORY'] = 1000  # Recent events kept for clients reconnecting with Last-Event-ID
+app.config['CHANGE_STREAM_KEEPALIVE'] = 15  # Seconds between keepalive comments on an idle stream
+app.config['CHANGE_STREAM_MAX_CLIENTS'] = 100  # Every open stream holds a server thread
+app.config['ANALYTICS_CACHE_MAX_AGE'] = 300  # Seconds a cached analytics result is trusted without a local commit
+app.config['FORECAST_ENABLED'] = True
+app.config['FORECAST_REFRESH_HOURS'] = 6
+app.config['FORECAST_HISTORY_DAYS'] = 90  # Days of sales loaded per refresh
+app.config['FORECAST_WINDOW_DAYS'] = 28  # Moving average window, also used to measure demand variability
+app.config['FORECAST_SMOOTHING'] = 0.1  # Exponential smoothing factor; higher follows recent days more closely
+app.config['FORECAST_LEAD_TIME_DAYS'] = 7  # Days from placing an order to restocking
+app.config['FORECAST_REVIEW_DAYS'] = 14  # An order should last until the next review
+app.config['FORECAST_SERVICE_Z'] = 1.65  # Safety stock in standard deviations of daily demand (about 95% service)
+app.config['COMPRESSION_ENABLED'] = True
+app.config['COMPRESSION_MIN_SIZE'] = 1024  # Smaller bodies gain too little to be worth compressing
+app.config['COMPRESSION_LEVELS'] = {'zstd': 3, 'br': 4, 'gzip': 6}  # See `flask compression-benchmark`
+app.config['CUSTOMER_COUNTRY_CODE'] = '91'  # Stripped from phone numbers so every spelling finds one customer
+app.config['CUSTOMER_NATIONAL_DIGITS'] = 10
+app.config['RATE_LIMIT_ENABLED'] = False  # Opt in once the budgets below suit the shop's clients
+app.config['RATE_LIMITS'] = {'cheap': (10.0, 30), 'expensive': (0.5, 5)}  # (requests per second, burst) per auth key and address
+app.config['RATE_LIMIT_STORAGE'] = 'memory'  # 'sqlite' shares the buckets between worker processes
+app.config['RATE_LIMIT_DATABASE_PATH'] = os.path.join(app.instance_path, 'rate_limit.db')
+app.config['EXPENSIVE_CONCURRENCY'] = 4  # Per worker process, even with 'sqlite' storage: the server allows this times its workers
+app.config['EXPENSIVE_ADMISSION_WAIT'] = 0.5  # Seconds an expensive request waits for a slot before a 503
+app.config['EXPENSIVE_RETRY_AFTER'] = 2  # Retry-After sent with a 503
+app.config['SINGLE_FLIGHT_ENABLED'] = True
+app.config['SINGLE_FLIGHT_TIMEOUT'] = 30  # Seconds a caller waits for a report another request is computing
+app.config['FAST_READ_CACHE_SIZE'] = 100  # Compiled list statements kept apart from the engine's cache
+app.config['UPSERT_CHUNK_SIZE'] = 500  # Catalog rows per INSERT statement in bulk upserts
+app.config['UPSERT_MAX_PARTS'] = 10000  # Parts accepted by one /repairing_accessory/bulk request
+app.config['POSTGRES_POOL_SIZE'] = 10  # Connections each worker process keeps open
+app.config['POSTGRES_MAX_OVERFLOW'] = 10  # Extra connections opened under bursts and closed when returned
+app.config['POSTGRES_POOL_TIMEOUT'] = 5  # Seconds a request waits for a free connection before failing
+app.config['POSTGRES_POOL_RECYCLE'] = 1800  # Reconnect before server or proxy idle timeouts drop connections
+app.config['POSTGRES_STATEMENT_TIMEOUT_MS'] = 30000  # A runaway query is cancelled instead of pinning a connection
+
+
+def sqlite_backend(url=None):
+    """Whether `url` (the main database by default) is SQLite.
+
+    Shop partitions, report snapshots, backups and the archive work on
+    SQLite files and are switched off on other backends.
+    """
+    return make_url(url or app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'sqlite'
+
+
+def database_engine_options(url):
+    """Engine options for a database URL; SQLite keeps the defaults.
+
+    PostgreSQL gets a bounded LIFO pool, so idle connections beyond the busy
+    set age out through pool_recycle, and a per-connection statement timeout.
+    """
+    if sqlite_backend(url):
+        return {}
+    return {
+        'pool_size': app.config['POSTGRES_POOL_SIZE'],
+        'max_overflow': app.config['POSTGRES_MAX_OVERFLOW'],
+        'pool_timeout': app.config['POSTGRES_POOL_TIMEOUT'],
+        'pool_recycle': app.config['POSTGRES_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+        'pool_use_lifo': True,
+        # Rows per multi-row INSERT ... RETURNING when the ORM flushes many objects
+        'insertmanyvalues_page_size': app.config['UPSERT_CHUNK_SIZE'],
+        'connect_args': {'options': f"-c statement_timeout={app.config['POSTGRES_STATEMENT_TIMEOUT_MS']}"},
+    }
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database_engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+if not sqlite_backend():
+    # PostgreSQL readers never block writers, and dumps and partitioning are its own tools
+    app.config.update(SHOP_PARTITIONING=False, REPORT_SNAPSHOT_ENABLED=False, BACKUP_ENABLED=False)
+
+# Tables that stay in the main database when shops are partitioned
+GLOBAL_TABLES = {'user', 'shop', 'invoice_sequence', 'idempotency_key'}
+
+# Tables the main database and every shop database have a copy of: a shop's
+# jobs commit with its writes without taking the main file's write lock
+PER_DATABASE_TABLES = {'background_job'}
+
+# Shop whose partition the current request or job works on
+current_shop_id = ContextVar('current_shop_id', default=None)
+
+# Set while a report reads from the snapshot copies instead of the live files
+reading_snapshot = ContextVar('reading_snapshot', default=False)
+
+# Savepoint of the /batch operation being run: commits only flush and a
+# rollback undoes just that operation; the batch commits once at the end
+batch_savepoint = ContextVar('batch_savepoint', default=None)
+
+# Auth key already verified for the current /batch request
+batch_auth_key = ContextVar('batch_auth_key', default=None)
+
+
+class ShopNotSelected(Exception):
+    pass
+
+
+class RoutingSession(FlaskSession):
+    """Sends statements to the selected shop's database in partitioned mode.
+
+    Each shop database attaches the main database, so users and shops stay
+    reachable from a shop connection. Without a selected shop only the global
+    tables and the main database's job queue may be used.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = self._live_bind(mapper, clause, bind, **kwargs)
+        if reading_snapshot.get():
+            return report_snapshots.engine_for(engine)
+        return engine
+
+    def _live_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and app.config['SHOP_PARTITIONING']:
+            shop_id = current_shop_id.get()
+            if shop_id is not None:
+                return shop_partitions.engine(shop_id)
+            if mapper is not None:
+                # Core statements pass the model class rather than its mapper
+                tables = {table.name for table in db.inspect(mapper).tables}
+            elif clause is not None:
+                tables = {table.name for table in find_tables(clause, include_crud=True)}
+            else:
+                tables = set()
+            if tables - GLOBAL_TABLES - PER_DATABASE_TABLES:
+                raise ShopNotSelected("Select a shop with shop_id (or assign the user to a shop)")
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def commit(self):
+        if batch_savepoint.get() is not None:
+            self.flush()
+            return
+        super().commit()
+
+    def rollback(self):
+        savepoint = batch_savepoint.get()
+        if savepoint is not None:
+            if savepoint.is_active:
+                savepoint.rollback()
+            return
+        super().rollback()
+
 
 # Database initialization
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+
+class SyncTracked:
+    # Stamped on every insert and update so /sync can return only changed rows
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
 
 # Database Models
 class User(db.Model):
@@ -22,11 +264,12 @@ class User(db.Model):
     username = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String(100), nullable=False)
     auth_key = db.Column(db.String(100), unique=True, nullable=False)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=True)  # Default shop of the user
 
     def __repr__(self):
         return f"<User {self.username}>"
 
-class RepairingProduct(db.Model):
+class RepairingProduct(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     type = db.Column(db.String(100), nullable=False)
@@ -38,7 +281,7 @@ class RepairingProduct(db.Model):
         return f"<RepairingProduct {self.name}, Type: {self.type}>"
         
         
-class Phone(db.Model):
+class Phone(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     imei = db.Column(db.String(15), unique=True, nullable=False)
     model_name = db.Column(db.String(100), nullable=False)
@@ -57,7 +300,7 @@ class Phone(db.Model):
         
 
         
-class Accessory(db.Model):
+class Accessory(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     accessory_name = db.Column(db.String(100), nullable=False)
     type = db.Column(db.String(50), nullable=False)
@@ -96,7 +339,7 @@ class Accessory(db.Model):
         }
         
         
-class RepairingAccessory(db.Model):
+class RepairingAccessory(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # Change to Integer with autoincrement
     name = db.Column(db.String(100))
     type = db.Column(db.String(100))
@@ -136,16 +379,24 @@ class RepairingAccessory(db.Model):
             "alert": self.alert,
             "company": self.company,
             "model": self.model
-        }        
-        
+        }
+
+
+# One catalog row per part; a missing detail counts as empty so it still collides
+REPAIR_PART_KEY_COLUMNS = ('name', 'type', 'company', 'model')
+REPAIR_PART_KEY = [
+    db.func.coalesce(RepairingAccessory.__table__.c[name], db.literal_column("''")) for name in REPAIR_PART_KEY_COLUMNS
+]
+db.Index('uq_repairing_accessory_catalog', *REPAIR_PART_KEY, unique=True)
         
         
-class RepairingDevice(db.Model):
+class RepairingDevice(SyncTracked, db.Model):
     __tablename__ = 'repairing_device'
 
     id = db.Column(db.Integer, primary_key=True)
     customer_name = db.Column(db.String(100), nullable=False)
     phone_number = db.Column(db.String(15), default='N/A')
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True, index=True)
     received_by = db.Column(db.String(50), default='N/A')
     company = db.Column(db.String(100), default='N/A')
     model = db.Column(db.String(100), default='N/A')
@@ -166,10 +417,10 @@ class RepairingDevice(db.Model):
         return f"<RepairingDevice {self.customer_name}, Status: {self.repairing_status}>"
 
 
-class RepairingInvoice(db.Model):
+class RepairingInvoice(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.String(100), nullable=False, unique=True)
-    repairing_device_id = db.Column(db.Integer, db.ForeignKey('repairing_device.id'), nullable=False)
+    repairing_device_id = db.Column(db.Integer, db.ForeignKey('repairing_device.id'), nullable=False, index=True)
     shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
     customer_name = db.Column(db.String(100), nullable=False)
     repairing_cost = db.Column(db.Float, default=0.0)
@@ -187,8 +438,40 @@ class RepairingInvoice(db.Model):
         return f"<RepairingInvoice {self.invoice_id}>"
     
 
+class RepairPartUsage(SyncTracked, db.Model):
+    # Repair parts taken from stock for a repair job; no job means use recorded by hand
+    __tablename__ = 'repair_part_usage'
+    __table_args__ = (db.Index('ix_repair_part_usage_part_used_at', 'repairing_accessory_id', 'used_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    repairing_device_id = db.Column(db.Integer, db.ForeignKey('repairing_device.id'), nullable=True, index=True)
+    repairing_accessory_id = db.Column(db.Integer, db.ForeignKey('repairing_accessory.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_cost = db.Column(db.Float, nullable=True)  # Part cost when it was used
+    used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    repairing_device = db.relationship('RepairingDevice', backref='part_usages', lazy=True)
+    part = db.relationship('RepairingAccessory', lazy=True)
+
+    def __repr__(self):
+        return f"<RepairPartUsage {self.repairing_device_id}: {self.repairing_accessory_id} x {self.quantity}>"
+
+
+def _invoice_field(name):
+    """Read-only attribute reading `name` of the related invoice through the relationship."""
+    return property(lambda self: getattr(self.invoice, name))
+
+
+def _profile_field(column, profile_id):
+    """Read-only attribute reading `column` of the referenced profile row."""
+    profile = column.class_
+    return db.column_property(
+        db.select(column).where(profile.id == profile_id).correlate_except(profile).scalar_subquery()
+    )
+
+
 # Models
-class Shop(db.Model):
+class Shop(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     address = db.Column(db.String(200), nullable=False)
@@ -197,12 +480,37 @@ class Shop(db.Model):
 
     def __repr__(self):
         return f"<Shop {self.name}>"
+
+
+class Customer(SyncTracked, db.Model):
+    # One person across phone sales, repairs and accessory sales, found by normalized phone number
+    id = db.Column(db.Integer, primary_key=True)
+    phone = db.Column(db.String(15), nullable=False, unique=True)
+    name = db.Column(db.String(100), nullable=True)  # Latest name given with this number
+    location = db.Column(db.String(200), nullable=True)
+    first_seen = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Customer {self.phone}>"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "phone": self.phone,
+            "name": self.name,
+            "location": self.location,
+            "first_seen": self.first_seen.isoformat(),
+            "last_seen": self.last_seen.isoformat(),
+        }
+
         
-class Invoice(db.Model):
+class Invoice(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     customer_name = db.Column(db.String(100), nullable=False)
     customer_phone = db.Column(db.String(15), nullable=False)
     customer_location = db.Column(db.String(200), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True, index=True)
     phone_id = db.Column(db.Integer, db.ForeignKey('phone.id'), nullable=False)
     shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
@@ -221,20 +529,25 @@ class Invoice(db.Model):
         return self.total_amount - self.paid_amount
 
     def update_paid_amount(self, payment):
-        """Update the paid amount and reflect changes in due_amount."""
+        """Update the paid amount and reflect changes in due_amount.
+
+        The caller owns the transaction: nothing is committed here.
+        """
         self.paid_amount += payment
-        db.session.commit()
 
-class Due(db.Model):
+class Due(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
-    phone_model = db.Column(db.String(100), nullable=False)
-    customer_name = db.Column(db.String(100), nullable=False)
+    # Snapshot of the model sold, so a later /phone/edit does not rewrite past payments
+    phone_model = db.Column(db.String(100), nullable=True)
     paid_amount = db.Column(db.Float, nullable=False)
     payment_date = db.Column(db.DateTime, default=datetime.utcnow)
 
-    # Relationship with the Invoice
-    invoice = db.relationship('Invoice', backref='dues')
+    # Relationship with the Invoice, joined so customer_name costs no extra query
+    invoice = db.relationship('Invoice', backref='dues', lazy='joined')
+
+    # The customer lives on the invoice
+    customer_name = _invoice_field('customer_name')
 
     def __repr__(self):
         return f"<Due {self.id} - {self.phone_model}>"
@@ -243,25 +556,27 @@ class Due(db.Model):
         # Update the paid_amount for the Due record
         self.paid_amount += payment
         self.payment_date = datetime.utcnow()  # Set the payment date to the current time
-        db.session.commit()
 
-        # Update the corresponding Invoice's due amount
-        invoice = Invoice.query.get(self.invoice_id)
-        invoice.update_due(payment)
+        # Update the corresponding Invoice's paid amount in the same transaction
+        invoice = self.invoice or Invoice.query.get(self.invoice_id)
+        invoice.update_paid_amount(payment)
+        db.session.flush()
 
-class InvoiceHistory(db.Model):
+class InvoiceHistory(SyncTracked, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
-    customer_name = db.Column(db.String(100), nullable=False)
-    customer_phone = db.Column(db.String(15), nullable=False)
-    customer_location = db.Column(db.String(200), nullable=False)
-    total_paid = db.Column(db.Float, nullable=False)
-    total_due = db.Column(db.Float, nullable=False)
-    total_amount = db.Column(db.Float, nullable=False)
     last_updated = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    # Relationship with Invoice
-    invoice = db.relationship('Invoice', backref='history')
+    # Relationship with Invoice, joined so the fields below cost no extra query
+    invoice = db.relationship('Invoice', backref='history', lazy='joined')
+
+    # Customer and totals live on the invoice; these read them back
+    customer_name = _invoice_field('customer_name')
+    customer_phone = _invoice_field('customer_phone')
+    customer_location = _invoice_field('customer_location')
+    total_paid = _invoice_field('paid_amount')
+    total_due = _invoice_field('due_amount')
+    total_amount = _invoice_field('total_amount')
 
     def __repr__(self):
         return f"<InvoiceHistory {self.id} - {self.invoice_id}>"
@@ -294,511 +609,3994 @@ class InvoiceHistory(db.Model):
         }
         
         
-class AccessorieInvoice(db.Model):
+class ShopProfile(SyncTracked, db.Model):
+    # Versioned copy of the shop details printed on a sale. Sales reference a
+    # version, so later edits to the shop do not rewrite old invoices.
+    __tablename__ = 'shop_profile'
+    __table_args__ = (db.UniqueConstraint('shop_id', 'version'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    invoice_id = db.Column(db.String(36), nullable=False, unique=True)  # UUID
-    user_name = db.Column(db.String(100), nullable=False)
-    user_phone = db.Column(db.String(15), nullable=False)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=True)
+    version = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    address = db.Column(db.String(200), nullable=False)
+    phone = db.Column(db.String(15), nullable=False)
+    email = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ShopProfile {self.shop_id} v{self.version}>"
+
+
+class AccessoryProfile(SyncTracked, db.Model):
+    # Versioned copy of the catalogue details of an accessory at the time of sale
+    __tablename__ = 'accessory_profile'
+    __table_args__ = (db.UniqueConstraint('accessory_id', 'version'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    accessory_id = db.Column(db.Integer, db.ForeignKey('accessory.id'), nullable=True)
+    version = db.Column(db.Integer, nullable=False)
     accessory_name = db.Column(db.String(100), nullable=False)
     company = db.Column(db.String(50), nullable=False)
     category = db.Column(db.String(50), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<AccessoryProfile {self.accessory_id} v{self.version}>"
+
+
+class AccessorieInvoice(SyncTracked, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.String(36), nullable=False, unique=True)  # UUID
+    user_name = db.Column(db.String(100), nullable=False)
+    user_phone = db.Column(db.String(15), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True, index=True)
+    accessory_profile_id = db.Column(db.Integer, db.ForeignKey('accessory_profile.id'), nullable=False)
     unit_price = db.Column(db.Float, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     total_price = db.Column(db.Float, nullable=False)
-    shop_name = db.Column(db.String(100), nullable=False)
-    shop_address = db.Column(db.String(200), nullable=False)
-    shop_phone = db.Column(db.String(15), nullable=False)
-    shop_email = db.Column(db.String(100), nullable=True)
-    date = db.Column(db.DateTime, default=datetime.utcnow)
+    shop_profile_id = db.Column(db.Integer, db.ForeignKey('shop_profile.id'), nullable=False)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    # The snapshot fields every sale used to copy, read through the profile rows
+    accessory_name = _profile_field(AccessoryProfile.accessory_name, accessory_profile_id)
+    company = _profile_field(AccessoryProfile.company, accessory_profile_id)
+    category = _profile_field(AccessoryProfile.category, accessory_profile_id)
+    shop_name = _profile_field(ShopProfile.name, shop_profile_id)
+    shop_address = _profile_field(ShopProfile.address, shop_profile_id)
+    shop_phone = _profile_field(ShopProfile.phone, shop_profile_id)
+    shop_email = _profile_field(ShopProfile.email, shop_profile_id)
 
     def __repr__(self):
         return f"<Invoice {self.invoice_id}>"
 
-# Utility function to verify auth key
-def verify_auth_key(auth_key):
-    return User.query.filter_by(auth_key=auth_key).first() is not None
-
-# Manually create tables
-with app.app_context():
-    db.create_all()
 
+class AccessoryCartInvoice(SyncTracked, db.Model):
+    # One invoice for several accessories sold together; the items are its lines
+    __tablename__ = 'accessory_cart_invoice'
 
-# User Management APIs
-@app.route('/register', methods=['GET'])
-def register():
-    username = request.args.get('username')
-    password = request.args.get('password')
-
-    if not username or not password:
-        return jsonify({"message": "Username and password are required"}), 400
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.String(36), nullable=False, unique=True)
+    user_name = db.Column(db.String(100), nullable=False)
+    user_phone = db.Column(db.String(15), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True, index=True)
+    shop_profile_id = db.Column(db.Integer, db.ForeignKey('shop_profile.id'), nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
+    date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-    if User.query.filter_by(username=username).first():
-        return jsonify({"message": "User already exists"}), 400
+    lines = db.relationship('AccessoryCartLine', backref='cart_invoice', order_by='AccessoryCartLine.id')
 
-    hashed_password = generate_password_hash(password)
-    auth_key = str(uuid.uuid4())
-    new_user = User(username=username, password=hashed_password, auth_key=auth_key)
-    db.session.add(new_user)
-    db.session.commit()
+    shop_name = _profile_field(ShopProfile.name, shop_profile_id)
+    shop_address = _profile_field(ShopProfile.address, shop_profile_id)
+    shop_phone = _profile_field(ShopProfile.phone, shop_profile_id)
+    shop_email = _profile_field(ShopProfile.email, shop_profile_id)
 
-    return jsonify({"message": "User registered successfully", "auth_key": auth_key}), 201
+    def __repr__(self):
+        return f"<AccessoryCartInvoice {self.invoice_id}>"
 
-@app.route('/login', methods=['GET'])
-def login():
-    username = request.args.get('username')
-    password = request.args.get('password')
 
-    if not username or not password:
-        return jsonify({"message": "Username and password are required"}), 400
+class AccessoryCartLine(SyncTracked, db.Model):
+    __tablename__ = 'accessory_cart_line'
 
-    user = User.query.filter_by(username=username).first()
-    if not user or not check_password_hash(user.password, password):
-        return jsonify({"message": "Invalid username or password"}), 401
+    id = db.Column(db.Integer, primary_key=True)
+    cart_invoice_id = db.Column(db.Integer, db.ForeignKey('accessory_cart_invoice.id'), nullable=False, index=True)
+    accessory_id = db.Column(db.Integer, db.ForeignKey('accessory.id'), nullable=False)
+    accessory_profile_id = db.Column(db.Integer, db.ForeignKey('accessory_profile.id'), nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    total_price = db.Column(db.Float, nullable=False)
 
-    return jsonify({"message": f"User '{username}' logged in successfully", "auth_key": user.auth_key}), 200
-    
-    
+    accessory_name = _profile_field(AccessoryProfile.accessory_name, accessory_profile_id)
+    company = _profile_field(AccessoryProfile.company, accessory_profile_id)
+    category = _profile_field(AccessoryProfile.category, accessory_profile_id)
 
-# Route to manage accessories
-@app.route('/accessory', methods=['GET'])
-def manage_accessory():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
+    def __repr__(self):
+        return f"<AccessoryCartLine {self.cart_invoice_id}: {self.accessory_id} x {self.quantity}>"
 
-    action = request.args.get('action')
-    try:
-        # Set Indian timezone
-        india_tz = timezone('Asia/Kolkata')
-        current_time_ist = datetime.now(india_tz)
 
-        if action == "add":
-            new_accessory = Accessory(
-                accessory_name=request.args.get('accessory_name'),
-                type=request.args.get('type'),
-                company=request.args.get('company'),
-                category=request.args.get('category'),
-                initial_stock=int(request.args.get('initial_stock', 0)),
-                added_stock=int(request.args.get('added_stock', 0)),
-                unit_price=float(request.args.get('unit_price', 0.0)),
-                minimum_stock=int(request.args.get('minimum_stock', 0)),
-                add_date=current_time_ist
-            )
-            db.session.add(new_accessory)
-            db.session.commit()
-            return jsonify({"message": "Accessory added successfully", "add_date": current_time_ist.isoformat()}), 201
+class SyncTombstone(db.Model):
+    # A deleted row, kept so /sync can tell clients to drop their copy
+    __tablename__ = 'sync_tombstone'
 
-        elif action == "update":
-            accessory_id = request.args.get('id')
-            accessory = Accessory.query.get(accessory_id)
-            if not accessory:
-                return jsonify({"message": "Accessory not found"}), 404
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(50), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-            update_fields = {
-                "added_stock": int(request.args.get('added_stock', 0)),
-                "last_purchase_quantity": int(request.args.get('last_purchase_quantity', 0)),
-                "unit_price": float(request.args.get('unit_price', accessory.unit_price)),
-                "minimum_stock": int(request.args.get('minimum_stock', accessory.minimum_stock)),
-                "times_sold": int(request.args.get('times_sold', accessory.times_sold)),
-            }
+    def __repr__(self):
+        return f"<SyncTombstone {self.entity} {self.entity_id}>"
 
-            # Handle stock adjustments
-            if update_fields["last_purchase_quantity"] > 0:
-                accessory.added_stock -= update_fields["last_purchase_quantity"]
-                accessory.stock_out += update_fields["last_purchase_quantity"]
-                accessory.last_purchase_quantity = update_fields["last_purchase_quantity"]
-                accessory.last_purchase_date = current_time_ist
 
-            if update_fields["added_stock"] > 0:
-                accessory.added_stock += update_fields["added_stock"]
+class ReorderForecast(db.Model):
+    # Precomputed demand and reorder suggestion per accessory and repair part
+    __tablename__ = 'reorder_forecast'
+    __table_args__ = (db.UniqueConstraint('item_type', 'item_id', name='uq_reorder_forecast_item'),)
 
-            # Update fields dynamically
-            for field, value in update_fields.items():
-                if field not in ["added_stock", "last_purchase_quantity"] and request.args.get(field) is not None:
-                    setattr(accessory, field, value)
+    id = db.Column(db.Integer, primary_key=True)
+    item_type = db.Column(db.String(30), nullable=False)  # "accessory" or "repairing_accessory"
+    item_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(100))
+    current_stock = db.Column(db.Integer, nullable=False, default=0)
+    minimum_stock = db.Column(db.Integer, nullable=False, default=0)
+    daily_demand = db.Column(db.Float, nullable=False)  # Exponentially smoothed units per day
+    moving_average = db.Column(db.Float, nullable=False)
+    demand_std = db.Column(db.Float, nullable=False)
+    days_of_cover = db.Column(db.Float, nullable=True)  # None when nothing sells
+    reorder_point = db.Column(db.Float, nullable=False)
+    suggested_quantity = db.Column(db.Integer, nullable=False, default=0)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-            alert = accessory.added_stock < accessory.minimum_stock
-            db.session.commit()
+    def to_dict(self):
+        return {
+            "item_type": self.item_type,
+            "item_id": self.item_id,
+            "name": self.name,
+            "current_stock": self.current_stock,
+            "minimum_stock": self.minimum_stock,
+            "daily_demand": round(self.daily_demand, 3),
+            "moving_average": round(self.moving_average, 3),
+            "demand_std": round(self.demand_std, 3),
+            "days_of_cover": round(self.days_of_cover, 1) if self.days_of_cover is not None else None,
+            "reorder_point": round(self.reorder_point, 1),
+            "suggested_quantity": self.suggested_quantity,
+        }
 
-            return jsonify({
-                "message": f"Accessory '{accessory.accessory_name}' updated successfully",
-                "current_stock": accessory.added_stock,
-                "stock_out": accessory.stock_out,
-                "last_purchase_quantity": accessory.last_purchase_quantity,
-                "last_purchase_date": current_time_ist.isoformat(),
-                "alert": alert
-            }), 200
 
-        elif action == "delete":
-            accessory_id = request.args.get('id')
-            accessory = Accessory.query.get(accessory_id)
-            if not accessory:
-                return jsonify({"message": "Accessory not found"}), 404
+class InvoiceSequence(db.Model):
+    # High-water mark of the invoice numbers handed out per shop and invoice kind
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), primary_key=True)
+    kind = db.Column(db.String(20), primary_key=True)  # "repair" or "accessory"
+    next_value = db.Column(db.Integer, nullable=False, default=1)
 
-            db.session.delete(accessory)
-            db.session.commit()
-            return jsonify({"message": f"Accessory with ID {accessory_id} deleted successfully"}), 200
+    def __repr__(self):
+        return f"<InvoiceSequence {self.shop_id}/{self.kind}: {self.next_value}>"
 
-        elif action == "view":
-            accessory_id = request.args.get('id')
-            if accessory_id:
-                accessory = Accessory.query.get(accessory_id)
-                if not accessory:
-                    return jsonify({"message": "Accessory not found"}), 404
 
-                current_stock = accessory.added_stock
-                alert = current_stock < accessory.minimum_stock
+class IdempotencyKey(db.Model):
+    # First response to a request sent with an Idempotency-Key header
+    __tablename__ = 'idempotency_key'
+    __table_args__ = (db.Index('ix_idempotency_key_expires_at', 'expires_at'),)
 
-                return jsonify({
-                    "id": accessory.id,
-                    "accessory_name": accessory.accessory_name,
-                    "type": accessory.type,
-                    "company": accessory.company,
-                    "category": accessory.category,
-                    "initial_stock": accessory.initial_stock,
-                    "current_stock": current_stock,
-                    "unit_price": accessory.unit_price,
-                    "minimum_stock": accessory.minimum_stock,
-                    "last_purchase_quantity": accessory.last_purchase_quantity,
-                    "times_sold": accessory.times_sold,
-                    "stock_out": accessory.stock_out,
-                    "add_date": accessory.add_date.isoformat(),
-                    "last_purchase_date": accessory.last_purchase_date.isoformat() if accessory.last_purchase_date else None,
-                    "alert": alert
-                }), 200
-            else:
-                accessories = Accessory.query.all()
-                results = []
-                for accessory in accessories:
-                    current_stock = accessory.added_stock
-                    alert = current_stock < accessory.minimum_stock
-
-                    results.append({
-                        "id": accessory.id,
-                        "accessory_name": accessory.accessory_name,
-                        "type": accessory.type,
-                        "company": accessory.company,
-                        "category": accessory.category,
-                        "initial_stock": accessory.initial_stock,
-                        "current_stock": current_stock,
-                        "unit_price": accessory.unit_price,
-                        "minimum_stock": accessory.minimum_stock,
-                        "last_purchase_quantity": accessory.last_purchase_quantity,
-                        "times_sold": accessory.times_sold,
-                        "stock_out": accessory.stock_out,
-                        "add_date": accessory.add_date.isoformat(),
-                        "last_purchase_date": accessory.last_purchase_date.isoformat() if accessory.last_purchase_date else None,
-                        "alert": alert
-                    })
-
-                return jsonify({"accessories": results}), 200
+    scope = db.Column(db.String(64), primary_key=True)  # sha256 of the caller's auth key
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)  # sha256 of method, path, query and body
+    status_code = db.Column(db.Integer, nullable=True)  # NULL while the first request is running
+    headers = db.Column(db.Text, nullable=True)  # JSON
+    body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
 
-        else:
-            return jsonify({"message": "Invalid action specified"}), 400
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key}: {self.status_code}>"
 
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"error": f"Error occurred: {str(e)}"}), 500
 
-@app.route('/repairing_accessory', methods=['GET'])
-def manage_repairing_accessory():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_job'
+    __table_args__ = (db.Index('ix_background_job_status_run_at', 'status', 'run_at'),)
 
-    action = request.args.get('action')
-    try:
-        india_tz = timezone('Asia/Kolkata')
-        current_time_ist = datetime.now(india_tz)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
 
-        if action == "add":
-            # Adding a new repairing accessory
-            name = request.args.get('name')
-            type_ = request.args.get('type')
-            company = request.args.get('company')
-            model = request.args.get('model')
+    def __repr__(self):
+        return f"<BackgroundJob {self.id} {self.name}: {self.status}>"
 
-            existing_accessory = RepairingAccessory.query.filter_by(
-                name=name, type=type_, company=company, model=model
-            ).first()
-
-            if existing_accessory:
-                return jsonify({"message": "Repairing accessory already exists."}), 400
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "payload": json.loads(self.payload),
+            "status": self.status,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "run_at": self.run_at.isoformat() if self.run_at else None,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "last_error": self.last_error,
+        }
 
-            new_accessory = RepairingAccessory(
-                name=name,
-                type=type_,
-                repairing_cost=float(request.args.get('repairing_cost', 0.0)),
-                selling_cost=float(request.args.get('selling_cost', 0.0)),
-                current_stock=int(request.args.get('current_stock', 0)),
-                add_stock=int(request.args.get('current_stock', 0)),
-                minimum_stock=int(request.args.get('minimum_stock', 0)),
-                alert=False,
-                company=company,
-                model=model
+# Utility function to verify auth key
+def verify_auth_key(auth_key):
+    if auth_key and auth_key == batch_auth_key.get():
+        return True
+    # Always checked against the live database, even inside a snapshot report
+    token = reading_snapshot.set(False)
+    try:
+        return User.query.filter_by(auth_key=auth_key).first() is not None
+    finally:
+        reading_snapshot.reset(token)
+
+
+class InvoiceNumberAllocator:
+    """Hands out per-shop, monotonically increasing invoice numbers.
+
+    Each worker reserves a block of numbers from `invoice_sequence` in its own
+    short transaction and then serves allocations from memory, so issuing an
+    invoice number costs a database round trip only once per block. Blocks are
+    never shared between processes, so numbers never collide; numbers left in
+    a block when a worker exits are simply skipped.
+    """
+
+    def __init__(self, block_size=50):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}  # (shop_id, kind) -> [next_number, end_exclusive]
+        self._pid = os.getpid()
+
+    def next_number(self, shop_id, kind):
+        key = (int(shop_id), kind)
+        with self._lock:
+            # A forked worker must not reuse the blocks reserved by its parent
+            if self._pid != os.getpid():
+                self._blocks = {}
+                self._pid = os.getpid()
+
+            block = self._blocks.get(key)
+            if block is None or block[0] >= block[1]:
+                block = self._blocks[key] = list(self._reserve_block(*key))
+            number = block[0]
+            block[0] += 1
+            return number
+
+    def next_number_in(self, conn, shop_id, kind):
+        """Take a single number inside the caller's transaction, bypassing the blocks.
+
+        Used when the caller already holds the write lock, where a separate
+        connection would wait for it; a rollback returns the number.
+        """
+        start, _ = self._reserve(conn, int(shop_id), kind, 1)
+        return start
+
+    def _reserve_block(self, shop_id, kind):
+        # Separate connection: the reservation must survive a rollback of the
+        # request that triggered it, otherwise another worker could reserve it too
+        with db.engine.begin() as conn:
+            return self._reserve(conn, shop_id, kind, self.block_size)
+
+    @staticmethod
+    def _reserve(conn, shop_id, kind, count):
+        # One round trip: the first reservation creates the row, later ones advance it
+        table = InvoiceSequence.__table__
+        end = conn.execute(
+            UPSERT_INSERTS[conn.dialect.name](table)
+            .values(shop_id=shop_id, kind=kind, next_value=1 + count)
+            .on_conflict_do_update(
+                index_elements=[table.c.shop_id, table.c.kind],
+                set_={'next_value': table.c.next_value + count},
             )
-            db.session.add(new_accessory)
-            db.session.commit()
-            return jsonify({
-                "message": "Repairing accessory added successfully",
-                "add_date": current_time_ist.isoformat()
-            }), 201
+            .returning(table.c.next_value)
+        ).scalar_one()
+        return end - count, end
 
-        elif action == "update":
-            # Updating an existing repairing accessory
-            accessory_id = request.args.get('id')
-            accessory = RepairingAccessory.query.get(accessory_id)
-            if not accessory:
-                return jsonify({"message": "Repairing accessory not found"}), 404
 
-            add_stock = int(request.args.get('add_stock', 0))
-            last_purchase_quantity = int(request.args.get('last_purchase_quantity', 0))
-            last_repairing_quantity = int(request.args.get('last_repairing_quantity', 0))
+invoice_number_allocator = InvoiceNumberAllocator(app.config['INVOICE_NUMBER_BLOCK_SIZE'])
 
-            if add_stock > 0:
-                accessory.current_stock += add_stock
-                accessory.add_stock += add_stock
 
-            if last_purchase_quantity > 0:
-                accessory.last_purchase_quantity = last_purchase_quantity
-                accessory.current_stock -= last_purchase_quantity
-                accessory.total_out_stock += last_purchase_quantity
-                accessory.last_purchase_date = current_time_ist
+def allocate_invoice_number(shop_id, kind):
+    """Return the next human-readable invoice number, e.g. 'REP-001-000042'."""
+    if batch_savepoint.get() is not None:
+        # Earlier operations of the batch may already hold the write lock
+        conn = db.session.connection(bind_arguments={'mapper': InvoiceSequence})
+        number = invoice_number_allocator.next_number_in(conn, shop_id, kind)
+    else:
+        number = invoice_number_allocator.next_number(shop_id, kind)
+    prefix = app.config['INVOICE_NUMBER_PREFIXES'][kind]
+    return f"{prefix}-{int(shop_id):03d}-{number:06d}"
 
-            if last_repairing_quantity > 0:
-                accessory.last_repairing_quantity = last_repairing_quantity
-                accessory.current_stock -= last_repairing_quantity
-                accessory.total_out_stock += last_repairing_quantity
-                accessory.last_repairing_date = current_time_ist
 
-            accessory.repairing_cost = float(request.args.get('repairing_cost', accessory.repairing_cost))
-            accessory.selling_cost = float(request.args.get('selling_cost', accessory.selling_cost))
+# ----- Fast Reads -----
+class FastRead:
+    """A read-only Core SELECT whose rows are serialized straight from tuples.
 
-            accessory.alert = accessory.current_stock < accessory.minimum_stock
+    List endpoints only copy columns into JSON, so they skip ORM instances
+    and the identity map. The statement is built once, and its compiled
+    form lives in a cache of its own where the ad-hoc statements sharing
+    the engine's cache cannot evict it. Reads go through the session's
+    connection, so shop routing, report snapshots and the archive views
+    apply as they do to ORM queries.
+    """
 
-            db.session.commit()
+    compiled_cache = LRUCache(app.config['FAST_READ_CACHE_SIZE'])
 
-            return jsonify({
-                "message": f"Repairing accessory '{accessory.name}' updated successfully",
-                **accessory.to_dict()
-            }), 200
+    def __init__(self, mapper, statement):
+        self.mapper = mapper
+        self.statement = statement
+        self.keys = [column.key for column in statement.selected_columns]
 
-        elif action == "delete":
-            # Deleting an existing repairing accessory
-            accessory_id = request.args.get('id')
-            accessory = RepairingAccessory.query.get(accessory_id)
-            if not accessory:
-                return jsonify({"message": "Repairing accessory not found"}), 404
+    def rows(self, **params):
+        conn = db.session.connection(bind_arguments={'mapper': self.mapper})
+        return conn.execute(self.statement, params, execution_options={'compiled_cache': self.compiled_cache}).all()
 
-            db.session.delete(accessory)
-            db.session.commit()
-            return jsonify({"message": f"Repairing accessory with ID {accessory_id} deleted successfully"}), 200
+    def dicts(self, **params):
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in self.rows(**params)]
 
-        elif action == "view":
-            # Viewing one or all repairing accessories
-            accessory_id = request.args.get('id')
-            if accessory_id:
-                accessory = RepairingAccessory.query.get(accessory_id)
-                if not accessory:
-                    return jsonify({"message": "Repairing accessory not found"}), 404
 
-                return jsonify(accessory.to_dict()), 200
-            else:
-                accessories = RepairingAccessory.query.all()
-                return jsonify({
-                    "repairing_accessories": [accessory.to_dict() for accessory in accessories]
-                }), 200
+def _isoformat(value):
+    return value.isoformat() if value else None
 
-        else:
-            return jsonify({"message": "Invalid action specified"}), 400
 
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"error": f"Error occurred: {str(e)}"}), 500
-        
-        
-        
-@app.route('/phone/add', methods=['GET'])
-def add_phone():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
+def _timestamp(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S')
 
-    imei = request.args.get('imei')
-    model_name = request.args.get('model_name')
-    company = request.args.get('company')
-    is_new = request.args.get('is_new')
-    price = request.args.get('price')
-    is_available = request.args.get('is_available')  # This will replace stock
 
-    if not imei or not model_name or not company or is_new is None or not price or is_available is None:
-        return jsonify({"message": "All fields are required (IMEI, model_name, company, is_new, price, is_available)"}), 400
+def _columns(table, *names):
+    return [table.c[name] for name in names]
 
-    try:
-        is_new = bool(int(is_new))
-        price = float(price)
-        is_available = bool(int(is_available))  # 1 for available, 0 for sold out
-    except ValueError:
-        return jsonify({"message": "Invalid input values"}), 400
 
-    if Phone.query.filter_by(imei=imei).first():
-        return jsonify({"message": "Phone with this IMEI already exists"}), 400
+_phones = Phone.__table__
+PHONE_LIST = FastRead(Phone, db.select(*_columns(
+    _phones, 'id', 'imei', 'model_name', 'company', 'is_new', 'price', 'status', 'date_added',
+)).order_by(_phones.c.id))
 
-    # Set status based on availability
-    status = "Available" if is_available else "Sold Out"
-    
-    phone = Phone(imei=imei, model_name=model_name, company=company, is_new=is_new, price=price, status=status)
-    db.session.add(phone)
-    db.session.commit()
+_accessories = Accessory.__table__
+ACCESSORY_LIST = FastRead(Accessory, db.select(*_columns(
+    _accessories, 'id', 'accessory_name', 'type', 'company', 'category', 'initial_stock', 'added_stock', 'unit_price',
+    'minimum_stock', 'last_purchase_quantity', 'times_sold', 'stock_out', 'add_date', 'last_purchase_date',
+)).order_by(_accessories.c.id))
 
-    phone_type = "New" if is_new else "Old"
-    return jsonify({"message": f"{phone_type} phone '{model_name}' by {company} added successfully"}), 201
+_repairing_accessories = RepairingAccessory.__table__
+REPAIRING_ACCESSORY_LIST = FastRead(RepairingAccessory, db.select(*_columns(
+    _repairing_accessories, 'id', 'name', 'type', 'repairing_cost', 'selling_cost', 'current_stock', 'add_stock',
+    'last_purchase_quantity', 'last_repairing_quantity', 'total_out_stock', 'last_purchase_date', 'minimum_stock',
+    'last_repairing_date', 'alert', 'company', 'model',
+)).order_by(_repairing_accessories.c.id))
 
+_repairing_devices = RepairingDevice.__table__
+REPAIRING_DEVICE_LIST = FastRead(RepairingDevice, db.select(*_columns(
+    _repairing_devices, 'id', 'customer_name', 'phone_number', 'received_by', 'company', 'model', 'device_condition',
+    'repairing_status', 'repairing_cost', 'estimated_delivery_date', 'parts_replaced', 'bill_status', 'due_price',
+    'advance_payment', 'payment_method', 'delivery_status', 'technician_name', 'date_added',
+)).order_by(_repairing_devices.c.id))
 
+_repairing_invoices, _shops = RepairingInvoice.__table__, Shop.__table__
+REPAIRING_INVOICE_LIST = FastRead(RepairingInvoice, db.select(
+    *_columns(_repairing_invoices, 'invoice_id', 'repairing_device_id', 'customer_name', 'repairing_cost',
+              'advance_payment', 'due_price', 'bill_status', 'payment_method', 'created_at'),
+    *_columns(_shops, 'id', 'name', 'address', 'phone', 'email'),
+).join(_shops, _shops.c.id == _repairing_invoices.c.shop_id).order_by(_repairing_invoices.c.id))
+
+# An invoice shows its first history row, as the per-invoice lookups it replaces did
+_invoices, _histories, _dues = Invoice.__table__, InvoiceHistory.__table__, Due.__table__
+_first_history = (
+    db.select(_histories.c.invoice_id, db.func.min(_histories.c.id).label('id'))
+    .group_by(_histories.c.invoice_id).subquery()
+)
+PHONE_INVOICE_LIST = FastRead(Invoice, db.select(
+    *_columns(_invoices, 'id', 'customer_name', 'customer_phone', 'customer_location', 'paid_amount',
+              'total_amount', 'date_created'),
+    *_columns(_phones, 'model_name', 'company', 'imei', 'price', 'status', 'is_new', 'date_added'),
+    *_columns(_shops, 'name', 'address', 'phone', 'email'),
+    _histories.c.last_updated,
+)
+    .join(_phones, _phones.c.id == _invoices.c.phone_id)
+    .join(_shops, _shops.c.id == _invoices.c.shop_id)
+    .join(_first_history, _first_history.c.invoice_id == _invoices.c.id)
+    .join(_histories, _histories.c.id == _first_history.c.id)
+    .order_by(_invoices.c.id))
+PHONE_INVOICE_PAYMENTS = FastRead(Due, db.select(
+    _dues.c.invoice_id, _dues.c.phone_model, _invoices.c.customer_name, _dues.c.paid_amount, _dues.c.payment_date,
+)
+    .join(_invoices, _invoices.c.id == _dues.c.invoice_id)
+    .order_by(_dues.c.invoice_id, _dues.c.id))
 
-@app.route('/phone/view', methods=['GET'])
-def view_phones():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
 
-    phones = Phone.query.all()
-    phone_list = [
+def phone_list():
+    return [
         {
-            "id": phone.id,
-            "imei": phone.imei,
-            "model_name": phone.model_name,
-            "company": phone.company,
-            "is_new": "New" if phone.is_new else "Old",
-            "price": phone.price,
-            "status": phone.status,  # Showing status (Available or Sold Out)
-            "date_added": phone.date_added
+            "id": id_,
+            "imei": imei,
+            "model_name": model_name,
+            "company": company,
+            "is_new": "New" if is_new else "Old",
+            "price": price,
+            "status": status,  # Showing status (Available or Sold Out)
+            "date_added": date_added
         }
-        for phone in phones
+        for id_, imei, model_name, company, is_new, price, status, date_added in PHONE_LIST.rows()
     ]
-    return jsonify({"phones": phone_list}), 200
 
-    
 
+def accessory_list():
+    return [
+        {
+            "id": id_,
+            "accessory_name": accessory_name,
+            "type": type_,
+            "company": company,
+            "category": category,
+            "initial_stock": initial_stock,
+            "current_stock": added_stock,
+            "unit_price": unit_price,
+            "minimum_stock": minimum_stock,
+            "last_purchase_quantity": last_purchase_quantity,
+            "times_sold": times_sold,
+            "stock_out": stock_out,
+            "add_date": add_date.isoformat(),
+            "last_purchase_date": _isoformat(last_purchase_date),
+            "alert": added_stock < minimum_stock
+        }
+        for (id_, accessory_name, type_, company, category, initial_stock, added_stock, unit_price, minimum_stock,
+             last_purchase_quantity, times_sold, stock_out, add_date, last_purchase_date) in ACCESSORY_LIST.rows()
+    ]
 
-# ----- Selling Product Management -----
-@app.route('/selling/edit', methods=['GET'])
-def edit_selling_product():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
 
-    product_id = request.args.get('id')
-    name = request.args.get('name')
-    type = request.args.get('type')
-    price = request.args.get('price')
-    quantity = request.args.get('quantity')
+def repairing_accessory_list():
+    accessories = REPAIRING_ACCESSORY_LIST.dicts()
+    for accessory in accessories:
+        accessory["last_purchase_date"] = _isoformat(accessory["last_purchase_date"])
+        accessory["last_repairing_date"] = _isoformat(accessory["last_repairing_date"])
+    return accessories
 
-    product = SellingProduct.query.filter_by(id=product_id).first()
-    if not product:
-        return jsonify({"message": "Product not found"}), 404
 
-    if name: product.name = name
-    if type: product.type = type
-    if price:
-        try:
-            product.price = float(price)
-        except ValueError:
-            return jsonify({"message": "Price must be a float"}), 400
-    if quantity:
+def repairing_invoice_list():
+    return [
+        {
+            "invoice_id": invoice_id,
+            "repairing_device_id": repairing_device_id,
+            "customer_name": customer_name,
+            "repairing_cost": repairing_cost,
+            "advance_payment": advance_payment,
+            "due_price": due_price,
+            "bill_status": bill_status,
+            "payment_method": payment_method,
+            "created_at": _timestamp(created_at),
+            "shop_details": {
+                "shop_id": shop_id,
+                "shop_name": shop_name,
+                "shop_address": shop_address,
+                "shop_phone": shop_phone,
+                "shop_email": shop_email,
+            }
+        }
+        for (invoice_id, repairing_device_id, customer_name, repairing_cost, advance_payment, due_price, bill_status,
+             payment_method, created_at, shop_id, shop_name, shop_address, shop_phone, shop_email)
+        in REPAIRING_INVOICE_LIST.rows()
+    ]
+
+
+def phone_invoice_list():
+    payments = {}
+    for invoice_id, phone_model, customer_name, paid_amount, payment_date in PHONE_INVOICE_PAYMENTS.rows():
+        payments.setdefault(invoice_id, []).append({
+            'phone_model': phone_model,
+            'customer_name': customer_name,
+            'paid_amount': paid_amount,
+            'payment_date': _timestamp(payment_date)
+        })
+    result = []
+    for (invoice_id, customer_name, customer_phone, customer_location, paid_amount, total_amount, date_created,
+         model_name, company, imei, price, status, is_new, date_added,
+         shop_name, shop_address, shop_phone, shop_email, last_updated) in PHONE_INVOICE_LIST.rows():
+        result.append({
+            'invoice_id': invoice_id,
+            'customer_name': customer_name,
+            'customer_phone': customer_phone,
+            'customer_location': customer_location,
+            'total_paid': paid_amount,
+            'total_due': total_amount - paid_amount,
+            'total_amount': total_amount,
+            'date_created': _timestamp(date_created),
+            'phone_details': {
+                'model_name': model_name,
+                'company': company,
+                'imei': imei,
+                'price': price,
+                'status': status,
+                'is_new': is_new,
+                'date_added': _timestamp(date_added)
+            },
+            'shop_details': {
+                'name': shop_name,
+                'address': shop_address,
+                'phone': shop_phone,
+                'email': shop_email
+            },
+            'invoice_history': {
+                'invoice_id': invoice_id,
+                'customer_name': customer_name,
+                'customer_phone': customer_phone,
+                'customer_location': customer_location,
+                'total_paid': paid_amount,
+                'total_due': total_amount - paid_amount,
+                'total_amount': total_amount,
+                'last_updated': _timestamp(last_updated)
+            },
+            'due_details': payments.get(invoice_id, [])
+        })
+    return result
+
+
+def _orm_read_baselines():
+    """The ORM reads the list endpoints used before, for `flask read-path-benchmark`."""
+    def columns(model, keys):
+        return lambda: [{key: getattr(obj, key) for key in keys} for obj in model.query.all()]
+
+    def repairing_invoices():
+        return [
+            {key: getattr(invoice, key) for key in REPAIRING_INVOICE_LIST.keys[:9]}
+            | {"shop_name": invoice.shop.name, "shop_address": invoice.shop.address}
+            for invoice in RepairingInvoice.query.all()
+        ]
+
+    def phone_invoices():
+        def fields(obj, *keys):
+            return {key: getattr(obj, key) for key in keys}
+
+        result = []
+        for invoice in Invoice.query.all():
+            phone = Phone.query.filter_by(id=invoice.phone_id).first()
+            shop = Shop.query.filter_by(id=invoice.shop_id).first()
+            history = InvoiceHistory.query.filter_by(invoice_id=invoice.id).first()
+            dues = Due.query.filter_by(invoice_id=invoice.id).all()
+            result.append({
+                **fields(invoice, 'id', 'customer_name', 'customer_phone', 'customer_location', 'paid_amount',
+                         'due_amount', 'total_amount', 'date_created'),
+                'phone_details': fields(phone, 'model_name', 'company', 'imei', 'price', 'status', 'is_new',
+                                        'date_added'),
+                'shop_details': fields(shop, 'name', 'address', 'phone', 'email'),
+                'invoice_history': fields(history, 'invoice_id', 'customer_name', 'customer_phone',
+                                          'customer_location', 'total_paid', 'total_due', 'total_amount',
+                                          'last_updated'),
+                'due_details': [fields(due, 'phone_model', 'customer_name', 'paid_amount', 'payment_date')
+                                for due in dues],
+            })
+        return result
+
+    return {
+        'phones': (columns(Phone, PHONE_LIST.keys), phone_list),
+        'accessories': (columns(Accessory, ACCESSORY_LIST.keys), accessory_list),
+        'repairing_accessories': (lambda: [a.to_dict() for a in RepairingAccessory.query.all()],
+                                  repairing_accessory_list),
+        'repairing_devices': (columns(RepairingDevice, REPAIRING_DEVICE_LIST.keys), REPAIRING_DEVICE_LIST.dicts),
+        'repairing_invoices': (repairing_invoices, repairing_invoice_list),
+        'phone_invoices': (phone_invoices, phone_invoice_list),
+    }
+
+
+def _measure_read(read, runs):
+    """(rows, median seconds, peak traced bytes) of `read` on a fresh session each run."""
+    timings = []
+    for _ in range(runs):
+        db.session.remove()
+        started = time.perf_counter()
+        rows = len(read())
+        timings.append(time.perf_counter() - started)
+    db.session.remove()
+    tracemalloc.start()
+    try:
+        read()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        db.session.remove()
+    return rows, sorted(timings)[len(timings) // 2], peak
+
+
+@app.cli.command('read-path-benchmark')
+@click.option('--runs', type=int, default=5, help="Timed runs per path; the median is reported.")
+@click.option('--shop-id', type=int, default=None, help="Shop partition to read when partitioning is on.")
+def read_path_benchmark_command(runs, shop_id):
+    """Compare rows per second and peak memory of the ORM and Core list reads."""
+    with shop_context(shop_id):
+        for name, (orm_read, core_read) in _orm_read_baselines().items():
+            rows, orm_seconds, orm_peak = _measure_read(orm_read, runs)
+            _, core_seconds, core_peak = _measure_read(core_read, runs)
+            click.echo(f"{name}: {rows} rows")
+            for label, seconds, peak in (('orm', orm_seconds, orm_peak), ('core', core_seconds, core_peak)):
+                click.echo(f"  {label:>4}: {seconds * 1000:8.2f} ms, {rows / max(seconds, 1e-9):10.0f} rows/s, "
+                           f"peak {peak / 1024:8.1f} KiB")
+            click.echo(f"  speedup {orm_seconds / max(core_seconds, 1e-9):.1f}x, "
+                       f"memory {core_peak / max(orm_peak, 1):.0%} of the ORM path")
+
+
+# ----- Background Jobs -----
+logger = logging.getLogger(__name__)
+
+BACKGROUND_TASKS = {}
+
+
+def background_task(name):
+    """Register a function as a background job handler under `name`."""
+    def decorator(fn):
+        BACKGROUND_TASKS[name] = fn
+        return fn
+    return decorator
+
+
+def enqueue_job(name, delay=0, max_attempts=None, **payload):
+    """Add a job to the current transaction.
+
+    The job row is committed together with the data it relates to, so a side
+    effect is never lost or run for a rolled back write. With partitioning
+    the row goes to the selected shop's database and the job runs for that
+    shop. The queue is woken as soon as the surrounding transaction commits.
+    """
+    if name not in BACKGROUND_TASKS:
+        raise KeyError(f"Unknown background task '{name}'")
+    job = BackgroundJob(
+        name=name,
+        payload=json.dumps(payload, default=str),
+        max_attempts=max_attempts or app.config['JOB_MAX_ATTEMPTS'],
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    db.session.add(job)
+    db.session.info['wake_job_queue'] = True
+    return job
+
+
+@event.listens_for(db.session, 'after_commit')
+def _wake_job_queue_after_commit(session):
+    # Also dispatched when a savepoint is released; only the real commit counts
+    if session.in_nested_transaction():
+        return
+    if session.info.pop('wake_job_queue', False):
+        job_queue.wake()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_job_queue_wakeup(session):
+    session.info.pop('wake_job_queue', None)
+
+
+class JobQueue:
+    """Runs jobs from the `background_job` table on a thread pool.
+
+    A dispatcher thread claims due jobs with a conditional UPDATE, so several
+    worker processes can share one table without running a job twice. With
+    partitioning it serves the main database's table and every shop's, and
+    a job is identified by its (shop_id, id) pair. Failed jobs are retried
+    with exponential backoff and jitter and are dead-lettered after
+    `max_attempts`.
+    """
+
+    def __init__(self, workers=2, poll_interval=2.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._executor = None
+        self._dispatcher = None
+        self._pid = None
+        self._running = 0
+        self._last_purge = 0.0
+        self.stats = {"succeeded": 0, "failed": 0, "retried": 0, "dead_lettered": 0}
+        self._latencies = []  # (queue wait, run time) of recent jobs, in seconds
+
+    def ensure_started(self):
+        if self._pid == os.getpid() and self._dispatcher is not None and self._dispatcher.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._dispatcher is not None and self._dispatcher.is_alive():
+                return
+            # Threads do not survive a fork, so each worker process starts its own
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._running = 0
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job-worker')
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True)
+            self._dispatcher.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wakeup.set()
+        if self._dispatcher is not None and wait:
+            self._dispatcher.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+        self._dispatcher = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    @staticmethod
+    def partitions():
+        """(shop_id, engine) of every database with a job table; None is the main database."""
+        if not app.config['SHOP_PARTITIONING']:
+            return [(None, db.engine)]
+        return [(None, db.engine)] + [
+            (shop_id, shop_partitions.engine(shop_id)) for shop_id in shop_partitions.shop_ids()
+        ]
+
+    @staticmethod
+    def _engine(shop_id):
+        return db.engine if shop_id is None else shop_partitions.engine(shop_id)
+
+    def _dispatch_loop(self):
+        while not self._stop.is_set():
+            timeout = self.poll_interval
+            try:
+                with app.app_context():
+                    self._reclaim_lost_jobs()
+                    self._purge_finished_jobs()
+                    for shop_id, job_id in self._claim_due_jobs():
+                        self._executor.submit(self._run_job, shop_id, job_id)
+                    timeout = self._seconds_until_next_job()
+            except Exception:
+                logger.exception("Background job dispatcher failed")
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def _seconds_until_next_job(self):
+        # Sleep until the next scheduled retry instead of a full poll interval
+        table = BackgroundJob.__table__
+        next_runs = []
+        for _, engine in self.partitions():
+            with engine.connect() as conn:
+                next_runs.append(conn.execute(
+                    db.select(db.func.min(table.c.run_at)).where(table.c.status == 'queued')
+                ).scalar())
+        next_run = min((run_at for run_at in next_runs if run_at is not None), default=None)
+        if next_run is None:
+            return self.poll_interval
+        return min(self.poll_interval, max(0.01, (next_run - datetime.utcnow()).total_seconds()))
+
+    def _claim_due_jobs(self):
+        with self._lock:
+            free = self.workers - self._running
+        if free <= 0:
+            return []
+        table = BackgroundJob.__table__
+        now = datetime.utcnow()
+        claimed = []
+        for shop_id, engine in self.partitions():
+            if len(claimed) >= free:
+                break
+            with engine.begin() as conn:
+                candidates = conn.execute(
+                    db.select(table.c.id)
+                    .where(table.c.status == 'queued', table.c.run_at <= now)
+                    .order_by(table.c.run_at, table.c.id)
+                    .limit(free - len(claimed))
+                    # PostgreSQL dispatchers skip each other's candidates; SQLite has one writer anyway
+                    .with_for_update(skip_locked=True)
+                ).scalars().all()
+                for job_id in candidates:
+                    updated = conn.execute(
+                        table.update()
+                        .where(table.c.id == job_id, table.c.status == 'queued')
+                        .values(status='running', started_at=now, attempts=table.c.attempts + 1)
+                    ).rowcount
+                    if updated:
+                        claimed.append((shop_id, job_id))
+        with self._lock:
+            self._running += len(claimed)
+        return claimed
+
+    def _reclaim_lost_jobs(self):
+        table = BackgroundJob.__table__
+        cutoff = datetime.utcnow() - timedelta(seconds=app.config['JOB_LEASE_SECONDS'])
+        for _, engine in self.partitions():
+            with engine.begin() as conn:
+                conn.execute(
+                    table.update()
+                    .where(table.c.status == 'running', table.c.started_at < cutoff)
+                    .values(status='queued', run_at=datetime.utcnow())
+                )
+
+    def _purge_finished_jobs(self):
+        if time.monotonic() - self._last_purge < 3600:
+            return
+        self._last_purge = time.monotonic()
+        table = BackgroundJob.__table__
+        cutoff = datetime.utcnow() - timedelta(hours=app.config['JOB_RETENTION_HOURS'])
+        for _, engine in self.partitions():
+            with engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.status == 'done', table.c.finished_at < cutoff))
+
+    def _run_job(self, shop_id, job_id):
         try:
-            product.quantity = int(quantity)
-        except ValueError:
-            return jsonify({"message": "Quantity must be an integer"}), 400
+            with app.app_context():
+                with shop_context(shop_id):
+                    job = db.session.get(BackgroundJob, job_id)
+                    name, payload = job.name, json.loads(job.payload)
+                    attempts, max_attempts = job.attempts, job.max_attempts
+                    waited = max(0.0, (job.started_at - job.run_at).total_seconds())
+                    db.session.rollback()
+
+                started = time.monotonic()
+                # Jobs queued in the main database before shops had job tables name their shop
+                token = current_shop_id.set(payload.pop('_shop_id', shop_id))
+                try:
+                    BACKGROUND_TASKS[name](**payload)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.exception("Background job %s (%s) failed", job_id, name)
+                    self._record_failure(shop_id, job_id, attempts, max_attempts, e)
+                    return
+                finally:
+                    db.session.close()
+                    current_shop_id.reset(token)
+
+                self._finish(shop_id, job_id, status='done', finished_at=datetime.utcnow(), last_error=None)
+                with self._lock:
+                    self.stats["succeeded"] += 1
+                    self._latencies.append((waited, time.monotonic() - started))
+                    del self._latencies[:-1000]
+        finally:
+            with self._lock:
+                self._running -= 1
+            self.wake()
+
+    def _record_failure(self, shop_id, job_id, attempts, max_attempts, error):
+        with self._lock:
+            self.stats["failed"] += 1
+        if attempts >= max_attempts:
+            self._finish(shop_id, job_id, status='dead', finished_at=datetime.utcnow(), last_error=repr(error))
+            with self._lock:
+                self.stats["dead_lettered"] += 1
+            return
+        delay = min(app.config['JOB_BACKOFF_BASE'] * (2 ** (attempts - 1)), app.config['JOB_BACKOFF_MAX'])
+        delay *= random.uniform(0.8, 1.2)
+        self._finish(shop_id, job_id, status='queued', run_at=datetime.utcnow() + timedelta(seconds=delay),
+                     last_error=repr(error))
+        with self._lock:
+            self.stats["retried"] += 1
+
+    def _finish(self, shop_id, job_id, **values):
+        table = BackgroundJob.__table__
+        with self._engine(shop_id).begin() as conn:
+            conn.execute(table.update().where(table.c.id == job_id).values(**values))
+
+    def metrics(self):
+        table = BackgroundJob.__table__
+        depth, oldest = {}, None
+        for _, engine in self.partitions():
+            with engine.connect() as conn:
+                for status, count in conn.execute(
+                    db.select(table.c.status, db.func.count()).group_by(table.c.status)
+                ):
+                    depth[status] = depth.get(status, 0) + count
+                queued = conn.execute(
+                    db.select(db.func.min(table.c.run_at)).where(table.c.status == 'queued')
+                ).scalar()
+            if queued is not None and (oldest is None or queued < oldest):
+                oldest = queued
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = dict(self.stats)
+            running_here = self._running
+
+        def percentile(values, pct):
+            if not values:
+                return None
+            values = sorted(values)
+            return round(values[min(len(values) - 1, int(len(values) * pct))], 4)
+
+        waits = [w for w, _ in latencies]
+        runs = [r for _, r in latencies]
+        now = datetime.utcnow()
+        return {
+            "depth": {status: depth.get(status, 0) for status in ('queued', 'running', 'done', 'dead')},
+            "oldest_queued_age_seconds": max(0.0, (now - oldest).total_seconds()) if oldest else 0.0,
+            "running_in_this_worker": running_here,
+            "counters": stats,
+            "queue_wait_seconds": {"p50": percentile(waits, 0.5), "p95": percentile(waits, 0.95)},
+            "run_time_seconds": {"p50": percentile(runs, 0.5), "p95": percentile(runs, 0.95)},
+        }
 
-    db.session.commit()
-    return jsonify({"message": f"Selling product '{product.name}' updated successfully"}), 200
 
-@app.route('/selling/delete', methods=['GET'])
-def delete_selling_product():
+job_queue = JobQueue(app.config['JOB_WORKERS'], app.config['JOB_POLL_INTERVAL'])
+
+
+@app.before_request
+def start_job_queue():
+    if app.config['JOB_QUEUE_ENABLED']:
+        job_queue.ensure_started()
+
+
+@background_task('refresh_low_stock_alerts')
+def refresh_low_stock_alerts():
+    # One statement recomputes the alert flag, touching only the parts whose flag changes
+    low = RepairingAccessory.current_stock < RepairingAccessory.minimum_stock
+    RepairingAccessory.query.filter(RepairingAccessory.alert.is_distinct_from(low)).update(
+        {RepairingAccessory.alert: low},
+        synchronize_session=False
+    )
+
+
+@app.route('/jobs/stats', methods=['GET'])
+def job_stats():
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
 
-    product_id = request.args.get('id')
-    product = SellingProduct.query.filter_by(id=product_id).first()
-    if not product:
-        return jsonify({"message": "Product not found"}), 404
+    return jsonify(job_queue.metrics()), 200
 
-    db.session.delete(product)
-    db.session.commit()
-    return jsonify({"message": f"Selling product '{product.name}' deleted successfully"}), 200
 
-# ----- Phone Management -----
-@app.route('/phone/edit', methods=['GET'])
-def edit_phone():
+@app.route('/jobs/dead', methods=['GET'])
+def dead_jobs():
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
 
-    phone_id = request.args.get('id')
-    imei = request.args.get('imei')
-    model_name = request.args.get('model_name')
-    company = request.args.get('company')
-    is_new = request.args.get('is_new')
-    price = request.args.get('price')
-    is_available = request.args.get('is_available')  # New availability field
+    action = request.args.get('action', 'view')
+    if action == 'view':
+        dead = []
+        for shop_id, _ in job_queue.partitions():
+            with shop_context(shop_id):
+                jobs = BackgroundJob.query.filter_by(status='dead').order_by(
+                    BackgroundJob.finished_at.desc()).limit(200).all()
+                dead.extend((job.finished_at, dict(job.to_dict(), shop_id=shop_id)) for job in jobs)
+                # Ids repeat across shops, so identities must not leak between them
+                db.session.close()
+        dead.sort(key=lambda item: item[0] or datetime.min, reverse=True)
+        return jsonify({"dead_jobs": [job for _, job in dead[:200]]}), 200
+
+    elif action == 'retry':
+        # A job lives in the database of the shop_id listed with it; none is the main database
+        with shop_context(request.args.get('shop_id') or None):
+            job = BackgroundJob.query.filter_by(id=request.args.get('id'), status='dead').first()
+            if not job:
+                return jsonify({"message": "Dead job not found"}), 404
+            job.status = 'queued'
+            job.attempts = 0
+            job.run_at = datetime.utcnow()
+            db.session.info['wake_job_queue'] = True
+            db.session.commit()
+            return jsonify({"message": f"Job {job.id} re-queued"}), 200
+
+    return jsonify({"message": "Invalid action specified"}), 400
+
+# ----- Rate Limiting -----
+# Endpoints that aggregate or export whole tables, render documents or run many
+# operations; plain list screens stay cheap
+EXPENSIVE_ENDPOINTS = {
+    'export_ledger', 'delta_sync', 'view_inventory_analytics', 'view_reorder_forecast', 'customer_history',
+    'repair_parts_usage', 'print_invoice', 'run_batch', 'bulk_upsert_repair_parts',
+}
+
+
+def _spend_token(tokens, updated, now, rate, burst):
+    """Refill a bucket up to `now` and take one token: (tokens left, seconds to wait or 0)."""
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryTokenBuckets:
+    """Token buckets kept in this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, wait = _spend_token(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+        return wait
+
+    def prune(self, idle_seconds):
+        cutoff = time.monotonic() - idle_seconds
+        with self._lock:
+            for key in [key for key, (_, updated) in self._buckets.items() if updated < cutoff]:
+                del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteTokenBuckets:
+    """Token buckets in a SQLite file shared by every worker process on the host.
+
+    A bucket is read and written in one IMMEDIATE transaction, so workers
+    never spend the same token twice. The file skips fsync: losing it only
+    refills every bucket.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS token_bucket '
+                         '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated FROM token_bucket WHERE key = ?', (key,)).fetchone()
+            tokens, wait = _spend_token(*(row or (burst, now)), now, rate, burst)
+            conn.execute(
+                'INSERT INTO token_bucket (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (key, tokens, now),
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+    def prune(self, idle_seconds):
+        self._connection().execute('DELETE FROM token_bucket WHERE updated < ?', (time.time() - idle_seconds,))
+
+    def __len__(self):
+        return self._connection().execute('SELECT count(*) FROM token_bucket').fetchone()[0]
+
+
+class RateLimiter:
+    """Per-client request budgets plus a cap on expensive requests running at once.
+
+    Each auth key gets one token bucket per route class (RATE_LIMITS) and
+    client address, so the devices of one shop do not share a budget; an
+    empty bucket answers 429 with the time until the next token. Expensive
+    routes additionally need one of EXPENSIVE_CONCURRENCY slots in this
+    process (the slots are never shared between processes) and are shed with a 503 when none frees up within
+    EXPENSIVE_ADMISSION_WAIT, so one client cannot occupy every worker.
+    """
+
+    prune_interval = 60
+
+    def __init__(self, buckets, concurrency):
+        self.buckets = buckets
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+        self._in_flight = 0
+        self.stats = {
+            "allowed": {"cheap": 0, "expensive": 0},
+            "rate_limited": {"cheap": 0, "expensive": 0},
+            "shed": 0,
+            "storage_errors": 0,
+            "peak_in_flight": 0,
+        }
 
-    phone = Phone.query.filter_by(id=phone_id).first()
-    if not phone:
-        return jsonify({"message": "Phone not found"}), 404
+    @staticmethod
+    def client_key(client, route_class):
+        return f"{route_class}:{hashlib.sha256(client.encode()).hexdigest()}"
 
-    if imei: phone.imei = imei
-    if model_name: phone.model_name = model_name
-    if company: phone.company = company
-    if is_new is not None:
-        try:
-            phone.is_new = bool(int(is_new))
-        except ValueError:
-            return jsonify({"message": "is_new must be 0 (old) or 1 (new)"}), 400
-    if price: 
-        try:
-            phone.price = float(price)
-        except ValueError:
-            return jsonify({"message": "Price must be a float"}), 400
-    if is_available is not None:
+    def take(self, client, route_class):
+        """Spend one token of the client's budget; returns 0 or the seconds until one is available."""
+        rate, burst = app.config['RATE_LIMITS'][route_class]
         try:
-            is_available = bool(int(is_available))  # 1 for available, 0 for sold out
-            phone.update_status(is_available)
-        except ValueError:
-            return jsonify({"message": "is_available must be 0 (sold out) or 1 (available)"}), 400
+            wait = self.buckets.take(self.client_key(client, route_class), rate, burst)
+            self._prune()
+        except sqlite3.Error:
+            # A broken limiter must not take the shop down with it
+            logger.exception("Rate limit storage failed, request allowed")
+            wait = 0.0
+            with self._lock:
+                self.stats["storage_errors"] += 1
+        with self._lock:
+            self.stats["rate_limited" if wait else "allowed"][route_class] += 1
+        return wait
+
+    def admit(self):
+        """Reserve a slot for an expensive request; False when the server is saturated."""
+        if not self._slots.acquire(timeout=app.config['EXPENSIVE_ADMISSION_WAIT']):
+            with self._lock:
+                self.stats["shed"] += 1
+            return False
+        with self._lock:
+            self._in_flight += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self._in_flight)
+        return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _prune(self):
+        if time.monotonic() - self._last_prune < self.prune_interval:
+            return
+        self._last_prune = time.monotonic()
+        # A bucket idle for longer than its refill time is full, the same as no bucket
+        self.buckets.prune(max(burst / rate for rate, burst in app.config['RATE_LIMITS'].values()))
+
+    def metrics(self):
+        with self._lock:
+            stats = json.loads(json.dumps(self.stats))
+            in_flight = self._in_flight
+        return {
+            "storage": type(self.buckets).__name__,
+            "tracked_buckets": len(self.buckets),
+            "expensive_in_flight": in_flight,
+            "expensive_capacity": app.config['EXPENSIVE_CONCURRENCY'],
+            "counters": stats,
+            "single_flight": dict(report_flights.stats),
+        }
 
-    db.session.commit()
-    return jsonify({"message": f"Phone '{phone.model_name}' updated successfully"}), 200
+
+rate_limiter = RateLimiter(
+    SQLiteTokenBuckets(app.config['RATE_LIMIT_DATABASE_PATH'])
+    if app.config['RATE_LIMIT_STORAGE'] == 'sqlite' else MemoryTokenBuckets(),
+    app.config['EXPENSIVE_CONCURRENCY'],
+)
 
 
-@app.route('/phone/delete', methods=['GET'])
-def delete_phone():
+def rate_limit_class(endpoint):
+    return 'expensive' if endpoint in EXPENSIVE_ENDPOINTS else 'cheap'
+
+
+def rate_limit_client():
+    """Whose budget the current request spends: its auth key from its address."""
+    return f"{request.args.get('auth_key') or ''}@{request.remote_addr}"
+
+
+def charge_rate_limit(endpoint):
+    """Spend a token for `endpoint`; returns the 429 response when the budget is empty."""
+    wait = rate_limiter.take(rate_limit_client(), rate_limit_class(endpoint))
+    if wait:
+        return _rejection(429, "Too many requests, slow down", math.ceil(wait))
+    return None
+
+
+def _rejection(status, message, retry_after):
+    response = jsonify({"message": message, "retry_after": retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+@app.before_request
+def enforce_rate_limits():
+    if not app.config['RATE_LIMIT_ENABLED'] or request.endpoint is None:
+        return None
+    # Coalesced reports are charged in single_flight, where followers are known
+    if not getattr(app.view_functions[request.endpoint], 'single_flight', False):
+        rejection = charge_rate_limit(request.endpoint)
+        if rejection is not None:
+            return rejection
+    if rate_limit_class(request.endpoint) == 'expensive':
+        if not rate_limiter.admit():
+            return _rejection(503, "Server busy, retry shortly", app.config['EXPENSIVE_RETRY_AFTER'])
+        request.environ['rate_limit_slot'] = True
+    return None
+
+
+@app.teardown_request
+def release_expensive_slot(exception=None):
+    if request.environ.pop('rate_limit_slot', None):
+        rate_limiter.release()
+
+
+@app.route('/rate_limit/stats', methods=['GET'])
+def rate_limit_stats():
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
 
-    phone_id = request.args.get('id')
-    phone = Phone.query.filter_by(id=phone_id).first()
-    if not phone:
-        return jsonify({"message": "Phone not found"}), 404
+    return jsonify(rate_limiter.metrics()), 200
+
+
+# ----- Request Coalescing -----
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one computation per key at a time; callers arriving meanwhile share its outcome.
+
+    The first caller of a key computes. Later callers wait for it and get
+    its result, or its exception raised again, without computing
+    themselves. A finished computation is forgotten at once, so the next
+    caller computes afresh: nothing is cached beyond the computation.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.stats = {"computed": 0, "shared": 0, "timeouts": 0, "errors": 0}
+
+    def do(self, key, compute, timeout, on_wait=None):
+        """Result of `compute` for `key`; returns (result, shared)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if on_wait is not None:
+                on_wait()
+            if not flight.done.wait(timeout):
+                with self._lock:
+                    self.stats["timeouts"] += 1
+                raise SingleFlightTimeout(key)
+            with self._lock:
+                self.stats["shared"] += 1
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = compute()
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                self.stats["computed"] += 1
+            flight.done.set()
+        return flight.result, False
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._flights
+
+
+report_flights = SingleFlight()
+
+
+def _release_admission_slot():
+    # A waiting caller does no work, so its expensive-request slot goes to someone who does
+    if request.environ.pop('rate_limit_slot', None):
+        rate_limiter.release()
+
+
+def single_flight(view):
+    """Let identical concurrent requests of a report share one computation.
+
+    Requests match on endpoint, shop partition and query string without the
+    auth key, which is checked for every caller before it may share. Each
+    waiting caller gets its own copy of the response. Reports run inside a
+    /batch are never shared. Only a caller that computes spends a rate limit
+    token; one joining a running computation is free.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = None
+        session = db.session
+        # Inside /batch the report would see, or miss, writes that are not committed yet
+        if (app.config['SINGLE_FLIGHT_ENABLED'] and verify_auth_key(request.args.get('auth_key'))
+                and batch_savepoint.get() is None and not (session.new or session.dirty or session.deleted)):
+            arguments = sorted((name, value) for name, value in request.args.items(multi=True) if name != 'auth_key')
+            key = (request.endpoint, current_shop_id.get(), json.dumps(arguments), json.dumps(kwargs, sort_keys=True))
+        # /batch charges each of its operations itself
+        if (app.config['RATE_LIMIT_ENABLED'] and batch_savepoint.get() is None
+                and not (key is not None and report_flights.in_flight(key))):
+            rejection = charge_rate_limit(request.endpoint)
+            if rejection is not None:
+                return rejection
+        if key is None:
+            return view(*args, **kwargs)
+
+        def compute():
+            response = app.make_response(view(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers.items())
 
-    db.session.delete(phone)
-    db.session.commit()
-    return jsonify({"message": f"Phone '{phone.model_name}' deleted successfully"}), 200
-    
+        try:
+            (body, status, headers), shared = report_flights.do(
+                key, compute, app.config['SINGLE_FLIGHT_TIMEOUT'], on_wait=_release_admission_slot
+            )
+        except SingleFlightTimeout:
+            return _rejection(503, "Report is still being computed, retry shortly", app.config['EXPENSIVE_RETRY_AFTER'])
+        response = Response(body, status=status, headers=headers)
+        if shared:
+            response.headers['X-Coalesced'] = 'true'
+        return response
+    wrapper.single_flight = True
+    return wrapper
 
 
-@app.route('/repairingdevice/add', methods=['GET'])
-def add_repairing_device():
-    # Extract parameters from the request, handling empty or missing strings
-    def handle_missing_string(value, default="None"):
-        return value.strip() if value and value.strip() else default
+# ----- Response Compression -----
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/csv', 'text/html', 'text/plain', 'text/event-stream'}
 
-    auth_key = request.args.get('auth_key')
-    customer_name = handle_missing_string(request.args.get('customer_name'), "N/A")
-    phone_number = handle_missing_string(request.args.get('phone_number'), "N/A")
-    received_by = handle_missing_string(request.args.get('received_by'), "N/A")
+
+def _gzip_stream(level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def _brotli_stream(level):
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+def _zstd_stream(level):
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return compressor.compress, lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), compressor.flush
+
+
+# Content-Encoding -> (compress a whole body, start a chunk-by-chunk compressor), best first
+RESPONSE_ENCODINGS = {}
+if zstandard is not None:
+    RESPONSE_ENCODINGS['zstd'] = (lambda data, level: zstandard.ZstdCompressor(level=level).compress(data), _zstd_stream)
+if brotli is not None:
+    RESPONSE_ENCODINGS['br'] = (lambda data, level: brotli.compress(data, quality=level), _brotli_stream)
+RESPONSE_ENCODINGS['gzip'] = (lambda data, level: gzip.compress(data, level, mtime=0), _gzip_stream)
+
+
+def negotiate_encoding(accept_encodings):
+    """The encoding the client rates highest, preferring the most efficient on a tie."""
+    best, best_quality = None, 0
+    for encoding in RESPONSE_ENCODINGS:
+        quality = accept_encodings.quality(encoding)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def _compressed_stream(body, encoder):
+    compress, flush, finish = encoder
+    try:
+        for chunk in body:
+            # Flushed per chunk so every CSV chunk or event reaches the client at once
+            data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+
+@app.after_request
+def compress_response(response):
+    # Registered before the other after_request hooks, so it runs last and
+    # idempotent replays are stored uncompressed
+    if not app.config['COMPRESSION_ENABLED'] or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (request.method == 'HEAD' or response.status_code in (204, 304) or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        # Files and precompressed bodies are sent as they are
+        return response
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    compress, stream = RESPONSE_ENCODINGS[encoding]
+    level = app.config['COMPRESSION_LEVELS'][encoding]
+    if response.is_streamed:
+        response.response = _compressed_stream(response.response, stream(level))
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+        response.set_data(compress(data, level))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def _benchmark_payloads(auth_key, paths):
+    client = app.test_client()
+    for path in paths:
+        response = client.get(path, query_string={'auth_key': auth_key, 'fresh': '1'},
+                              headers={'Accept-Encoding': 'identity'})
+        yield path, response.status_code, response.get_data()
+
+
+@app.cli.command('compression-benchmark')
+@click.option('--path', 'paths', multiple=True, default=['/invoice_history', '/repairingdevice/view'],
+              help="Endpoint whose response is compressed (repeatable).")
+@click.option('--auth-key', help="Auth key to call the endpoints with (defaults to the first user's).")
+@click.option('--link-mbps', type=float, default=2.0, help="Link speed used to estimate the transfer time.")
+@click.option('--runs', type=int, default=5, help="Timed runs per level; the median is reported.")
+def compression_benchmark_command(paths, auth_key, link_mbps, runs):
+    """Compress real endpoint responses at every level and show CPU time against bytes sent."""
+    if auth_key is None:
+        user = User.query.first()
+        if user is None:
+            raise click.ClickException("No users yet, pass --auth-key")
+        auth_key = user.auth_key
+    levels = {'gzip': (1, 6, 9), 'br': (1, 4, 6, 9, 11), 'zstd': (1, 3, 6, 12, 19)}
+    for path, status, data in _benchmark_payloads(auth_key, paths):
+        link_ms = len(data) * 8 / (link_mbps * 1000)
+        click.echo(f"{path}: HTTP {status}, {len(data)} bytes, {link_ms:.0f} ms at {link_mbps:g} Mbit/s uncompressed")
+        for encoding, (compress, _) in RESPONSE_ENCODINGS.items():
+            for level in levels[encoding]:
+                timings = []
+                for _ in range(runs):
+                    started = time.perf_counter()
+                    size = len(compress(data, level))
+                    timings.append(time.perf_counter() - started)
+                cpu_ms = sorted(timings)[len(timings) // 2] * 1000
+                total_ms = cpu_ms + size * 8 / (link_mbps * 1000)
+                marker = " *" if app.config['COMPRESSION_LEVELS'][encoding] == level else ""
+                click.echo(f"  {encoding:>4} {level:>2}: {size:>9} bytes ({size / max(len(data), 1):6.1%}), "
+                           f"{cpu_ms:7.2f} ms CPU, {len(data) / 1e6 / max(cpu_ms / 1000, 1e-9):7.1f} MB/s, "
+                           f"{total_ms:7.0f} ms CPU + transfer{marker}")
+
+
+# ----- Idempotency Keys -----
+class IdempotencyStore:
+    """Replays the stored first response to requests retried with the same Idempotency-Key.
+
+    Checking a key is a primary-key read. The key is claimed by a row that is
+    written in the handler's own commit, so it costs no extra commit, and a
+    concurrent retry fails on the key instead of writing twice. The response
+    is stored when the request ends. Keys are scoped to the caller's auth key.
+    """
+
+    header = 'Idempotency-Key'
+
+    def __init__(self):
+        self._last_purge = 0.0
+
+    @staticmethod
+    def scope():
+        return hashlib.sha256((request.args.get('auth_key') or '').encode()).hexdigest()
+
+    @staticmethod
+    def fingerprint():
+        digest = hashlib.sha256()
+        for part in (request.method, request.path, request.query_string, request.get_data()):
+            digest.update(part if isinstance(part, bytes) else part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def lookup(self, scope, key):
+        """The live row for a key, dropping one whose first request was lost."""
+        table = IdempotencyKey.__table__
+        now = datetime.utcnow()
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(table).where(table.c.scope == scope, table.c.key == key, table.c.expires_at > now)
+            ).first()
+        stale = now - timedelta(seconds=app.config['IDEMPOTENCY_PENDING_TIMEOUT'])
+        if row is not None and row.status_code is None and row.created_at < stale:
+            self.release(scope, key)
+            return None
+        return row
+
+    def claim(self, scope, key, fingerprint):
+        now = datetime.utcnow()
+        self._purge_expired(now)
+        return IdempotencyKey(
+            scope=scope, key=key, fingerprint=fingerprint, created_at=now,
+            expires_at=now + timedelta(hours=app.config['IDEMPOTENCY_TTL_HOURS']),
+        )
+
+    def store(self, claim, response, committed):
+        """Save the response for the claimed key; returns the row that won if another request did."""
+        table = IdempotencyKey.__table__
+        values = dict(
+            status_code=response.status_code,
+            headers=json.dumps({name: value for name, value in response.headers.items() if name != 'Content-Length'}),
+            body=response.get_data(),
+        )
+        with db.engine.begin() as conn:
+            if committed:
+                conn.execute(table.update().where(
+                    table.c.scope == claim.scope, table.c.key == claim.key, table.c.status_code.is_(None)
+                ).values(**values))
+                return None
+            try:
+                with conn.begin_nested():
+                    conn.execute(table.insert().values(
+                        scope=claim.scope, key=claim.key, fingerprint=claim.fingerprint,
+                        created_at=claim.created_at, expires_at=claim.expires_at, **values
+                    ))
+                return None
+            except exc.IntegrityError:
+                return conn.execute(
+                    db.select(table).where(table.c.scope == claim.scope, table.c.key == claim.key)
+                ).first()
+
+    def release(self, scope, key):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as conn:
+            conn.execute(
+                table.delete().where(table.c.scope == scope, table.c.key == key, table.c.status_code.is_(None))
+            )
+
+    def _purge_expired(self, now):
+        if time.monotonic() - self._last_purge < app.config['IDEMPOTENCY_PURGE_INTERVAL']:
+            return
+        self._last_purge = time.monotonic()
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.expires_at <= now))
+
+    @staticmethod
+    def replay(row):
+        """Response for a request whose key already has a row."""
+        if row.status_code is None:
+            response = jsonify({"message": "A request with this Idempotency-Key is still being processed"})
+            response.status_code = 409
+            response.headers['Retry-After'] = '1'
+            return response
+        response = Response(row.body, status=row.status_code, headers=json.loads(row.headers or '{}'))
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+
+idempotency_store = IdempotencyStore()
+
+
+@app.before_request
+def replay_idempotent_request():
+    key = request.headers.get(IdempotencyStore.header)
+    if not key:
+        return None
+    if len(key) > 255:
+        return jsonify({"message": "Idempotency-Key must be at most 255 characters"}), 400
+    scope, fingerprint = IdempotencyStore.scope(), IdempotencyStore.fingerprint()
+    row = idempotency_store.lookup(scope, key)
+    if row is None:
+        request.environ['idempotency_claim'] = idempotency_store.claim(scope, key, fingerprint)
+        return None
+    if row.fingerprint != fingerprint:
+        return jsonify({"message": "Idempotency-Key was already used for a different request"}), 422
+    return IdempotencyStore.replay(row)
+
+
+@event.listens_for(db.session, 'before_commit')
+def _write_idempotency_claim(session):
+    # The claim becomes visible exactly when the handler's writes do
+    claim = request.environ.get('idempotency_claim') if has_request_context() else None
+    if claim is None or claim in session or session.in_nested_transaction():
+        return
+    if not request.environ.get('idempotency_committed'):
+        session.add(claim)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _mark_idempotency_claim_committed(session):
+    claim = request.environ.get('idempotency_claim') if has_request_context() else None
+    if claim is not None and claim in session and not session.in_nested_transaction():
+        request.environ['idempotency_committed'] = True
+
+
+@app.after_request
+def store_idempotent_response(response):
+    claim = request.environ.pop('idempotency_claim', None)
+    if claim is None:
+        return response
+    committed = request.environ.pop('idempotency_committed', False)
+    # Anything the handler left open must not hold the write lock while the response is saved
+    db.session.rollback()
+    streamed = response.is_streamed or response.direct_passthrough
+    if not committed and (streamed or response.status_code >= 500):
+        # Nothing was written, so a server error may be retried for real
+        row = idempotency_store.lookup(claim.scope, claim.key)
+        return IdempotencyStore.replay(row) if row is not None else response
+    if streamed:
+        # The writes are committed and a retry must not repeat them, but the body cannot be kept
+        stored = jsonify({"message": "Request already applied; its response could not be stored"})
+        stored.status_code = response.status_code
+        idempotency_store.store(claim, stored, committed)
+        return response
+    winner = idempotency_store.store(claim, response, committed)
+    return IdempotencyStore.replay(winner) if winner is not None else response
+
+
+# ----- Shop Partitions -----
+class ShopPartitions:
+    """Engines for the per-shop databases used when SHOP_PARTITIONING is on.
+
+    Every shop file holds the shop's inventory, repairs, invoices and queued
+    jobs; the main database keeps GLOBAL_TABLES and is attached to each shop connection as
+    `global`, so joins against shops and users keep working. Writes in
+    different shops lock different files and no longer serialize on one lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = {}
+
+    def path(self, shop_id):
+        return os.path.join(app.config['SHOP_PARTITION_DIR'], f'shop_{int(shop_id)}.db')
+
+    def engine(self, shop_id):
+        shop_id = int(shop_id)
+        engine = self._engines.get(shop_id)
+        if engine is not None:
+            return engine
+        with self._lock:
+            engine = self._engines.get(shop_id)
+            if engine is None:
+                engine = self._create_engine(shop_id)
+                self._engines[shop_id] = engine
+            return engine
+
+    def _create_engine(self, shop_id):
+        if not sqlite_backend():
+            raise RuntimeError("Shop partitions are SQLite files; use one PostgreSQL database for all shops")
+        with db.engine.connect() as conn:
+            if conn.execute(db.select(Shop.id).where(Shop.id == shop_id)).first() is None:
+                raise ShopNotSelected(f"Shop {shop_id} does not exist")
+        os.makedirs(app.config['SHOP_PARTITION_DIR'], exist_ok=True)
+        engine = create_engine(f"sqlite:///{self.path(shop_id)}")
+        global_path = db.engine.url.database
+
+        @event.listens_for(engine, 'connect')
+        def attach_global(dbapi_connection, connection_record):
+            dbapi_connection.execute("ATTACH DATABASE ? AS global", (global_path,))
+
+        # Global tables must not exist in the shop file: main would shadow them
+        db.metadata.create_all(engine, tables=[
+            table for table in db.metadata.sorted_tables if table.name not in GLOBAL_TABLES
+        ])
+        upgrade_schema(engine, exclude=GLOBAL_TABLES,
+                       archive=archive_path(shop_id) if app.config['SHOP_PARTITIONING'] else None)
+        return engine
+
+    def shop_ids(self):
+        with db.engine.connect() as conn:
+            return conn.execute(db.select(Shop.id).order_by(Shop.id)).scalars().all()
+
+
+shop_partitions = ShopPartitions()
+
+
+def partition_targets():
+    """(shop_id, engine) pairs a report or maintenance task should cover."""
+    if not app.config['SHOP_PARTITIONING']:
+        return [(None, db.engine)]
+    if current_shop_id.get() is not None:
+        return [(current_shop_id.get(), shop_partitions.engine(current_shop_id.get()))]
+    return [(shop_id, shop_partitions.engine(shop_id)) for shop_id in shop_partitions.shop_ids()]
+
+
+@contextmanager
+def shop_context(shop_id):
+    """Route the current session to one shop's partition for the block."""
+    token = current_shop_id.set(int(shop_id) if shop_id is not None else None)
+    try:
+        yield
+    finally:
+        current_shop_id.reset(token)
+
+
+@app.before_request
+def select_shop_partition():
+    if not app.config['SHOP_PARTITIONING']:
+        return None
+    shop_id = request.args.get('shop_id')
+    if not shop_id and request.is_json:
+        # POST routes such as the cart name their shop in the body
+        body = request.get_json(silent=True)
+        shop_id = body.get('shop_id') if isinstance(body, dict) else None
+    if not shop_id:
+        user = User.query.filter_by(auth_key=request.args.get('auth_key')).first()
+        shop_id = user.shop_id if user else None
+    try:
+        shop_id = int(shop_id) if shop_id else None
+    except (TypeError, ValueError):
+        return jsonify({"message": "shop_id must be an integer"}), 400
+    request.environ['shop_partition_token'] = current_shop_id.set(shop_id)
+    return None
+
+
+@app.teardown_request
+def release_shop_partition(exception=None):
+    token = request.environ.pop('shop_partition_token', None)
+    if token is not None:
+        current_shop_id.reset(token)
+
+
+@app.errorhandler(ShopNotSelected)
+def handle_shop_not_selected(e):
+    db.session.rollback()
+    return jsonify({"message": str(e)}), 400
+
+
+def cross_shop_report(list_key):
+    """Fan a list endpoint out over every shop when no shop is selected."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config['SHOP_PARTITIONING'] or current_shop_id.get() is not None:
+                return view(*args, **kwargs)
+            combined = None
+            for shop_id in shop_partitions.shop_ids():
+                with shop_context(shop_id):
+                    response, status = view(*args, **kwargs)
+                    # Ids repeat across shops, so identities must not leak between them
+                    db.session.close()
+                if status != 200:
+                    return response, status
+                data = response.get_json()
+                if combined is None:
+                    combined = data
+                else:
+                    combined[list_key].extend(data[list_key])
+            return jsonify(combined or {list_key: []}), 200
+        return wrapper
+    return decorator
+
+
+@app.cli.command('partition-shops')
+@click.option('--inventory-shop', type=int, required=True,
+              help="Shop that receives inventory and repair rows that carry no shop.")
+def partition_shops_command(inventory_shop):
+    """Copy the rows of a single-file database into per-shop partitions."""
+    if not sqlite_backend():
+        raise click.ClickException("Shop partitions are only available on SQLite")
+    shop_scoped = {
+        'invoice': 'shop_id = :shop_id',
+        'due': 'invoice_id IN (SELECT id FROM main.invoice WHERE shop_id = :shop_id)',
+        'invoice_history': 'invoice_id IN (SELECT id FROM main.invoice WHERE shop_id = :shop_id)',
+        'repairing_invoice': 'shop_id = :shop_id',
+        'shop_profile': 'shop_id = :shop_id',
+        'accessory_profile': '1 = 1',
+        'accessorie_invoice': 'shop_profile_id IN (SELECT id FROM main.shop_profile WHERE shop_id = :shop_id)',
+        'accessory_cart_invoice': 'shop_profile_id IN (SELECT id FROM main.shop_profile WHERE shop_id = :shop_id)',
+        'accessory_cart_line': 'cart_invoice_id IN (SELECT c.id FROM main.accessory_cart_invoice c '
+                               'JOIN main.shop_profile p ON p.id = c.shop_profile_id WHERE p.shop_id = :shop_id)',
+    }
+    for shop_id in shop_partitions.shop_ids():
+        shop_partitions.engine(shop_id)
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql("ATTACH DATABASE ? AS part", (shop_partitions.path(shop_id),))
+            try:
+                for table in db.metadata.sorted_tables:
+                    if table.name in GLOBAL_TABLES or table.name in PER_DATABASE_TABLES:
+                        continue
+                    if table.name in shop_scoped:
+                        where = shop_scoped[table.name]
+                    elif shop_id == inventory_shop:
+                        where = '1 = 1'
+                    else:
+                        continue
+                    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+                    count = conn.execute(db.text(
+                        f'INSERT OR IGNORE INTO part."{table.name}" ({columns}) '
+                        f'SELECT {columns} FROM main."{table.name}" WHERE {where}'
+                    ), {"shop_id": shop_id}).rowcount
+                    click.echo(f"shop {shop_id}: {table.name}: {count} rows")
+                conn.commit()
+            finally:
+                conn.exec_driver_sql("DETACH DATABASE part")
+    click.echo("Done. Set SHOP_PARTITIONING = True once the copies are verified.")
+
+
+# ----- Report Snapshots -----
+class ReportSnapshots:
+    """Read-only copies of the live database files for long report queries.
+
+    A snapshot is taken with the SQLite online backup API in small page steps
+    and swapped in atomically, so reports never hold locks on the live file.
+    Snapshot engines do not pool connections: every checkout opens the file
+    currently in place. The snapshot's mtime is the time it was last known to
+    match the live file, so worker processes share one copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_locks = {}
+        self._engines = {}
+        self._thread = None
+        self._pid = None
+
+    def path(self, live_engine):
+        name = os.path.basename(live_engine.url.database)
+        return os.path.join(app.config['REPORT_SNAPSHOT_DIR'], f"{name}.snapshot")
+
+    def age(self, live_engine):
+        """Seconds since the snapshot was taken, or None if there is none."""
+        try:
+            return max(0.0, time.time() - os.path.getmtime(self.path(live_engine)))
+        except OSError:
+            return None
+
+    def _refresh_lock(self, live_engine):
+        with self._lock:
+            return self._refresh_locks.setdefault(self.path(live_engine), threading.Lock())
+
+    def refresh(self, live_engine, max_age=None, wait=True):
+        """Copy the live file into the snapshot; returns whether a copy was made.
+
+        A snapshot younger than `max_age` when the refresh lock is taken was
+        refreshed by someone else meanwhile and is kept. Without `wait`
+        nothing happens while another refresh of the file is running. Only
+        one process copies a file at a time, and a live file that has not
+        been written since the snapshot was taken is not copied again: the
+        snapshot is stamped as current instead.
+        """
+        source_path = live_engine.url.database
+        target = self.path(live_engine)
+        refresh_lock = self._refresh_lock(live_engine)
+        if not refresh_lock.acquire(blocking=wait):
+            return False
+        try:
+            if max_age is not None:
+                age = self.age(live_engine)
+                if age is not None and age < max_age:
+                    return False
+            os.makedirs(app.config['REPORT_SNAPSHOT_DIR'], exist_ok=True)
+            lock_path = f"{target}.lock"
+            try:
+                if time.time() - os.path.getmtime(lock_path) > 600:
+                    os.remove(lock_path)  # Left behind by a crashed worker
+            except OSError:
+                pass
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False  # Another worker process is taking this snapshot
+            try:
+                if self._unchanged_since_snapshot(source_path, target):
+                    os.utime(target)
+                    return False
+                tmp_path = f"{target}.{os.getpid()}.tmp"
+                source = sqlite3.connect(source_path)
+                destination = sqlite3.connect(tmp_path)
+                try:
+                    # Small steps with a pause let live writers in between
+                    source.backup(destination, pages=app.config['REPORT_SNAPSHOT_PAGES'], sleep=0.005)
+                finally:
+                    destination.close()
+                    source.close()
+                os.replace(tmp_path, target)
+                return True
+            finally:
+                os.close(fd)
+                os.remove(lock_path)
+        finally:
+            refresh_lock.release()
+
+    @staticmethod
+    def _unchanged_since_snapshot(source_path, target):
+        """Whether neither the live file nor its write-ahead log was written after the snapshot.
+
+        A backup restarts when another connection writes the source, so the
+        copy is finished, and stamped, after the last write it contains.
+        """
+        try:
+            taken = os.path.getmtime(target)
+        except OSError:
+            return False
+        for path in (source_path, f"{source_path}-wal"):
+            try:
+                if os.path.getmtime(path) >= taken:
+                    return False
+            except OSError:
+                pass
+        return True
+
+    def refresh_in_background(self, live_engine):
+        if self._refresh_lock(live_engine).locked():
+            return
+        threading.Thread(
+            target=self.refresh, args=(live_engine, app.config['REPORT_SNAPSHOT_MAX_AGE'], False),
+            name='report-snapshot-refresh', daemon=True,
+        ).start()
+
+    def fresh(self, live_engine):
+        age = self.age(live_engine)
+        return age is not None and age <= app.config['REPORT_SNAPSHOT_MAX_AGE']
+
+    def engine_for(self, live_engine):
+        """The snapshot engine, or `live_engine` while the snapshot is missing or too old.
+
+        A full copy is never taken on the request path: a stale snapshot is
+        refreshed in the background and reports read the live file meanwhile.
+        """
+        if not self.fresh(live_engine):
+            self.refresh_in_background(live_engine)
+            return live_engine
+        target = self.path(live_engine)
+        engine = self._engines.get(target)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(target)
+                if engine is None:
+                    engine = self._engines[target] = self._create_engine(live_engine, target)
+        return engine
+
+    def _create_engine(self, live_engine, target):
+        engine = create_engine(f"sqlite:///file:{target}?mode=ro&uri=true", poolclass=NullPool)
+        if live_engine is not db.engine:
+            # Shop partitions see users and shops through the live main database
+            global_uri = f"file:{db.engine.url.database}?mode=ro"
+
+            @event.listens_for(engine, 'connect')
+            def attach_global(dbapi_connection, connection_record):
+                dbapi_connection.execute("ATTACH DATABASE ? AS global", (global_uri,))
+        return engine
+
+    def discard(self):
+        """Remove every snapshot, e.g. after a schema upgrade the copies predate."""
+        directory = app.config['REPORT_SNAPSHOT_DIR']
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name.endswith('.snapshot'):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+    def live_engines(self):
+        engines = [db.engine]
+        if app.config['SHOP_PARTITIONING']:
+            engines += [shop_partitions.engine(shop_id) for shop_id in shop_partitions.shop_ids()]
+        return engines
+
+    def ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._refresh_loop, name='report-snapshots', daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                with app.app_context():
+                    for engine in self.live_engines():
+                        # Another worker or a request may have refreshed it already
+                        self.refresh(engine, max_age=app.config['REPORT_SNAPSHOT_INTERVAL'])
+            except Exception:
+                logger.exception("Report snapshot refresh failed")
+            time.sleep(app.config['REPORT_SNAPSHOT_INTERVAL'])
+
+
+report_snapshots = ReportSnapshots()
+
+
+@app.before_request
+def start_report_snapshots():
+    if app.config['REPORT_SNAPSHOT_ENABLED']:
+        report_snapshots.ensure_started()
+
+
+@contextmanager
+def snapshot_reads():
+    """Send every query of the block to the report snapshots."""
+    token = reading_snapshot.set(True)
+    try:
+        yield
+    finally:
+        # Connections opened on a snapshot must not be reused for live reads
+        db.session.rollback()
+        reading_snapshot.reset(token)
+
+
+def snapshot_headers():
+    """Staleness of the snapshots a report was served from."""
+    # Files whose snapshot was too old were read live and add no staleness
+    ages = [report_snapshots.age(engine) for _, engine in partition_targets() if report_snapshots.fresh(engine)]
+    if not ages:
+        return {}
+    oldest = max(ages)
+    return {
+        'X-Snapshot-Age-Seconds': f"{oldest:.1f}",
+        'X-Snapshot-Taken-At': datetime.utcfromtimestamp(time.time() - oldest).strftime('%Y-%m-%dT%H:%M:%SZ'),
+    }
+
+
+def use_report_snapshot(view):
+    """Serve a read-only report from the snapshot unless `fresh=1` is passed."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not app.config['REPORT_SNAPSHOT_ENABLED'] or request.args.get('fresh') == '1':
+            return view(*args, **kwargs)
+        with snapshot_reads():
+            response, status = view(*args, **kwargs)
+            headers = snapshot_headers()
+        response.headers.update(headers)
+        return response, status
+    return wrapper
+
+
+# ----- Backups -----
+class WriteLatencyTracker:
+    """Latency of requests that wrote to the database, split by whether a backup was running."""
+
+    def __init__(self, window=2000):
+        self._lock = threading.Lock()
+        self._samples = {True: [], False: []}
+        self.window = window
+
+    def record(self, seconds, during_backup):
+        with self._lock:
+            samples = self._samples[during_backup]
+            samples.append(seconds)
+            del samples[:-self.window]
+
+    def summary(self):
+        def percentiles(values):
+            if not values:
+                return {"count": 0, "p50_ms": None, "p95_ms": None}
+            values = sorted(values)
+            return {
+                "count": len(values),
+                "p50_ms": round(values[len(values) // 2] * 1000, 2),
+                "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 2),
+            }
+        with self._lock:
+            return {"during_backup": percentiles(self._samples[True]),
+                    "baseline": percentiles(self._samples[False])}
+
+
+write_latency = WriteLatencyTracker()
+
+
+def backup_running():
+    """Whether any worker is copying a database right now.
+
+    backup_database keeps a `.copying-*` marker in BACKUP_DIR for the length of
+    the copy, so workers that are not running the backup still see it.
+    """
+    cutoff = time.time() - 6 * 3600  # Older markers were left behind by a crashed worker
+    try:
+        with os.scandir(app.config['BACKUP_DIR']) as entries:
+            return any(entry.name.startswith('.copying-') and entry.stat().st_mtime > cutoff
+                       for entry in entries)
+    except OSError:
+        return False
+
+
+@event.listens_for(db.session, 'after_flush')
+def _mark_session_wrote(session, flush_context):
+    session.info['wrote_data'] = True
+
+
+@app.before_request
+def start_write_timer():
+    request.environ['request_started'] = time.monotonic()
+
+
+@app.after_request
+def record_write_latency(response):
+    started = request.environ.get('request_started')
+    if started is not None and db.session.info.get('wrote_data'):
+        write_latency.record(time.monotonic() - started, backup_running())
+    return response
+
+
+def backup_sources():
+    """(name, path) of every database file that makes up the shop's data."""
+    sources = [(os.path.basename(engine.url.database), engine.url.database)
+               for engine in report_snapshots.live_engines()]
+    archives = [app.config['ARCHIVE_DATABASE_PATH']]
+    archives += glob.glob(os.path.join(app.config['SHOP_PARTITION_DIR'], 'shop_*_archive.db'))
+    sources += [(os.path.basename(path), path) for path in archives if os.path.exists(path)]
+    return sources
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backup_database(name, path):
+    """Take an online, gzip-compressed, checksummed backup of one database file.
+
+    The SQLite backup API copies BACKUP_PAGES_PER_STEP pages at a time and
+    sleeps between steps, so writers are only ever delayed by one step.
+    Returns the backup manifest, which is also written next to the backup.
+    """
+    os.makedirs(app.config['BACKUP_DIR'], exist_ok=True)
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    target = os.path.join(app.config['BACKUP_DIR'], f"{name}-{stamp}.gz")
+    raw_path = f"{target}.{os.getpid()}.raw"
+    steps = []
+
+    def progress(status, remaining, total):
+        steps.append((remaining, total))
+
+    marker = os.path.join(app.config['BACKUP_DIR'], f".copying-{name}-{os.getpid()}-{threading.get_ident()}")
+    started = time.monotonic()
+    open(marker, 'w').close()
+    try:
+        source = sqlite3.connect(path)
+        destination = sqlite3.connect(raw_path)
+        try:
+            source.backup(destination, pages=app.config['BACKUP_PAGES_PER_STEP'], progress=progress,
+                          sleep=app.config['BACKUP_STEP_SLEEP'])
+        finally:
+            destination.close()
+            source.close()
+    finally:
+        os.remove(marker)
+    copy_seconds = time.monotonic() - started
+
+    with open(raw_path, 'rb') as raw, gzip.open(f"{target}.tmp", 'wb', compresslevel=6) as compressed:
+        shutil.copyfileobj(raw, compressed, 1024 * 1024)
+    raw_size = os.path.getsize(raw_path)
+    os.remove(raw_path)
+    os.replace(f"{target}.tmp", target)
+    checksum = _sha256_file(target)
+
+    manifest = {
+        "database": name,
+        "file": os.path.basename(target),
+        "created_at": stamp,
+        "sha256": checksum,
+        "size_bytes": os.path.getsize(target),
+        "uncompressed_bytes": raw_size,
+        "pages": steps[-1][1] if steps else None,
+        "steps": len(steps),
+        "copy_seconds": round(copy_seconds, 3),
+        "total_seconds": round(time.monotonic() - started, 3),
+        "write_latency": write_latency.summary(),
+    }
+    with open(f"{target}.sha256", 'w') as f:
+        f.write(f"{checksum}  {os.path.basename(target)}\n")
+    with open(f"{target}.json", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    rotate_backups(name)
+    logger.info("Backed up %s in %.2fs (%d steps)", name, manifest["total_seconds"], len(steps))
+    return manifest
+
+
+def list_backups(name=None):
+    pattern = f"{name}-*.gz" if name else "*.gz"
+    return sorted(glob.glob(os.path.join(app.config['BACKUP_DIR'], pattern)))
+
+
+def rotate_backups(name):
+    for old in list_backups(name)[:-app.config['BACKUP_RETENTION']]:
+        for path in (old, f"{old}.sha256", f"{old}.json"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def verify_backup(backup_path):
+    """Check the checksum and SQLite integrity of a backup. Returns a list of problems."""
+    problems = []
+    checksum_path = f"{backup_path}.sha256"
+    if not os.path.exists(checksum_path):
+        problems.append("checksum file is missing")
+    else:
+        expected = open(checksum_path).read().split()[0]
+        if _sha256_file(backup_path) != expected:
+            problems.append("checksum mismatch")
+    if problems:
+        return problems
+
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as raw:
+        raw_path = raw.name
+        with gzip.open(backup_path, 'rb') as compressed:
+            shutil.copyfileobj(compressed, raw, 1024 * 1024)
+    try:
+        conn = sqlite3.connect(raw_path)
+        try:
+            result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            conn.close()
+        if result != 'ok':
+            problems.append(f"integrity check failed: {result}")
+    finally:
+        os.remove(raw_path)
+    return problems
+
+
+def restore_backup(backup_path, target_path):
+    """Restore a verified backup into `target_path` with the backup API.
+
+    The target may be the live database: the copy takes the proper locks, so
+    running connections see either the old or the restored data.
+    """
+    problems = verify_backup(backup_path)
+    if problems:
+        raise ValueError("; ".join(problems))
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as raw:
+        raw_path = raw.name
+        with gzip.open(backup_path, 'rb') as compressed:
+            shutil.copyfileobj(compressed, raw, 1024 * 1024)
+    try:
+        source = sqlite3.connect(raw_path)
+        destination = sqlite3.connect(target_path)
+        try:
+            source.backup(destination)
+        finally:
+            destination.close()
+            source.close()
+    finally:
+        os.remove(raw_path)
+
+
+class BackupScheduler:
+    """Runs backups every BACKUP_INTERVAL_HOURS in a background thread.
+
+    A lock file keeps worker processes from backing up at the same time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.last_run = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name='backup-scheduler', daemon=True)
+            self._thread.start()
+
+    def _due(self, name):
+        backups = list_backups(name)
+        if not backups:
+            return True
+        age = time.time() - os.path.getmtime(backups[-1])
+        return age >= app.config['BACKUP_INTERVAL_HOURS'] * 3600
+
+    def run_due(self):
+        os.makedirs(app.config['BACKUP_DIR'], exist_ok=True)
+        lock_path = os.path.join(app.config['BACKUP_DIR'], '.lock')
+        try:
+            if time.time() - os.path.getmtime(lock_path) > 6 * 3600:
+                os.remove(lock_path)  # Left behind by a crashed worker
+        except OSError:
+            pass
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return []
+        try:
+            manifests = [backup_database(name, path) for name, path in backup_sources() if self._due(name)]
+            self.last_run = datetime.utcnow()
+            return manifests
+        finally:
+            os.close(fd)
+            os.remove(lock_path)
+
+    def _loop(self):
+        while True:
+            try:
+                with app.app_context():
+                    self.run_due()
+            except Exception:
+                logger.exception("Scheduled backup failed")
+            time.sleep(300)
+
+
+backup_scheduler = BackupScheduler()
+
+
+@app.before_request
+def start_backup_scheduler():
+    if app.config['BACKUP_ENABLED']:
+        backup_scheduler.ensure_started()
+
+
+@app.route('/backups', methods=['GET'])
+def view_backups():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    backups = []
+    for path in list_backups():
+        manifest_path = f"{path}.json"
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                backups.append(json.load(f))
+        else:
+            backups.append({"file": os.path.basename(path), "size_bytes": os.path.getsize(path)})
+    return jsonify({
+        "backups": backups,
+        "write_latency": write_latency.summary(),
+        "last_scheduled_run": backup_scheduler.last_run.isoformat() if backup_scheduler.last_run else None,
+    }), 200
+
+
+@app.cli.command('backup-db')
+def backup_db_command():
+    """Take an online backup of every database file now."""
+    if not sqlite_backend():
+        raise click.ClickException("Back up PostgreSQL with pg_dump")
+    for name, path in backup_sources():
+        manifest = backup_database(name, path)
+        click.echo(f"{manifest['file']}: {manifest['size_bytes']} bytes, {manifest['steps']} steps, "
+                   f"{manifest['total_seconds']}s")
+
+
+@app.cli.command('verify-backup')
+@click.argument('backup_path')
+def verify_backup_command(backup_path):
+    """Verify the checksum and integrity of a backup file."""
+    problems = verify_backup(backup_path)
+    if problems:
+        raise click.ClickException("; ".join(problems))
+    click.echo(f"{backup_path}: OK")
+
+
+@app.cli.command('restore-backup')
+@click.argument('backup_path')
+@click.option('--target', default=None, help="Database file to restore into (defaults to the main database).")
+@click.confirmation_option(prompt="This overwrites the target database. Continue?")
+def restore_backup_command(backup_path, target):
+    """Verify a backup and restore it with the backup API."""
+    target = target or db.engine.url.database
+    try:
+        restore_backup(backup_path, target)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Restored {backup_path} into {target}")
+
+
+# ----- Archive -----
+# Tables whose settled rows move to the archive database, in dependency order
+ARCHIVED_TABLES = ['invoice', 'due', 'invoice_history', 'repairing_device', 'repairing_invoice', 'repair_part_usage',
+                   'accessorie_invoice', 'accessory_cart_invoice', 'accessory_cart_line']
+
+
+def _table_columns(conn, schema, table):
+    return [(row[1], row[2]) for row in conn.exec_driver_sql(f'PRAGMA {schema}.table_info("{table}")')]
+
+
+def _sync_archive_schema(conn):
+    """Create archive tables and add any columns the hot tables gained since."""
+    for table in ARCHIVED_TABLES:
+        hot_columns = _table_columns(conn, 'main', table)
+        archived = dict(_table_columns(conn, 'archive', table))
+        if not archived:
+            columns = ", ".join(
+                f'"{name}" {type_ or ""}{" PRIMARY KEY" if name == "id" else ""}' for name, type_ in hot_columns
+            )
+            conn.exec_driver_sql(f'CREATE TABLE archive."{table}" ({columns})')
+            continue
+        for name, type_ in hot_columns:
+            if name not in archived:
+                conn.exec_driver_sql(f'ALTER TABLE archive."{table}" ADD COLUMN "{name}" {type_ or ""}')
+
+
+def archive_path(shop_id=None):
+    if app.config['SHOP_PARTITIONING'] and shop_id is not None:
+        return os.path.join(app.config['SHOP_PARTITION_DIR'], f'shop_{int(shop_id)}_archive.db')
+    return app.config['ARCHIVE_DATABASE_PATH']
+
+
+def _attach_archive(conn, shop_id=None):
+    conn.exec_driver_sql("ATTACH DATABASE ? AS archive", (archive_path(shop_id),))
+
+
+def _detach_archive(conn):
+    conn.exec_driver_sql("DETACH DATABASE archive")
+
+
+class ArchiveUnavailable(Exception):
+    pass
+
+
+@app.errorhandler(ArchiveUnavailable)
+def handle_archive_unavailable(e):
+    return jsonify({"message": str(e)}), 400
+
+
+@contextmanager
+def archive_attached():
+    """Make the archived rows visible to every query of the current session.
+
+    The archive is attached to the session's connection and each archived
+    table is shadowed by a TEMP view of the same name that unions the hot and
+    archived rows. Unqualified table names resolve to TEMP first, so the
+    existing queries return both without changes. The block must only read.
+    SQLite cannot detach a database while a transaction is open, so
+    ArchiveUnavailable is raised instead of attaching inside one.
+    """
+    shop_id = current_shop_id.get()
+    if not sqlite_backend() or not os.path.exists(archive_path(shop_id)):
+        yield
+        return
+    conn = db.session.connection(bind_arguments={'mapper': Invoice})
+    if batch_savepoint.get() is not None or conn.connection.in_transaction:
+        raise ArchiveUnavailable("Archived records cannot be read inside an open transaction such as a /batch")
+    _attach_archive(conn, shop_id)
+    try:
+        for table in ARCHIVED_TABLES:
+            hot = [name for name, _ in _table_columns(conn, 'main', table)]
+            archived = {name for name, _ in _table_columns(conn, 'archive', table)}
+            columns = ", ".join(f'"{name}"' for name in hot)
+            if archived:
+                # Columns added after the last archival read as NULL for archived rows
+                archived_columns = ", ".join(
+                    f'"{name}"' if name in archived else f'NULL AS "{name}"' for name in hot
+                )
+                select = (f'SELECT {columns} FROM main."{table}" '
+                          f'UNION ALL SELECT {archived_columns} FROM archive."{table}"')
+            else:
+                select = f'SELECT {columns} FROM main."{table}"'
+            conn.exec_driver_sql(f'CREATE TEMP VIEW "{table}" AS {select}')
+        yield
+    finally:
+        for table in ARCHIVED_TABLES:
+            conn.exec_driver_sql(f'DROP VIEW IF EXISTS temp."{table}"')
+        _detach_archive(conn)
+        db.session.rollback()
+
+
+def archive_aware(view):
+    """Let a read-only route include archived rows when `include_archived=1`."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.args.get('include_archived') != '1':
+            return view(*args, **kwargs)
+        with archive_attached():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+# Settled rows older than the cutoff. A row holding the current max(id) of its
+# table is never moved: SQLite would hand that id out again and collide with
+# the archived copy.
+ARCHIVE_SELECTIONS = {
+    'invoice': """
+        SELECT i.id FROM main.invoice i
+        WHERE i.date_created < :cutoff
+          AND i.paid_amount >= i.total_amount
+          AND i.id < (SELECT max(id) FROM main.invoice)
+          AND NOT EXISTS (SELECT 1 FROM main.due d WHERE d.invoice_id = i.id
+                          AND (d.payment_date >= :cutoff OR d.id >= (SELECT max(id) FROM main.due)))
+          AND NOT EXISTS (SELECT 1 FROM main.invoice_history h WHERE h.invoice_id = i.id
+                          AND h.id >= (SELECT max(id) FROM main.invoice_history))
+    """,
+    'repairing_device': """
+        SELECT r.id FROM main.repairing_device r
+        WHERE r.date_added < :cutoff
+          AND coalesce(r.due_price, 0) <= 0
+          AND r.id < (SELECT max(id) FROM main.repairing_device)
+          AND NOT EXISTS (SELECT 1 FROM main.repairing_invoice ri WHERE ri.repairing_device_id = r.id
+                          AND (ri.created_at >= :cutoff OR ri.id >= (SELECT max(id) FROM main.repairing_invoice)))
+          AND NOT EXISTS (SELECT 1 FROM main.repair_part_usage u WHERE u.repairing_device_id = r.id
+                          AND u.id >= (SELECT max(id) FROM main.repair_part_usage))
+    """,
+    'accessorie_invoice': """
+        SELECT a.id FROM main.accessorie_invoice a
+        WHERE a.date < :cutoff AND a.id < (SELECT max(id) FROM main.accessorie_invoice)
+    """,
+    'accessory_cart_invoice': """
+        SELECT c.id FROM main.accessory_cart_invoice c
+        WHERE c.date < :cutoff AND c.id < (SELECT max(id) FROM main.accessory_cart_invoice)
+          AND NOT EXISTS (SELECT 1 FROM main.accessory_cart_line l WHERE l.cart_invoice_id = c.id
+                          AND l.id >= (SELECT max(id) FROM main.accessory_cart_line))
+    """,
+}
+
+# Rows that travel with their parent: table -> (parent table, foreign key column)
+ARCHIVE_CHILDREN = {
+    'due': ('invoice', 'invoice_id'),
+    'invoice_history': ('invoice', 'invoice_id'),
+    'repairing_invoice': ('repairing_device', 'repairing_device_id'),
+    'repair_part_usage': ('repairing_device', 'repairing_device_id'),
+    'accessory_cart_line': ('accessory_cart_invoice', 'cart_invoice_id'),
+}
+
+
+def archive_settled_records(older_than_days=None):
+    """Move settled records older than the cutoff into the archive database.
+
+    Copy and delete happen in one transaction spanning both files, so a row is
+    never lost or visible twice. In partitioned mode every shop (or only the
+    selected one) is archived into its own file. Returns the number of rows
+    moved per table.
+    """
+    if not sqlite_backend():
+        # Archived rows are copied back into PostgreSQL by migrate-to-postgres
+        logger.info("Archiving only applies to SQLite databases")
+        return {}
+    older_than_days = app.config['ARCHIVE_AFTER_DAYS'] if older_than_days is None else older_than_days
+    cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).strftime('%Y-%m-%d %H:%M:%S.%f')
+    moved = {}
+    for shop_id, engine in partition_targets():
+        for table, count in _archive_partition(engine, shop_id, cutoff).items():
+            moved[table] = moved.get(table, 0) + count
+    logger.info("Archived settled records older than %s days: %s", older_than_days, moved)
+    return moved
+
+
+def _archive_partition(engine, shop_id, cutoff):
+    moved = {}
+    with engine.connect() as conn:
+        _attach_archive(conn, shop_id)
+        try:
+            _sync_archive_schema(conn)
+            conn.commit()
+            for table, selection in ARCHIVE_SELECTIONS.items():
+                conn.exec_driver_sql(f'CREATE TEMP TABLE "archive_ids_{table}" (id INTEGER PRIMARY KEY)')
+                conn.execute(db.text(f'INSERT INTO temp."archive_ids_{table}" {selection}'), {"cutoff": cutoff})
+
+            order = [t for t in ARCHIVED_TABLES if t in ARCHIVE_CHILDREN] + list(ARCHIVE_SELECTIONS)
+            for table in order:
+                columns = ", ".join(f'"{name}"' for name, _ in _table_columns(conn, 'main', table))
+                if table in ARCHIVE_CHILDREN:
+                    parent, fk = ARCHIVE_CHILDREN[table]
+                    where = f'"{fk}" IN (SELECT id FROM temp."archive_ids_{parent}")'
+                else:
+                    where = f'id IN (SELECT id FROM temp."archive_ids_{table}")'
+                conn.exec_driver_sql(
+                    f'INSERT INTO archive."{table}" ({columns}) SELECT {columns} FROM main."{table}" WHERE {where}'
+                )
+                moved[table] = conn.exec_driver_sql(f'DELETE FROM main."{table}" WHERE {where}').rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            for table in ARCHIVE_SELECTIONS:
+                conn.exec_driver_sql(f'DROP TABLE IF EXISTS temp."archive_ids_{table}"')
+            conn.commit()
+            _detach_archive(conn)
+    return moved
+
+
+@background_task('archive_settled_records')
+def archive_settled_records_task(older_than_days=None):
+    archive_settled_records(older_than_days)
+
+
+@app.route('/archive/run', methods=['GET'])
+def run_archive():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    older_than_days = request.args.get('older_than_days')
+    try:
+        older_than_days = int(older_than_days) if older_than_days else None
+    except ValueError:
+        return jsonify({"message": "older_than_days must be an integer"}), 400
+
+    enqueue_job('archive_settled_records', max_attempts=1, older_than_days=older_than_days)
+    db.session.commit()
+    return jsonify({"message": "Archival queued"}), 202
+
+
+@app.cli.command('archive-records')
+@click.option('--older-than-days', type=int, default=None, help="Defaults to ARCHIVE_AFTER_DAYS.")
+def archive_records_command(older_than_days):
+    """Move settled invoices and repair records into the archive database."""
+    moved = archive_settled_records(older_than_days)
+    for table, count in moved.items():
+        click.echo(f"{table}: {count} rows archived")
+
+# ----- Invoice Normalization -----
+# Profile table -> owner column; a profile row is one version of its owner's details
+PROFILE_OWNERS = {'shop_profile': 'shop_id', 'accessory_profile': 'accessory_id'}
+
+
+def snapshot_profile(conn, profile, owner_id, **fields):
+    """Id of the `profile` version holding `fields`, adding a version if none does.
+
+    Sales reference the returned row, so the details are written once per
+    change instead of once per sale.
+    """
+    table = profile.__table__
+    owner = table.c[PROFILE_OWNERS[table.name]]
+    same_owner = owner.is_not_distinct_from(owner_id)
+    match = [same_owner] + [table.c[name].is_not_distinct_from(value) for name, value in fields.items()]
+    while True:
+        found = conn.execute(
+            db.select(table.c.id).where(*match).order_by(table.c.version.desc()).limit(1)
+        ).scalar()
+        if found is not None:
+            return found
+        version = conn.execute(
+            db.select(db.func.coalesce(db.func.max(table.c.version), 0) + 1).where(same_owner)
+        ).scalar()
+        # No savepoint: pysqlite would commit one released outside a transaction on its own
+        created = conn.execute(
+            UPSERT_INSERTS[conn.dialect.name](table)
+            .values({owner.name: owner_id, 'version': version, 'created_at': datetime.utcnow(), **fields})
+            .on_conflict_do_nothing(index_elements=[owner, table.c.version])
+            .returning(table.c.id)
+        ).scalar()
+        if created is not None:
+            return created
+        # A concurrent sale wrote this version first; look again
+
+
+def shop_profile_id(shop):
+    conn = db.session.connection(bind_arguments={'mapper': ShopProfile})
+    return snapshot_profile(conn, ShopProfile, shop.id,
+                            name=shop.name, address=shop.address, phone=shop.phone, email=shop.email)
+
+
+def accessory_profile_id(accessory):
+    conn = db.session.connection(bind_arguments={'mapper': AccessoryProfile})
+    return snapshot_profile(conn, AccessoryProfile, accessory.id, accessory_name=accessory.accessory_name,
+                            company=accessory.company, category=accessory.category)
+
+
+# Profile table -> (model, accessorie_invoice column, {profile column: legacy accessorie_invoice column},
+# query finding the owner of legacy details)
+LEGACY_PROFILES = {
+    'shop_profile': (
+        ShopProfile, 'shop_profile_id',
+        {'name': 'shop_name', 'address': 'shop_address', 'phone': 'shop_phone', 'email': 'shop_email'},
+        'SELECT id FROM shop WHERE name = :name ORDER BY address = :address DESC, id LIMIT 1',
+    ),
+    'accessory_profile': (
+        AccessoryProfile, 'accessory_profile_id',
+        {'accessory_name': 'accessory_name', 'company': 'company', 'category': 'category'},
+        'SELECT id FROM accessory WHERE accessory_name = :accessory_name AND company = :company '
+        'AND category = :category ORDER BY id LIMIT 1',
+    ),
+}
+
+# Views returning the pre-normalization row shapes, for reporting tools reading the file
+COMPAT_VIEWS = {
+    'v_accessorie_invoice': """
+        SELECT a.id, a.invoice_id, a.user_name, a.user_phone,
+               ap.accessory_name, ap.company, ap.category,
+               a.unit_price, a.quantity, a.total_price,
+               sp.name AS shop_name, sp.address AS shop_address, sp.phone AS shop_phone, sp.email AS shop_email,
+               a.date
+        FROM accessorie_invoice a
+        LEFT JOIN shop_profile sp ON sp.id = a.shop_profile_id
+        LEFT JOIN accessory_profile ap ON ap.id = a.accessory_profile_id
+    """,
+    'v_due': """
+        SELECT d.id, d.invoice_id, d.phone_model, i.customer_name, d.paid_amount, d.payment_date
+        FROM due d
+        JOIN invoice i ON i.id = d.invoice_id
+    """,
+    'v_invoice_history': """
+        SELECT h.id, h.invoice_id, i.customer_name, i.customer_phone, i.customer_location,
+               i.paid_amount AS total_paid, i.total_amount - i.paid_amount AS total_due, i.total_amount,
+               h.last_updated
+        FROM invoice_history h
+        JOIN invoice i ON i.id = h.invoice_id
+    """,
+}
+
+
+def create_compat_views(conn):
+    """Create the views that keep the columns of the pre-normalization tables."""
+    replace = '' if conn.dialect.name == 'sqlite' else 'OR REPLACE '
+    for view, select in COMPAT_VIEWS.items():
+        conn.exec_driver_sql(f'CREATE {replace}VIEW "{view}" AS {select}')
+
+
+def _backfill_profiles(conn, schema):
+    """Create the profile versions for the details copied into legacy sale rows."""
+    for model, _, columns, owner_query in LEGACY_PROFILES.values():
+        legacy = ", ".join(f'"{name}"' for name in columns.values())
+        rows = conn.exec_driver_sql(
+            f'SELECT {legacy} FROM {schema}.accessorie_invoice GROUP BY {legacy} ORDER BY min(date)'
+        ).all()
+        for row in rows:
+            fields = dict(zip(columns, row))
+            owner_id = conn.execute(db.text(owner_query), fields).scalar()
+            snapshot_profile(conn, model, owner_id, **fields)
+
+
+def _legacy_profile_reference(profile_table, row_alias):
+    columns = LEGACY_PROFILES[profile_table][2]
+    match = " AND ".join(f'p."{name}" IS {row_alias}."{legacy}"' for name, legacy in columns.items())
+    return f'(SELECT p.id FROM main."{profile_table}" p WHERE {match} ORDER BY p.version DESC LIMIT 1)'
+
+
+def _rebuild_table(conn, table, expressions):
+    """Recreate `table` from its model, copying rows over; `expressions` fill new columns.
+
+    SQLite cannot drop NOT NULL columns in place, so the old table is renamed,
+    copied and dropped inside the caller's transaction.
+    """
+    legacy = {name for name, _ in _table_columns(conn, 'main', table)}
+    conn.exec_driver_sql(f'ALTER TABLE "{table}" RENAME TO "{table}_legacy"')
+    # Named indexes keep their names across the rename and would collide
+    for (index,) in conn.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (f'{table}_legacy',),
+    ).all():
+        conn.exec_driver_sql(f'DROP INDEX "{index}"')
+    db.metadata.tables[table].create(conn)
+    targets, sources = [], []
+    for column in db.metadata.tables[table].columns:
+        if column.name in expressions:
+            sources.append(expressions[column.name])
+        elif column.name in legacy:
+            sources.append(f'l."{column.name}"')
+        elif column.name == 'updated_at':
+            sources.append(f"'{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')}'")
+        else:
+            continue
+        targets.append(f'"{column.name}"')
+    conn.exec_driver_sql(
+        f'INSERT INTO "{table}" ({", ".join(targets)}) SELECT {", ".join(sources)} FROM "{table}_legacy" l'
+    )
+    conn.exec_driver_sql(f'DROP TABLE "{table}_legacy"')
+
+
+def normalize_invoice_tables(conn):
+    """Move sale rows written before the profile tables existed to the normalized layout."""
+    if 'shop_name' in dict(_table_columns(conn, 'main', 'accessorie_invoice')):
+        _backfill_profiles(conn, 'main')
+        _rebuild_table(conn, 'accessorie_invoice', {
+            column: _legacy_profile_reference(profile_table, 'l')
+            for profile_table, (_, column, _, _) in LEGACY_PROFILES.items()
+        })
+    if 'customer_name' in dict(_table_columns(conn, 'main', 'due')):
+        _rebuild_table(conn, 'due', {})
+    if 'customer_name' in dict(_table_columns(conn, 'main', 'invoice_history')):
+        _rebuild_table(conn, 'invoice_history', {})
+
+
+def snapshot_due_phone_models(conn, schema='main'):
+    """Fill in the phone model of payments recorded while Due did not store it.
+
+    The model as it is now is the closest record left of the one sold.
+    """
+    conn.exec_driver_sql(f"""
+        UPDATE {schema}.due AS d SET phone_model = (
+            SELECT p.model_name FROM {schema}.invoice i JOIN main.phone p ON p.id = i.phone_id
+            WHERE i.id = d.invoice_id
+        )
+        WHERE d.phone_model IS NULL
+    """)
+
+
+def normalize_archive(engine, path):
+    """Point legacy archived sales at profile versions of the hot database.
+
+    Archived rows keep their old columns; only the profile references are
+    filled in, which is all the archive views need.
+    """
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS archive", (path,))
+        try:
+            if 'shop_name' not in dict(_table_columns(conn, 'archive', 'accessorie_invoice')):
+                return
+            _sync_archive_schema(conn)
+            _backfill_profiles(conn, 'archive')
+            for profile_table, (_, column, _, _) in LEGACY_PROFILES.items():
+                conn.exec_driver_sql(
+                    f'UPDATE archive.accessorie_invoice AS l '
+                    f'SET "{column}" = {_legacy_profile_reference(profile_table, "l")} WHERE "{column}" IS NULL'
+                )
+            conn.commit()
+        finally:
+            conn.rollback()
+            _detach_archive(conn)
+
+
+def _payload_bytes(conn, relation):
+    """Row count and summed value lengths of a table or view, a proxy for bytes stored."""
+    columns = [name for name, _ in _table_columns(conn, 'main', relation)]
+    size = " + ".join(f'coalesce(length(CAST("{name}" AS BLOB)), 0)' for name in columns)
+    return conn.exec_driver_sql(f'SELECT count(*), coalesce(sum({size}), 0) FROM "{relation}"').one()
+
+
+@app.cli.command('sale-storage-report')
+def sale_storage_report_command():
+    """Compare the bytes stored per sale row in the legacy and the normalized layout."""
+    for shop_id, engine in partition_targets():
+        with engine.connect() as conn:
+            if shop_id is not None:
+                click.echo(f"shop {shop_id}:")
+            for view in COMPAT_VIEWS:
+                rows, legacy = _payload_bytes(conn, view)
+                _, normalized = _payload_bytes(conn, view[len('v_'):])
+                if rows:
+                    click.echo(f"{view[len('v_'):]}: {rows} rows, "
+                               f"{legacy / rows:.0f} -> {normalized / rows:.0f} bytes per row")
+            for profile_table in LEGACY_PROFILES:
+                rows, size = _payload_bytes(conn, profile_table)
+                click.echo(f"{profile_table}: {rows} versions, {size} bytes in total")
+
+
+# ----- Catalog Upserts -----
+# insert() constructs supporting ON CONFLICT, by dialect
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def repair_part_key(part):
+    return tuple(part.get(name) or '' for name in REPAIR_PART_KEY_COLUMNS)
+
+
+def merge_duplicate_repair_parts(conn):
+    """Fold repair parts sharing a catalog key into the oldest one, so the unique index can be built.
+
+    Stock counters are added up and usage rows follow the kept part. The
+    other rows are deleted with sync tombstones.
+    """
+    if conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'uq_repairing_accessory_catalog'"
+    ).first():
+        return
+    table = RepairingAccessory.__table__
+    groups = conn.execute(
+        db.select(db.func.min(table.c.id), db.func.group_concat(table.c.id))
+        .group_by(*REPAIR_PART_KEY).having(db.func.count() > 1)
+    ).all()
+    for keep, ids in groups:
+        duplicates = [int(part_id) for part_id in ids.split(',') if int(part_id) != keep]
+        totals = conn.execute(
+            db.select(*[db.func.sum(db.func.coalesce(table.c[name], 0)) for name in
+                        ('current_stock', 'add_stock', 'total_out_stock')])
+            .where(table.c.id.in_([keep] + duplicates))
+        ).one()
+        conn.execute(table.update().where(table.c.id == keep).values(
+            current_stock=totals[0], add_stock=totals[1], total_out_stock=totals[2], updated_at=datetime.utcnow()
+        ))
+        usage = RepairPartUsage.__table__
+        conn.execute(usage.update().where(usage.c.repairing_accessory_id.in_(duplicates))
+                     .values(repairing_accessory_id=keep, updated_at=datetime.utcnow()))
+        forecast = ReorderForecast.__table__
+        conn.execute(forecast.delete().where(forecast.c.item_type == 'repairing_accessory',
+                                             forecast.c.item_id.in_(duplicates)))
+        conn.execute(table.delete().where(table.c.id.in_(duplicates)))
+        conn.execute(SyncTombstone.__table__.insert(), [
+            {'entity': 'repairing_accessory', 'entity_id': part_id, 'deleted_at': datetime.utcnow()}
+            for part_id in duplicates
+        ])
+
+
+def upsert_repair_parts(parts, merge=False):
+    """Add catalog parts without a read-before-write; returns (row, created) per part, in order.
+
+    New parts are inserted by one INSERT ... ON CONFLICT DO NOTHING per
+    chunk, which returns the rows it created. With `merge` the remaining
+    parts are applied by one INSERT ... ON CONFLICT DO UPDATE: prices and
+    minimum stock are replaced where given and stock is added. Without it
+    existing parts are left alone and read back. Parts repeating a key are
+    combined first.
+    """
+    table = RepairingAccessory.__table__
+    combined = {}
+    for part in parts:
+        key = repair_part_key(part)
+        if key in combined:
+            previous = combined[key]
+            part = {**previous, **{name: value for name, value in part.items() if value is not None},
+                    'current_stock': previous.get('current_stock', 0) + part.get('current_stock', 0)}
+        combined[key] = part
+    bind = {'mapper': RepairingAccessory}
+    insert = UPSERT_INSERTS[db.session.connection(bind_arguments=bind).dialect.name]
+    returned = [table.c.id, *[table.c[name] for name in REPAIR_PART_KEY_COLUMNS],
+                table.c.current_stock, table.c.minimum_stock]
+
+    def values(part, fill):
+        stock = part.get('current_stock', 0)
+        return {
+            **{name: part.get(name) for name in REPAIR_PART_KEY_COLUMNS},
+            'repairing_cost': part['repairing_cost'] if part.get('repairing_cost') is not None else fill,
+            'selling_cost': part['selling_cost'] if part.get('selling_cost') is not None else fill,
+            'minimum_stock': part['minimum_stock'] if part.get('minimum_stock') is not None else fill,
+            'current_stock': stock,
+            'add_stock': stock,
+            'alert': False,
+        }
+
+    outcome = {}
+    pending = list(combined.values())
+    chunk_size = app.config['UPSERT_CHUNK_SIZE']
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        created = insert(table).values([values(part, 0) for part in chunk])
+        for row in db.session.execute(
+            created.on_conflict_do_nothing(index_elements=REPAIR_PART_KEY).returning(*returned), bind_arguments=bind
+        ):
+            outcome[repair_part_key(row._mapping)] = (row, True)
+        existing = [part for part in chunk if repair_part_key(part) not in outcome]
+        if not existing:
+            continue
+        if merge:
+            merged = insert(table).values([values(part, None) for part in existing])
+            excluded = merged.excluded
+            statement = merged.on_conflict_do_update(index_elements=REPAIR_PART_KEY, set_={
+                'repairing_cost': db.func.coalesce(excluded.repairing_cost, table.c.repairing_cost),
+                'selling_cost': db.func.coalesce(excluded.selling_cost, table.c.selling_cost),
+                'minimum_stock': db.func.coalesce(excluded.minimum_stock, table.c.minimum_stock),
+                'current_stock': db.func.coalesce(table.c.current_stock, 0) + excluded.current_stock,
+                'add_stock': db.func.coalesce(table.c.add_stock, 0) + excluded.add_stock,
+                'updated_at': datetime.utcnow(),
+            }).returning(*returned)
+        else:
+            statement = db.select(*returned).where(
+                db.tuple_(*REPAIR_PART_KEY).in_([repair_part_key(part) for part in existing])
+            )
+        for row in db.session.execute(statement, bind_arguments=bind):
+            outcome[repair_part_key(row._mapping)] = (row, False)
+
+    for row, created in outcome.values():
+        if created or merge:
+            queue_change_event(
+                'stock_changed', item='repairing_accessory', id=row.id, name=row.name,
+                stock=row.current_stock, minimum_stock=row.minimum_stock,
+            )
+    # Parts repeating a key share its row, which only the first of them created
+    results, seen = [], set()
+    for part in parts:
+        key = repair_part_key(part)
+        row, created = outcome[key]
+        results.append((row, created and key not in seen))
+        seen.add(key)
+    return results
+
+
+# ----- Customers -----
+# Table -> (phone, name, location, date) columns of the customer details it records
+CUSTOMER_SOURCES = {
+    'invoice': ('customer_phone', 'customer_name', 'customer_location', 'date_created'),
+    'repairing_device': ('phone_number', 'customer_name', None, 'date_added'),
+    'accessorie_invoice': ('user_phone', 'user_name', None, 'date'),
+    'accessory_cart_invoice': ('user_phone', 'user_name', None, 'date'),
+}
+
+
+def normalize_phone(value):
+    """The national digits of a phone number, or None if it has no digits."""
+    digits = re.sub(r'\D', '', value or '')
+    code, national = app.config['CUSTOMER_COUNTRY_CODE'], app.config['CUSTOMER_NATIONAL_DIGITS']
+    if len(digits) == len(code) + national and digits.startswith(code):
+        digits = digits[len(code):]
+    elif len(digits) == national + 1 and digits.startswith('0'):
+        digits = digits[1:]
+    return digits or None
+
+
+def store_customer(conn, phone, name=None, location=None, first_seen=None, last_seen=None):
+    """Id of the customer with the normalized `phone`, adding it if it is new.
+
+    Details seen later than the stored ones replace them, so the customer
+    keeps the most recent name and location given with the number.
+    """
+    table = Customer.__table__
+    last_seen = last_seen or datetime.utcnow()
+    first_seen = first_seen or last_seen
+    details = {key: value for key, value in (('name', name), ('location', location)) if value}
+    while True:
+        found = conn.execute(
+            db.select(table.c.id, table.c.first_seen, table.c.last_seen).where(table.c.phone == phone)
+        ).first()
+        if found is not None:
+            values = {}
+            if last_seen >= found.last_seen:
+                values.update(details, last_seen=last_seen)
+            if first_seen < found.first_seen:
+                values['first_seen'] = first_seen
+            if values:
+                conn.execute(table.update().where(table.c.id == found.id).values(values))
+            return found.id
+        # No savepoint: pysqlite would commit one released outside a transaction on its own
+        created = conn.execute(
+            UPSERT_INSERTS[conn.dialect.name](table)
+            .values(phone=phone, first_seen=first_seen, last_seen=last_seen, **details)
+            .on_conflict_do_nothing(index_elements=[table.c.phone])
+            .returning(table.c.id)
+        ).scalar()
+        if created is not None:
+            return created
+        # A concurrent request added this customer first; look again
+
+
+def resolve_customer(phone, name=None, location=None):
+    """Customer id for a sale or repair being recorded now; None without a usable number."""
+    phone = normalize_phone(phone)
+    if phone is None:
+        return None
+    conn = db.session.connection(bind_arguments={'mapper': Customer})
+    return store_customer(conn, phone, name, location)
+
+
+def link_customers(conn, schema='main'):
+    """Point rows recorded before the customer table existed at their customer.
+
+    Rows are grouped by the phone string they were written with, so each
+    spelling costs one lookup and one UPDATE. Numbers without digits stay
+    unlinked.
+    """
+    for table_name, (phone, name, location, date) in CUSTOMER_SOURCES.items():
+        columns = [db.column(phone), db.column(name), db.column('customer_id'), db.column(date, db.DateTime)]
+        if location:
+            columns.append(db.column(location))
+        table = db.table(table_name, *columns, schema=schema)
+        unlinked = conn.execute(
+            db.select(
+                table.c[phone], table.c[name], table.c[location] if location else db.literal(None),
+                db.func.min(table.c[date]), db.func.max(table.c[date]),
+            )
+            .where(table.c.customer_id.is_(None), table.c[phone].is_not(None))
+            .group_by(table.c[phone])
+        ).all()
+        links = []
+        for raw_phone, customer_name, customer_location, first_seen, last_seen in unlinked:
+            normalized = normalize_phone(raw_phone)
+            if normalized is not None:
+                customer_id = store_customer(conn, normalized, customer_name, customer_location,
+                                             first_seen, last_seen)
+                links.append({'raw_phone': raw_phone, 'linked_id': customer_id})
+        if links:
+            conn.execute(
+                table.update()
+                .where(table.c[phone] == db.bindparam('raw_phone'), table.c.customer_id.is_(None))
+                .values(customer_id=db.bindparam('linked_id')),
+                links,
+            )
+
+
+def link_archived_customers(engine, path):
+    """Link the archived rows of `path` to customers of the hot database and fill in payment phone models."""
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS archive", (path,))
+        try:
+            _sync_archive_schema(conn)
+            link_customers(conn, 'archive')
+            snapshot_due_phone_models(conn, 'archive')
+            conn.commit()
+        finally:
+            conn.rollback()
+            _detach_archive(conn)
+
+
+def customer_history_statement(customer_id):
+    """Every sale, cart line and repair of one customer as one UNION ALL, newest first.
+
+    Each branch is read through the `customer_id` index of its table.
+    """
+    phone_sales = (
+        db.select(
+            db.literal("phone_sale").label("channel"), Invoice.date_created.label("date"),
+            db.cast(Invoice.id, db.String).label("invoice_id"), Shop.name.label("shop"),
+            (Phone.company + " " + Phone.model_name).label("item"), db.literal(1).label("quantity"),
+            Invoice.total_amount.label("amount"), Invoice.paid_amount.label("paid"),
+            (Invoice.total_amount - Invoice.paid_amount).label("due"), db.literal(None).label("status"),
+        )
+        .join(Phone, Phone.id == Invoice.phone_id)
+        .join(Shop, Shop.id == Invoice.shop_id)
+        .where(Invoice.customer_id == customer_id)
+    )
+    repairs = (
+        db.select(
+            db.literal("repair"), RepairingDevice.date_added,
+            db.select(db.func.max(RepairingInvoice.invoice_id))
+            .where(RepairingInvoice.repairing_device_id == RepairingDevice.id).scalar_subquery(),
+            db.literal(None), RepairingDevice.company + " " + RepairingDevice.model, db.literal(1),
+            RepairingDevice.repairing_cost, RepairingDevice.advance_payment, RepairingDevice.due_price,
+            RepairingDevice.repairing_status,
+        )
+        .where(RepairingDevice.customer_id == customer_id)
+    )
+    accessories = (
+        db.select(
+            db.literal("accessory_sale"), AccessorieInvoice.date, AccessorieInvoice.invoice_id, ShopProfile.name,
+            AccessoryProfile.accessory_name, AccessorieInvoice.quantity, AccessorieInvoice.total_price,
+            AccessorieInvoice.total_price, db.literal(0.0), db.literal(None),
+        )
+        .join(ShopProfile, ShopProfile.id == AccessorieInvoice.shop_profile_id)
+        .join(AccessoryProfile, AccessoryProfile.id == AccessorieInvoice.accessory_profile_id)
+        .where(AccessorieInvoice.customer_id == customer_id)
+    )
+    accessory_carts = (
+        db.select(
+            db.literal("accessory_sale"), AccessoryCartInvoice.date, AccessoryCartInvoice.invoice_id,
+            ShopProfile.name, AccessoryProfile.accessory_name, AccessoryCartLine.quantity,
+            AccessoryCartLine.total_price, AccessoryCartLine.total_price, db.literal(0.0), db.literal(None),
+        )
+        .join(AccessoryCartLine, AccessoryCartLine.cart_invoice_id == AccessoryCartInvoice.id)
+        .join(ShopProfile, ShopProfile.id == AccessoryCartInvoice.shop_profile_id)
+        .join(AccessoryProfile, AccessoryProfile.id == AccessoryCartLine.accessory_profile_id)
+        .where(AccessoryCartInvoice.customer_id == customer_id)
+    )
+    history = db.union_all(phone_sales, repairs, accessories, accessory_carts).subquery()
+    return db.select(history).order_by(history.c.date.desc())
+
+
+def _history_entry(row):
+    entry = dict(row._mapping)
+    entry['date'] = entry['date'].isoformat() if entry['date'] else None
+    return entry
+
+
+@app.route('/customer/<phone>/history', methods=['GET'])
+def customer_history(phone):
+    """Phone sales, repairs and accessory sales of one customer, newest first.
+
+    `phone` may be written in any form the shop used (spaces, +91, leading
+    0). Without a selected shop every shop partition is searched. Pass
+    `include_archived=1` to include archived records.
+    """
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+    normalized = normalize_phone(phone)
+    if normalized is None:
+        return jsonify({"message": "Invalid phone number"}), 400
+
+    customer, history = None, []
+    include_archived = request.args.get('include_archived') == '1'
+    for shop_id, _ in partition_targets():
+        with shop_context(shop_id), (archive_attached() if include_archived else nullcontext()):
+            found = Customer.query.filter_by(phone=normalized).first()
+            if found is not None:
+                customer = customer or found.to_dict()
+                history.extend(
+                    _history_entry(row) for row in db.session.execute(customer_history_statement(found.id))
+                )
+            # Ids repeat across shops, so identities must not leak between them
+            db.session.close()
+    if customer is None:
+        return jsonify({"message": "Customer not found"}), 404
+
+    history.sort(key=lambda entry: entry['date'] or '', reverse=True)
+    return jsonify({
+        "customer": customer,
+        "summary": {
+            "purchases": sum(1 for entry in history if entry['channel'] != 'repair'),
+            "repairs": sum(1 for entry in history if entry['channel'] == 'repair'),
+            "total_spent": round(sum(entry['amount'] or 0 for entry in history), 2),
+            "total_due": round(sum(entry['due'] or 0 for entry in history), 2),
+        },
+        "history": history,
+    }), 200
+
+
+def upgrade_schema(engine, exclude=(), archive=None):
+    """Bring an existing database up to the current models.
+
+    `create_all` only creates missing tables, so legacy invoice tables are
+    normalized, new nullable/defaulted columns and their indexes are added,
+    rows are linked to their customers and the compatibility views are
+    recreated. `archive` is the archive file that
+    belongs to the database, if any.
+    """
+    with engine.begin() as conn:
+        # Views follow renamed tables, so they are dropped before any rebuild
+        for view in COMPAT_VIEWS:
+            conn.exec_driver_sql(f'DROP VIEW IF EXISTS "{view}"')
+        normalize_invoice_tables(conn)
+        for table in db.metadata.sorted_tables:
+            if table.name in exclude:
+                continue
+            existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA main.table_info("{table.name}")')}
+            if not existing:
+                continue
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.exec_driver_sql(ddl)
+                if column.name == 'updated_at':
+                    # Existing rows count as changed now, so /sync pages never meet a NULL stamp
+                    conn.execute(table.update().values(updated_at=datetime.utcnow()))
+            if table.name == 'repairing_accessory':
+                # Duplicate parts would stop the catalog's unique index from being built
+                merge_duplicate_repair_parts(conn)
+            for index in table.indexes:
+                # SQLite does not reflect expression indexes, so checkfirst cannot be trusted here
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        link_customers(conn)
+        snapshot_due_phone_models(conn)
+        create_compat_views(conn)
+    if archive and os.path.exists(archive):
+        normalize_archive(engine, archive)
+        link_archived_customers(engine, archive)
+
+
+# ----- Database Backends -----
+def _bench_list_parts(conn, rng, part_ids, shop_id):
+    conn.execute(REPAIRING_ACCESSORY_LIST.statement).all()
+
+
+def _bench_usage_report(conn, rng, part_ids, shop_id):
+    usage = RepairPartUsage.__table__
+    conn.execute(
+        db.select(usage.c.repairing_accessory_id, db.func.sum(usage.c.quantity))
+        .where(usage.c.used_at >= datetime.utcnow() - timedelta(days=30))
+        .group_by(usage.c.repairing_accessory_id)
+    ).all()
+
+
+def _bench_sell_part(conn, rng, part_ids, shop_id):
+    table = RepairingAccessory.__table__
+    part_id = rng.choice(part_ids)
+    taken = conn.execute(
+        table.update().where(table.c.id == part_id, table.c.current_stock >= 1)
+        .values(current_stock=table.c.current_stock - 1, total_out_stock=table.c.total_out_stock + 1,
+                updated_at=datetime.utcnow())
+    ).rowcount
+    if taken:
+        conn.execute(RepairPartUsage.__table__.insert().values(repairing_accessory_id=part_id, quantity=1))
+
+
+def _bench_restock_part(conn, rng, part_ids, shop_id):
+    table = RepairingAccessory.__table__
+    statement = UPSERT_INSERTS[conn.dialect.name](table).values(
+        name=f"Part {rng.randrange(len(part_ids))}", type='benchmark', company='', model='', current_stock=5,
+        add_stock=5, minimum_stock=2,
+    )
+    conn.execute(statement.on_conflict_do_update(index_elements=REPAIR_PART_KEY, set_={
+        'current_stock': table.c.current_stock + statement.excluded.current_stock,
+        'add_stock': table.c.add_stock + statement.excluded.add_stock,
+        'updated_at': datetime.utcnow(),
+    }))
+
+
+def _bench_invoice_number(conn, rng, part_ids, shop_id):
+    InvoiceNumberAllocator._reserve(conn, shop_id, 'repair', 1)
+
+
+# The counter's day: mostly list reads, one write in three
+BENCHMARK_WORKLOAD = {
+    'list_parts': (_bench_list_parts, 45),
+    'usage_report': (_bench_usage_report, 15),
+    'sell_part': (_bench_sell_part, 25),
+    'restock_part': (_bench_restock_part, 5),
+    'invoice_number': (_bench_invoice_number, 10),
+}
+
+
+def run_backend_benchmark(url, workers, operations, parts, seed=0):
+    """Run BENCHMARK_WORKLOAD against an empty scratch database; returns throughput and latencies.
+
+    The same seed gives every backend the same sequence of operations. Each
+    operation is one transaction on a pooled connection and failures (such
+    as SQLite's "database is locked") are counted, not retried.
+    """
+    engine = create_engine(url, **database_engine_options(url))
+    try:
+        if db.inspect(engine).get_table_names():
+            raise ValueError(f"{engine.url.render_as_string()} is not empty; benchmark a scratch database")
+        db.metadata.create_all(engine)
+        try:
+            with engine.begin() as conn:
+                shop = Shop.__table__
+                shop_id = conn.execute(
+                    shop.insert().values(name='Benchmark', address='-', phone='-').returning(shop.c.id)
+                ).scalar_one()
+                conn.execute(RepairingAccessory.__table__.insert(), [
+                    {'name': f"Part {i}", 'type': 'benchmark', 'company': '', 'model': '', 'repairing_cost': 10.0,
+                     'selling_cost': 15.0, 'current_stock': operations, 'add_stock': operations,
+                     'total_out_stock': 0, 'minimum_stock': 2, 'alert': False}
+                    for i in range(parts)
+                ])
+                part_ids = conn.execute(db.select(RepairingAccessory.__table__.c.id)).scalars().all()
+
+            rng = random.Random(seed)
+            names = list(BENCHMARK_WORKLOAD)
+            plan = rng.choices(names, weights=[BENCHMARK_WORKLOAD[name][1] for name in names], k=operations)
+            latencies = {name: [] for name in names}
+            errors = {}
+            lock = threading.Lock()
+
+            def run(share):
+                worker_rng = random.Random(seed + share)
+                for name in plan[share::workers]:
+                    started = time.perf_counter()
+                    try:
+                        with engine.begin() as conn:
+                            BENCHMARK_WORKLOAD[name][0](conn, worker_rng, part_ids, shop_id)
+                    except exc.DBAPIError as e:
+                        key = f"{name}: {type(e.orig).__name__}"
+                        with lock:
+                            errors[key] = errors.get(key, 0) + 1
+                        continue
+                    with lock:
+                        latencies[name].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(run, range(workers)))
+            elapsed = time.perf_counter() - started
+        finally:
+            db.metadata.drop_all(engine)
+    finally:
+        engine.dispose()
+
+    def percentiles(values):
+        values = sorted(values)
+        if not values:
+            return {"count": 0, "p50_ms": None, "p95_ms": None}
+        return {
+            "count": len(values),
+            "p50_ms": round(values[len(values) // 2] * 1000, 2),
+            "p95_ms": round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 2),
+        }
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        "backend": engine.dialect.name,
+        "seconds": round(elapsed, 3),
+        "operations_per_second": round(completed / elapsed, 1) if elapsed else None,
+        "operations": {name: percentiles(values) for name, values in latencies.items()},
+        "errors": errors,
+    }
+
+
+@app.cli.command('backend-benchmark')
+@click.option('--url', 'urls', multiple=True,
+              help="Empty scratch database to benchmark; repeat for each backend. "
+                   "Defaults to a temporary SQLite file.")
+@click.option('--workers', type=int, default=8, help="Concurrent counters.")
+@click.option('--operations', type=int, default=5000, help="Operations per backend.")
+@click.option('--parts', type=int, default=500, help="Repair parts in the catalog.")
+@click.option('--seed', type=int, default=0)
+def backend_benchmark_command(urls, workers, operations, parts, seed):
+    """Run the same read/write mix against each backend and compare throughput."""
+    with tempfile.TemporaryDirectory() as scratch:
+        for url in urls or [f"sqlite:///{os.path.join(scratch, 'benchmark.db')}"]:
+            if make_url(url) == db.engine.url:
+                raise click.ClickException("Benchmark a scratch database, not the shop's own")
+            try:
+                result = run_backend_benchmark(url, workers, operations, parts, seed)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+            click.echo(f"{result['backend']}: {result['operations_per_second']} ops/s "
+                       f"over {result['seconds']}s with {workers} workers")
+            for name, stats in result['operations'].items():
+                click.echo(f"  {name:>14}: {stats['count']:6d} ok, p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms")
+            for error, count in sorted(result['errors'].items()):
+                click.echo(f"  failed {error}: {count}")
+
+
+def _migration_sources(conn, table, include_archive):
+    """SELECTs yielding the rows of `table` to copy: the live rows, then any archived ones."""
+    yield False, db.select(table).order_by(*table.primary_key.columns)
+    if include_archive and table.name in ARCHIVED_TABLES:
+        archived = {name for name, _ in _table_columns(conn, 'archive', table.name)}
+        if archived:
+            # Columns the archive copy never got read as NULL
+            source = db.table(table.name, *[db.column(c.name, c.type) for c in table.columns if c.name in archived],
+                              schema='archive')
+            yield True, db.select(*[
+                source.c[c.name].label(c.name) if c.name in archived else db.null().label(c.name)
+                for c in table.columns
+            ])
+
+
+def _copy_to_postgres(source, conn, chunk_size, include_archive):
+    db.metadata.create_all(conn)
+    create_compat_views(conn)
+    preparer = conn.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        copied = skipped = 0
+        for archived, statement in _migration_sources(source, table, include_archive):
+            insert = postgresql.insert(table)
+            if archived:
+                # SQLite may have handed an archived id out again; the live row wins
+                insert = insert.on_conflict_do_nothing()
+            before = conn.execute(db.select(db.func.count()).select_from(table)).scalar()
+            read = 0
+            try:
+                result = source.execute(statement, execution_options={'yield_per': chunk_size})
+                for rows in result.partitions():
+                    conn.execute(insert, [row._asdict() for row in rows])
+                    read += len(rows)
+            except (exc.DBAPIError, ValueError) as e:
+                # SQLite accepts what PostgreSQL refuses: overlong strings, dangling keys, bad dates
+                raise click.ClickException(f"{table.name}: {getattr(e, 'orig', e)}")
+            added = conn.execute(db.select(db.func.count()).select_from(table)).scalar() - before
+            copied += added
+            skipped += read - added
+        column = table.autoincrement_column
+        if column is not None:
+            # Rows kept their ids, so the sequence must continue after them
+            conn.execute(db.text(
+                f"SELECT setval(pg_get_serial_sequence(:table, :column), "
+                f"coalesce(max({preparer.quote(column.name)}), 0) + 1, false) FROM {preparer.format_table(table)}"
+            ), {'table': preparer.format_table(table), 'column': column.name})
+        click.echo(f"{table.name}: {copied} rows" + (f", {skipped} archived duplicates skipped" if skipped else ""))
+
+
+@app.cli.command('migrate-to-postgres')
+@click.argument('target_url')
+@click.option('--chunk-size', type=int, default=2000, help="Rows read and inserted per round trip.")
+@click.option('--include-archive/--no-archive', default=True,
+              help="Copy archived rows back into the live tables (PostgreSQL has no archive file).")
+def migrate_to_postgres_command(target_url, chunk_size, include_archive):
+    """Copy the SQLite database into an empty PostgreSQL database in one transaction.
+
+    The schema is created from the models, rows keep their ids and every
+    id sequence is moved past the copied rows. Point DATABASE_URL at the
+    target once the counts match.
+    """
+    if not sqlite_backend():
+        raise click.ClickException("The configured database is not SQLite; nothing to migrate")
+    if app.config['SHOP_PARTITIONING']:
+        raise click.ClickException("Shop partitions reuse ids; migrate a single-file database")
+    if make_url(target_url).get_backend_name() != 'postgresql':
+        raise click.ClickException("The target must be a postgresql:// URL")
+
+    target = create_engine(target_url, **database_engine_options(target_url))
+    archive = archive_path(None)
+    include_archive = include_archive and os.path.exists(archive)
+    try:
+        existing = set(db.inspect(target).get_table_names())
+        with target.connect() as conn:
+            for table in db.metadata.sorted_tables:
+                if table.name in existing and conn.execute(db.select(1).select_from(table).limit(1)).first():
+                    raise click.ClickException(f"{table.name} already has rows; the target must be empty")
+
+        with db.engine.connect() as source, target.begin() as conn:
+            if include_archive:
+                _attach_archive(source)
+            try:
+                _copy_to_postgres(source, conn, chunk_size, include_archive)
+            finally:
+                if include_archive:
+                    source.rollback()
+                    _detach_archive(source)
+    finally:
+        target.dispose()
+    click.echo(f"Done. Set DATABASE_URL={make_url(target_url).render_as_string()} to serve from PostgreSQL.")
+
+
+# Manually create tables
+with app.app_context():
+    db.create_all()
+    if sqlite_backend():
+        upgrade_schema(db.engine, archive=app.config['ARCHIVE_DATABASE_PATH'])
+        # Snapshots copied before the upgrade lack its columns
+        report_snapshots.discard()
+    else:
+        # Other backends start from the current models, so only the views are missing
+        with db.engine.begin() as conn:
+            create_compat_views(conn)
+
+
+# User Management APIs
+@app.route('/register', methods=['GET'])
+def register():
+    username = request.args.get('username')
+    password = request.args.get('password')
+
+    if not username or not password:
+        return jsonify({"message": "Username and password are required"}), 400
+
+    if User.query.filter_by(username=username).first():
+        return jsonify({"message": "User already exists"}), 400
+
+    shop_id = request.args.get('shop_id')  # Optional default shop of the user
+    if shop_id and not Shop.query.filter_by(id=shop_id).first():
+        return jsonify({"message": "Shop not found"}), 404
+
+    hashed_password = generate_password_hash(password)
+    auth_key = str(uuid.uuid4())
+    new_user = User(username=username, password=hashed_password, auth_key=auth_key,
+                    shop_id=int(shop_id) if shop_id else None)
+    db.session.add(new_user)
+    db.session.commit()
+
+    return jsonify({"message": "User registered successfully", "auth_key": auth_key}), 201
+
+@app.route('/login', methods=['GET'])
+def login():
+    username = request.args.get('username')
+    password = request.args.get('password')
+
+    if not username or not password:
+        return jsonify({"message": "Username and password are required"}), 400
+
+    user = User.query.filter_by(username=username).first()
+    if not user or not check_password_hash(user.password, password):
+        return jsonify({"message": "Invalid username or password"}), 401
+
+    return jsonify({"message": f"User '{username}' logged in successfully", "auth_key": user.auth_key}), 200
+    
+    
+
+# Route to manage accessories
+@app.route('/accessory', methods=['GET'])
+def manage_accessory():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    action = request.args.get('action')
+    try:
+        # Set Indian timezone
+        india_tz = timezone('Asia/Kolkata')
+        current_time_ist = datetime.now(india_tz)
+
+        if action == "add":
+            new_accessory = Accessory(
+                accessory_name=request.args.get('accessory_name'),
+                type=request.args.get('type'),
+                company=request.args.get('company'),
+                category=request.args.get('category'),
+                initial_stock=int(request.args.get('initial_stock', 0)),
+                added_stock=int(request.args.get('added_stock', 0)),
+                unit_price=float(request.args.get('unit_price', 0.0)),
+                minimum_stock=int(request.args.get('minimum_stock', 0)),
+                add_date=current_time_ist
+            )
+            db.session.add(new_accessory)
+            db.session.commit()
+            return jsonify({"message": "Accessory added successfully", "add_date": current_time_ist.isoformat()}), 201
+
+        elif action == "update":
+            accessory_id = request.args.get('id')
+            accessory = Accessory.query.get(accessory_id)
+            if not accessory:
+                return jsonify({"message": "Accessory not found"}), 404
+
+            update_fields = {
+                "added_stock": int(request.args.get('added_stock', 0)),
+                "last_purchase_quantity": int(request.args.get('last_purchase_quantity', 0)),
+                "unit_price": float(request.args.get('unit_price', accessory.unit_price)),
+                "minimum_stock": int(request.args.get('minimum_stock', accessory.minimum_stock)),
+                "times_sold": int(request.args.get('times_sold', accessory.times_sold)),
+            }
+
+            # Handle stock adjustments
+            if update_fields["last_purchase_quantity"] > 0:
+                accessory.added_stock -= update_fields["last_purchase_quantity"]
+                accessory.stock_out += update_fields["last_purchase_quantity"]
+                accessory.last_purchase_quantity = update_fields["last_purchase_quantity"]
+                accessory.last_purchase_date = current_time_ist
+
+            if update_fields["added_stock"] > 0:
+                accessory.added_stock += update_fields["added_stock"]
+
+            # Update fields dynamically
+            for field, value in update_fields.items():
+                if field not in ["added_stock", "last_purchase_quantity"] and request.args.get(field) is not None:
+                    setattr(accessory, field, value)
+
+            alert = accessory.added_stock < accessory.minimum_stock
+            db.session.commit()
+
+            return jsonify({
+                "message": f"Accessory '{accessory.accessory_name}' updated successfully",
+                "current_stock": accessory.added_stock,
+                "stock_out": accessory.stock_out,
+                "last_purchase_quantity": accessory.last_purchase_quantity,
+                "last_purchase_date": current_time_ist.isoformat(),
+                "alert": alert
+            }), 200
+
+        elif action == "delete":
+            accessory_id = request.args.get('id')
+            accessory = Accessory.query.get(accessory_id)
+            if not accessory:
+                return jsonify({"message": "Accessory not found"}), 404
+
+            db.session.delete(accessory)
+            db.session.commit()
+            return jsonify({"message": f"Accessory with ID {accessory_id} deleted successfully"}), 200
+
+        elif action == "view":
+            accessory_id = request.args.get('id')
+            if accessory_id:
+                accessory = Accessory.query.get(accessory_id)
+                if not accessory:
+                    return jsonify({"message": "Accessory not found"}), 404
+
+                current_stock = accessory.added_stock
+                alert = current_stock < accessory.minimum_stock
+
+                return jsonify({
+                    "id": accessory.id,
+                    "accessory_name": accessory.accessory_name,
+                    "type": accessory.type,
+                    "company": accessory.company,
+                    "category": accessory.category,
+                    "initial_stock": accessory.initial_stock,
+                    "current_stock": current_stock,
+                    "unit_price": accessory.unit_price,
+                    "minimum_stock": accessory.minimum_stock,
+                    "last_purchase_quantity": accessory.last_purchase_quantity,
+                    "times_sold": accessory.times_sold,
+                    "stock_out": accessory.stock_out,
+                    "add_date": accessory.add_date.isoformat(),
+                    "last_purchase_date": accessory.last_purchase_date.isoformat() if accessory.last_purchase_date else None,
+                    "alert": alert
+                }), 200
+            else:
+                return jsonify({"accessories": accessory_list()}), 200
+
+        else:
+            return jsonify({"message": "Invalid action specified"}), 400
+
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Error occurred: {str(e)}"}), 500
+
+@app.route('/repairing_accessory', methods=['GET'])
+def manage_repairing_accessory():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    action = request.args.get('action')
+    try:
+        india_tz = timezone('Asia/Kolkata')
+        current_time_ist = datetime.now(india_tz)
+
+        if action == "add":
+            # Adding a new repairing accessory
+            # on_conflict=merge adds the stock to an existing part and takes its new prices
+            merge = request.args.get('on_conflict') == 'merge'
+            merge_args = ('repairing_cost', 'selling_cost', 'minimum_stock')
+            part = {
+                "name": request.args.get('name'),
+                "type": request.args.get('type'),
+                "company": request.args.get('company'),
+                "model": request.args.get('model'),
+                "repairing_cost": float(request.args.get('repairing_cost', 0.0)),
+                "selling_cost": float(request.args.get('selling_cost', 0.0)),
+                "current_stock": int(request.args.get('current_stock', 0)),
+                "minimum_stock": int(request.args.get('minimum_stock', 0)),
+            }
+            if merge:
+                # Only the values given replace those of an existing part
+                part.update({name: None for name in merge_args if request.args.get(name) is None})
+
+            [(row, created)] = upsert_repair_parts([part], merge=merge)
+            if not created and not merge:
+                db.session.rollback()
+                return jsonify({"message": "Repairing accessory already exists.", "id": row.id}), 400
+            enqueue_job('refresh_low_stock_alerts')
+            db.session.commit()
+            return jsonify({
+                "message": "Repairing accessory added successfully" if created else "Repairing accessory merged",
+                "id": row.id,
+                "created": created,
+                "current_stock": row.current_stock,
+                "add_date": current_time_ist.isoformat()
+            }), 201 if created else 200
+
+        elif action == "update":
+            # Updating an existing repairing accessory
+            accessory_id = request.args.get('id')
+            accessory = RepairingAccessory.query.get(accessory_id)
+            if not accessory:
+                return jsonify({"message": "Repairing accessory not found"}), 404
+
+            add_stock = int(request.args.get('add_stock', 0))
+            last_purchase_quantity = int(request.args.get('last_purchase_quantity', 0))
+            last_repairing_quantity = int(request.args.get('last_repairing_quantity', 0))
+
+            if add_stock > 0:
+                accessory.current_stock += add_stock
+                accessory.add_stock += add_stock
+
+            if last_purchase_quantity > 0:
+                accessory.last_purchase_quantity = last_purchase_quantity
+                accessory.current_stock -= last_purchase_quantity
+                accessory.total_out_stock += last_purchase_quantity
+                accessory.last_purchase_date = current_time_ist
+
+            if last_repairing_quantity > 0:
+                accessory.last_repairing_quantity = last_repairing_quantity
+                accessory.current_stock -= last_repairing_quantity
+                accessory.total_out_stock += last_repairing_quantity
+                accessory.last_repairing_date = current_time_ist
+                db.session.add(RepairPartUsage(
+                    repairing_accessory_id=accessory.id,
+                    quantity=last_repairing_quantity,
+                    unit_cost=accessory.repairing_cost,
+                ))
+
+            accessory.repairing_cost = float(request.args.get('repairing_cost', accessory.repairing_cost))
+            accessory.selling_cost = float(request.args.get('selling_cost', accessory.selling_cost))
+
+            accessory.alert = accessory.current_stock < accessory.minimum_stock
+
+            db.session.commit()
+
+            return jsonify({
+                "message": f"Repairing accessory '{accessory.name}' updated successfully",
+                **accessory.to_dict()
+            }), 200
+
+        elif action == "delete":
+            # Deleting an existing repairing accessory
+            accessory_id = request.args.get('id')
+            accessory = RepairingAccessory.query.get(accessory_id)
+            if not accessory:
+                return jsonify({"message": "Repairing accessory not found"}), 404
+
+            db.session.delete(accessory)
+            db.session.commit()
+            return jsonify({"message": f"Repairing accessory with ID {accessory_id} deleted successfully"}), 200
+
+        elif action == "view":
+            # Viewing one or all repairing accessories
+            accessory_id = request.args.get('id')
+            if accessory_id:
+                accessory = RepairingAccessory.query.get(accessory_id)
+                if not accessory:
+                    return jsonify({"message": "Repairing accessory not found"}), 404
+
+                return jsonify(accessory.to_dict()), 200
+            else:
+                return jsonify({"repairing_accessories": repairing_accessory_list()}), 200
+
+        else:
+            return jsonify({"message": "Invalid action specified"}), 400
+
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Error occurred: {str(e)}"}), 500
+        
+        
+        
+@app.route('/repairing_accessory/bulk', methods=['POST'])
+def bulk_upsert_repair_parts():
+    """Load repair parts from a supplier price list.
+
+    Body: {"on_conflict": "merge", "parts": [{"name": "Display", "type": "OLED",
+    "company": "Samsung", "model": "S24", "repairing_cost": 900, "selling_cost": 1500,
+    "current_stock": 4, "minimum_stock": 2}, ...]}. Known parts get the listed
+    prices and stock added with "merge", and are left alone with "ignore"
+    (the default). Every part is reported with its id and whether it was created.
+    """
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    data = request.get_json(silent=True) or {}
+    parts = data.get("parts")
+    on_conflict = data.get("on_conflict", "ignore")
+    if not isinstance(parts, list) or not parts:
+        return jsonify({"error": "A non-empty parts list is required"}), 400
+    if on_conflict not in ("ignore", "merge"):
+        return jsonify({"error": "on_conflict must be 'ignore' or 'merge'"}), 400
+    if len(parts) > app.config['UPSERT_MAX_PARTS']:
+        return jsonify({"error": f"At most {app.config['UPSERT_MAX_PARTS']} parts per request"}), 400
+
+    cleaned = []
+    for part in parts:
+        try:
+            if not isinstance(part, dict) or not part.get("name"):
+                raise ValueError
+            cleaned.append({
+                **{name: str(part[name]) if part.get(name) is not None else None for name in REPAIR_PART_KEY_COLUMNS},
+                "repairing_cost": float(part["repairing_cost"]) if part.get("repairing_cost") is not None else None,
+                "selling_cost": float(part["selling_cost"]) if part.get("selling_cost") is not None else None,
+                "minimum_stock": int(part["minimum_stock"]) if part.get("minimum_stock") is not None else None,
+                "current_stock": int(part.get("current_stock") or 0),
+            })
+        except (TypeError, ValueError):
+            return jsonify({"error": "Every part needs a name and numeric prices and stock"}), 400
+        if cleaned[-1]["current_stock"] < 0:
+            return jsonify({"error": "Stock cannot be negative"}), 400
+
+    try:
+        results = upsert_repair_parts(cleaned, merge=on_conflict == "merge")
+        enqueue_job('refresh_low_stock_alerts')
+        db.session.commit()
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Error occurred: {str(e)}"}), 500
+
+    created = sum(1 for _, was_created in results if was_created)
+    return jsonify({
+        "created": created,
+        ("merged" if on_conflict == "merge" else "ignored"): len(results) - created,
+        "parts": [
+            {"id": row.id, "name": row.name, "created": was_created, "current_stock": row.current_stock}
+            for row, was_created in results
+        ],
+    }), 200
+
+
+@app.route('/phone/add', methods=['GET'])
+def add_phone():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    imei = request.args.get('imei')
+    model_name = request.args.get('model_name')
+    company = request.args.get('company')
+    is_new = request.args.get('is_new')
+    price = request.args.get('price')
+    is_available = request.args.get('is_available')  # This will replace stock
+
+    if not imei or not model_name or not company or is_new is None or not price or is_available is None:
+        return jsonify({"message": "All fields are required (IMEI, model_name, company, is_new, price, is_available)"}), 400
+
+    try:
+        is_new = bool(int(is_new))
+        price = float(price)
+        is_available = bool(int(is_available))  # 1 for available, 0 for sold out
+    except ValueError:
+        return jsonify({"message": "Invalid input values"}), 400
+
+    # Set status based on availability
+    status = "Available" if is_available else "Sold Out"
+
+    # The IMEI's unique index decides in the same statement whether the phone is new
+    table = Phone.__table__
+    bind = {'mapper': Phone}
+    insert = UPSERT_INSERTS[db.session.connection(bind_arguments=bind).dialect.name]
+    phone_id = db.session.execute(
+        insert(table).values(imei=imei, model_name=model_name, company=company, is_new=is_new, price=price,
+                             status=status)
+        .on_conflict_do_nothing(index_elements=[table.c.imei]).returning(table.c.id),
+        bind_arguments=bind,
+    ).scalar()
+    if phone_id is None:
+        db.session.rollback()
+        return jsonify({"message": "Phone with this IMEI already exists"}), 400
+    queue_change_event(
+        'phone_sold' if status == "Sold Out" else 'phone_available',
+        id=phone_id, imei=imei, model_name=model_name, company=company, price=price,
+    )
+    db.session.commit()
+
+    phone_type = "New" if is_new else "Old"
+    return jsonify({"message": f"{phone_type} phone '{model_name}' by {company} added successfully"}), 201
+
+
+
+@app.route('/phone/view', methods=['GET'])
+def view_phones():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    return jsonify({"phones": phone_list()}), 200
+
+    
+
+
+# ----- Selling Product Management -----
+@app.route('/selling/edit', methods=['GET'])
+def edit_selling_product():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    product_id = request.args.get('id')
+    name = request.args.get('name')
+    type = request.args.get('type')
+    price = request.args.get('price')
+    quantity = request.args.get('quantity')
+
+    product = SellingProduct.query.filter_by(id=product_id).first()
+    if not product:
+        return jsonify({"message": "Product not found"}), 404
+
+    if name: product.name = name
+    if type: product.type = type
+    if price:
+        try:
+            product.price = float(price)
+        except ValueError:
+            return jsonify({"message": "Price must be a float"}), 400
+    if quantity:
+        try:
+            product.quantity = int(quantity)
+        except ValueError:
+            return jsonify({"message": "Quantity must be an integer"}), 400
+
+    db.session.commit()
+    return jsonify({"message": f"Selling product '{product.name}' updated successfully"}), 200
+
+@app.route('/selling/delete', methods=['GET'])
+def delete_selling_product():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    product_id = request.args.get('id')
+    product = SellingProduct.query.filter_by(id=product_id).first()
+    if not product:
+        return jsonify({"message": "Product not found"}), 404
+
+    db.session.delete(product)
+    db.session.commit()
+    return jsonify({"message": f"Selling product '{product.name}' deleted successfully"}), 200
+
+# ----- Phone Management -----
+@app.route('/phone/edit', methods=['GET'])
+def edit_phone():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    phone_id = request.args.get('id')
+    imei = request.args.get('imei')
+    model_name = request.args.get('model_name')
+    company = request.args.get('company')
+    is_new = request.args.get('is_new')
+    price = request.args.get('price')
+    is_available = request.args.get('is_available')  # New availability field
+
+    phone = Phone.query.filter_by(id=phone_id).first()
+    if not phone:
+        return jsonify({"message": "Phone not found"}), 404
+
+    if imei: phone.imei = imei
+    if model_name: phone.model_name = model_name
+    if company: phone.company = company
+    if is_new is not None:
+        try:
+            phone.is_new = bool(int(is_new))
+        except ValueError:
+            return jsonify({"message": "is_new must be 0 (old) or 1 (new)"}), 400
+    if price: 
+        try:
+            phone.price = float(price)
+        except ValueError:
+            return jsonify({"message": "Price must be a float"}), 400
+    if is_available is not None:
+        try:
+            is_available = bool(int(is_available))  # 1 for available, 0 for sold out
+            phone.update_status(is_available)
+        except ValueError:
+            return jsonify({"message": "is_available must be 0 (sold out) or 1 (available)"}), 400
+
+    db.session.commit()
+    return jsonify({"message": f"Phone '{phone.model_name}' updated successfully"}), 200
+
+
+@app.route('/phone/delete', methods=['GET'])
+def delete_phone():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    phone_id = request.args.get('id')
+    phone = Phone.query.filter_by(id=phone_id).first()
+    if not phone:
+        return jsonify({"message": "Phone not found"}), 404
+
+    db.session.delete(phone)
+    db.session.commit()
+    return jsonify({"message": f"Phone '{phone.model_name}' deleted successfully"}), 200
+    
+
+
+@app.route('/repairingdevice/add', methods=['GET'])
+def add_repairing_device():
+    # Extract parameters from the request, handling empty or missing strings
+    def handle_missing_string(value, default="None"):
+        return value.strip() if value and value.strip() else default
+
+    auth_key = request.args.get('auth_key')
+    customer_name = handle_missing_string(request.args.get('customer_name'), "N/A")
+    phone_number = handle_missing_string(request.args.get('phone_number'), "N/A")
+    received_by = handle_missing_string(request.args.get('received_by'), "N/A")
     company = handle_missing_string(request.args.get('company'), "N/A")
     model = handle_missing_string(request.args.get('model'), "N/A")
     device_condition = handle_missing_string(request.args.get('device_condition'), "N/A")
@@ -809,656 +4607,2502 @@ def add_repairing_device():
     delivery_status = handle_missing_string(request.args.get('delivery_status'), "Pending")
     technician_name = handle_missing_string(request.args.get('technician_name'), "N/A")
 
-    # Handle numeric fields
-    def handle_missing_numeric(value, default=0.0):
+    # Handle numeric fields
+    def handle_missing_numeric(value, default=0.0):
+        try:
+            return float(value) if value and value.strip() else default
+        except ValueError:
+            return default
+
+    repairing_cost = handle_missing_numeric(request.args.get('repairing_cost'))
+    due_price = handle_missing_numeric(request.args.get('due_price'))
+    advance_payment = handle_missing_numeric(request.args.get('advance_payment'))
+
+    # Handle date fields
+    estimated_delivery_date = request.args.get('estimated_delivery_date')
+    if estimated_delivery_date:
+        try:
+            estimated_delivery_date = datetime.strptime(estimated_delivery_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({"message": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
+
+    # Validate if the user is authorized
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    # Creating the new repairing device object
+    repairing_device = RepairingDevice(
+        customer_name=customer_name,
+        phone_number=phone_number,
+        customer_id=resolve_customer(phone_number, customer_name),
+        received_by=received_by,
+        company=company,
+        model=model,
+        device_condition=device_condition,
+        repairing_status=repairing_status,
+        repairing_cost=repairing_cost,
+        estimated_delivery_date=estimated_delivery_date,
+        parts_replaced=parts_replaced,
+        bill_status=bill_status,
+        due_price=due_price,
+        advance_payment=advance_payment,
+        payment_method=payment_method,
+        delivery_status=delivery_status,
+        technician_name=technician_name,
+    )
+
+    try:
+        db.session.add(repairing_device)
+        db.session.commit()
+        return jsonify({"message": "Repairing device added successfully"}), 200
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Failed to add repairing device. Error: {str(e)}"}), 500
+        
+        
+@app.route('/repairingdevice/view', methods=['GET'])
+@single_flight
+@cross_shop_report('repairing_devices')
+@archive_aware
+def view_repairing_devices():
+    # Extract auth key from the request
+    auth_key = request.args.get('auth_key')
+
+    # Verify if the user is authorized
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    return jsonify({"repairing_devices": REPAIRING_DEVICE_LIST.dicts()}), 200
+    
+@app.route('/repairingdevice/delete', methods=['GET'])
+def delete_repairing_device():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    device_id = request.args.get('id')
+    repairing_device = RepairingDevice.query.filter_by(id=device_id).first()
+    if not repairing_device:
+        return jsonify({"message": "Repairing device not found"}), 404
+
+    db.session.delete(repairing_device)
+    db.session.commit()
+    return jsonify({"message": f"Repairing device with ID {device_id} deleted successfully"}), 200
+    
+    
+@app.route('/repairingdevice/edit', methods=['GET'])
+def edit_repairing_device():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    device_id = request.args.get('id')
+    repairing_device = RepairingDevice.query.filter_by(id=device_id).first()
+    if not repairing_device:
+        return jsonify({"message": "Repairing device not found"}), 404
+
+    # Optional fields for editing
+    customer_name = request.args.get('customer_name')
+    phone_number = request.args.get('phone_number')
+    received_by = request.args.get('received_by')
+    company = request.args.get('company')
+    model = request.args.get('model')
+    device_condition = request.args.get('device_condition')
+    repairing_status = request.args.get('repairing_status')
+    repairing_cost = request.args.get('repairing_cost')
+    estimated_delivery_date = request.args.get('estimated_delivery_date')
+    parts_replaced = request.args.get('parts_replaced')
+    bill_status = request.args.get('bill_status')
+    due_price = request.args.get('due_price')
+    advance_payment = request.args.get('advance_payment')
+    payment_method = request.args.get('payment_method')
+    delivery_status = request.args.get('delivery_status')
+    technician_name = request.args.get('technician_name')
+
+    # Update fields if provided
+    if customer_name: repairing_device.customer_name = customer_name
+    if phone_number: repairing_device.phone_number = phone_number
+    if received_by: repairing_device.received_by = received_by
+    if company: repairing_device.company = company
+    if model: repairing_device.model = model
+    if device_condition: repairing_device.device_condition = device_condition
+    if repairing_status: repairing_device.repairing_status = repairing_status
+    if repairing_cost: repairing_device.repairing_cost = repairing_cost
+    if estimated_delivery_date:
+        try:
+            repairing_device.estimated_delivery_date = datetime.strptime(estimated_delivery_date, '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({"message": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
+    if parts_replaced: repairing_device.parts_replaced = parts_replaced
+    if bill_status: repairing_device.bill_status = bill_status
+    if due_price: repairing_device.due_price = due_price
+    if advance_payment: repairing_device.advance_payment = advance_payment
+    if payment_method: repairing_device.payment_method = payment_method
+    if delivery_status: repairing_device.delivery_status = delivery_status
+    if technician_name: repairing_device.technician_name = technician_name
+    if customer_name or phone_number:
+        repairing_device.customer_id = resolve_customer(repairing_device.phone_number, repairing_device.customer_name)
+
+    db.session.commit()
+    return jsonify({"message": f"Repairing device with ID {device_id} updated successfully"}), 200
+
+
+# ----- Repair Parts Usage -----
+def _usage_range():
+    # Defaults to the current month
+    start = request.args.get('start') or datetime.utcnow().strftime('%Y-%m-01')
+    return parse_ledger_range(start, request.args.get('end'))
+
+
+@app.route('/repairingdevice/parts', methods=['POST'])
+def attach_repair_parts():
+    """Take parts from stock for a repair job.
+
+    Body: {"device_id": 3, "parts": [{"part_id": 7, "quantity": 1}, ...]}.
+    Every part is decremented by one conditional UPDATE in the same
+    transaction as the usage rows, so a job never takes stock that is not
+    there. The device's parts_replaced text is rewritten from its usage rows.
+    """
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    data = request.get_json(silent=True) or {}
+    parts = data.get("parts")
+    if not data.get("device_id") or not isinstance(parts, list) or not parts:
+        return jsonify({"error": "device_id and a non-empty parts list are required"}), 400
+
+    # Repeated parts are merged into one usage row
+    quantities = {}
+    for part in parts:
+        try:
+            part_id = int(part["part_id"])
+            quantity = int(part["quantity"])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "Every part needs an integer part_id and quantity"}), 400
+        if quantity <= 0:
+            return jsonify({"error": "Quantity must be greater than 0"}), 400
+        quantities[part_id] = quantities.get(part_id, 0) + quantity
+
+    try:
+        device_id = int(data["device_id"])
+    except (TypeError, ValueError):
+        return jsonify({"error": "device_id must be an integer"}), 400
+    device = db.session.get(RepairingDevice, device_id)
+    if not device:
+        return jsonify({"error": "Repairing device not found"}), 404
+
+    table = RepairingAccessory.__table__
+    found = {
+        row.id: row for row in db.session.execute(
+            db.select(table.c.id, table.c.name, table.c.current_stock, table.c.repairing_cost)
+            .where(table.c.id.in_(quantities))
+        )
+    }
+    missing = [part_id for part_id in quantities if part_id not in found]
+    if missing:
+        return jsonify({"error": "Repairing accessory not found", "part_ids": missing}), 404
+    short = [
+        {"part_id": part_id, "requested": quantity, "available": found[part_id].current_stock or 0}
+        for part_id, quantity in quantities.items()
+        if (found[part_id].current_stock or 0) < quantity
+    ]
+    if short:
+        return jsonify({"error": "Insufficient stock available", "parts": short}), 400
+
+    try:
+        # Every part in one statement; a part whose stock moved since the read does not match
+        used = db.case(quantities, value=table.c.id)
+        taken = db.session.execute(
+            table.update()
+            .where(table.c.id.in_(quantities), table.c.current_stock >= used)
+            .values(
+                current_stock=table.c.current_stock - used,
+                total_out_stock=db.func.coalesce(table.c.total_out_stock, 0) + used,
+                last_repairing_quantity=used,
+                last_repairing_date=datetime.now(timezone('Asia/Kolkata')),
+                alert=table.c.current_stock - used < db.func.coalesce(table.c.minimum_stock, 0),
+            )
+        ).rowcount
+        if taken != len(quantities):
+            db.session.rollback()
+            return jsonify({"error": "Stock changed while the parts were taken, please retry"}), 409
+        for row in db.session.execute(
+            db.select(table.c.id, table.c.name, table.c.current_stock, table.c.minimum_stock)
+            .where(table.c.id.in_(quantities))
+        ):
+            queue_change_event(
+                'stock_changed', item='repairing_accessory', id=row.id, name=row.name,
+                stock=row.current_stock, minimum_stock=row.minimum_stock,
+            )
+
+        used_at = datetime.utcnow()
+        for part_id, quantity in quantities.items():
+            db.session.add(RepairPartUsage(
+                repairing_device_id=device.id,
+                repairing_accessory_id=part_id,
+                quantity=quantity,
+                unit_cost=found[part_id].repairing_cost,
+                used_at=used_at,
+            ))
+        used_parts = db.session.execute(
+            db.select(RepairingAccessory.name, db.func.sum(RepairPartUsage.quantity))
+            .join(RepairingAccessory, RepairingAccessory.id == RepairPartUsage.repairing_accessory_id)
+            .where(RepairPartUsage.repairing_device_id == device.id)
+            .group_by(RepairingAccessory.id, RepairingAccessory.name)
+            .order_by(RepairingAccessory.name)
+        ).all()
+        device.parts_replaced = ", ".join(f"{name} x{quantity}" for name, quantity in used_parts)[:255]
+        db.session.commit()
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({
+        "message": f"{len(quantities)} parts taken from stock",
+        "device_id": device.id,
+        "parts_replaced": device.parts_replaced,
+    }), 200
+
+
+@app.route('/repairingdevice/parts', methods=['GET'])
+@archive_aware
+def view_repair_parts():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    device_id = request.args.get('device_id')
+    if not device_id:
+        return jsonify({"error": "device_id is required"}), 400
+    try:
+        device_id = int(device_id)
+    except ValueError:
+        return jsonify({"error": "device_id must be an integer"}), 400
+
+    rows = db.session.execute(
+        db.select(RepairPartUsage.id, RepairPartUsage.repairing_accessory_id, RepairingAccessory.name,
+                  RepairPartUsage.quantity, RepairPartUsage.unit_cost, RepairPartUsage.used_at)
+        .join(RepairingAccessory, RepairingAccessory.id == RepairPartUsage.repairing_accessory_id)
+        .where(RepairPartUsage.repairing_device_id == device_id)
+        .order_by(RepairPartUsage.id)
+    ).all()
+    return jsonify({
+        "device_id": device_id,
+        "parts": [
+            {"usage_id": usage_id, "part_id": part_id, "name": name, "quantity": quantity,
+             "unit_cost": unit_cost, "used_at": used_at.isoformat()}
+            for usage_id, part_id, name, quantity, unit_cost, used_at in rows
+        ],
+    }), 200
+
+
+@app.route('/repair_parts/usage', methods=['GET'])
+@single_flight
+@archive_aware
+def repair_parts_usage():
+    """Parts used in a period (this month by default), read through the used_at index."""
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+    try:
+        start_dt, end_dt = _usage_range()
+    except ValueError:
+        return jsonify({"message": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
+
+    rows = db.session.execute(
+        db.select(
+            RepairPartUsage.repairing_accessory_id, RepairingAccessory.name, RepairingAccessory.type,
+            db.func.sum(RepairPartUsage.quantity),
+            db.func.count(db.distinct(RepairPartUsage.repairing_device_id)),
+            db.func.sum(RepairPartUsage.quantity * RepairPartUsage.unit_cost),
+        )
+        .join(RepairingAccessory, RepairingAccessory.id == RepairPartUsage.repairing_accessory_id)
+        .where(RepairPartUsage.used_at >= start_dt, RepairPartUsage.used_at < end_dt)
+        .group_by(RepairPartUsage.repairing_accessory_id, RepairingAccessory.name, RepairingAccessory.type)
+        .order_by(db.func.sum(RepairPartUsage.quantity).desc())
+    ).all()
+    return jsonify({
+        "start": start_dt.date().isoformat(),
+        "end": (end_dt - timedelta(days=1)).date().isoformat(),
+        "parts": [
+            {"part_id": part_id, "name": name, "type": type_, "quantity": quantity, "jobs": jobs,
+             "cost": round(cost or 0, 2)}
+            for part_id, name, type_, quantity, jobs, cost in rows
+        ],
+    }), 200
+
+
+@app.route('/repair_parts/jobs', methods=['GET'])
+@archive_aware
+def repair_part_jobs():
+    """Repair jobs that used one part, read through the (part, used_at) index."""
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+    part_id = request.args.get('part_id')
+    if not part_id:
+        return jsonify({"error": "part_id is required"}), 400
+    try:
+        part_id = int(part_id)
+    except ValueError:
+        return jsonify({"error": "part_id must be an integer"}), 400
+    try:
+        start_dt, end_dt = parse_ledger_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return jsonify({"message": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
+
+    rows = db.session.execute(
+        db.select(
+            RepairPartUsage.repairing_device_id, RepairingDevice.customer_name, RepairingDevice.company,
+            RepairingDevice.model, RepairingDevice.repairing_status, RepairPartUsage.quantity, RepairPartUsage.used_at,
+        )
+        .join(RepairingDevice, RepairingDevice.id == RepairPartUsage.repairing_device_id)
+        .where(RepairPartUsage.repairing_accessory_id == part_id,
+               RepairPartUsage.used_at >= start_dt, RepairPartUsage.used_at < end_dt)
+        .order_by(RepairPartUsage.used_at.desc())
+    ).all()
+    return jsonify({
+        "part_id": part_id,
+        "jobs": [
+            {"device_id": device_id, "customer_name": customer_name, "company": company, "model": model,
+             "repairing_status": status, "quantity": quantity, "used_at": used_at.isoformat()}
+            for device_id, customer_name, company, model, status, quantity, used_at in rows
+        ],
+    }), 200
+
+
+@app.route('/add_shop', methods=['GET'])
+def add_shop():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    name = request.args.get('name')
+    address = request.args.get('address')
+    phone = request.args.get('phone')
+    email = request.args.get('email')
+
+    if not name or not address or not phone:
+        return jsonify({'error': 'Name, address, and phone are required'}), 400
+
+    shop = Shop(name=name, address=address, phone=phone, email=email)
+    db.session.add(shop)
+    db.session.commit()
+
+    return jsonify({'message': 'Shop added successfully', 'shop_id': shop.id}), 200
+    
+    
+@app.route('/generate_invoice', methods=['GET'])
+def generate_invoice():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+        
+    user_name = request.args.get('name')
+    user_phone = request.args.get('phone')
+    user_location = request.args.get('location')
+    imei = request.args.get('imei')
+    shop_id = request.args.get('shop_id')  # Shop ID provided by the user
+    paid_amount = float(request.args.get('paid_amount', 0.0))
+
+    # Validate shop
+    shop = Shop.query.filter_by(id=shop_id).first()
+    if not shop:
+        return jsonify({'error': 'Shop not found'}), 404
+
+    # Find phone details by IMEI
+    phone = Phone.query.filter_by(imei=imei).first()
+    if not phone:
+        return jsonify({'error': 'Phone with given IMEI not found'}), 404
+
+    # Check if phone is already sold
+    if phone.status == "Sold Out":
+        return jsonify({'error': 'Phone is already sold out'}), 400
+
+    total_amount = phone.price
+    due_amount = total_amount - paid_amount
+
+    # Create Invoice
+    invoice = Invoice(
+    customer_name=user_name,
+    customer_phone=user_phone,
+    customer_location=user_location,
+    customer_id=resolve_customer(user_phone, user_name, user_location),
+    phone_id=phone.id,
+    shop_id=shop.id,
+    total_amount=total_amount,
+    paid_amount=paid_amount,
+)
+    db.session.add(invoice)
+    db.session.flush()  # Flush to get the invoice_id; everything commits together below
+
+    # Add Initial Due Record (Make sure invoice_id is available)
+    due = Due(
+        invoice_id=invoice.id,
+        phone_model=phone.model_name,
+        paid_amount=paid_amount,
+        payment_date=datetime.utcnow()  # Set payment_date as current time
+    )
+    db.session.add(due)
+
+    # Add Invoice History
+    invoice_history = InvoiceHistory(invoice_id=invoice.id)
+    db.session.add(invoice_history)
+
+    # Update phone status to "Sold Out"
+    phone.update_status(False)
+
+    # Render the printable copy in the background
+    enqueue_job('render_invoice', kind='phone', invoice_id=invoice.id)
+    db.session.commit()
+
+    # Fetch the created invoice details
+    invoice_details = {
+        'invoice_id': invoice.id,
+        'customer_name': invoice.customer_name,
+        'customer_phone': invoice.customer_phone,
+        'customer_location': invoice.customer_location,
+        'total_amount': invoice.total_amount,
+        'paid_amount': invoice.paid_amount,
+        'due_amount': invoice.due_amount,
+        'date_created': invoice.date_created.strftime('%Y-%m-%d %H:%M:%S'),
+        'phone': {
+            'model_name': phone.model_name,
+            'company': phone.company,
+            'imei': phone.imei,
+            'price': phone.price
+        },
+        'shop': {
+            'name': shop.name,
+            'address': shop.address,
+            'phone': shop.phone,
+            'email': shop.email
+        },
+        'due': {
+            'phone_model': due.phone_model,
+            'customer_name': due.customer_name,
+            'paid_amount': due.paid_amount,
+            'payment_date': due.payment_date.strftime('%Y-%m-%d %H:%M:%S')  # Format payment_date
+        },
+        'invoice_history': {
+            'total_paid': invoice_history.total_paid,
+            'total_due': invoice_history.total_due,
+            'total_amount': invoice_history.total_amount,
+            'last_updated': invoice_history.last_updated.strftime('%Y-%m-%d %H:%M:%S')  # Format last_updated
+        }
+    }
+
+    return jsonify({
+        'message': 'Invoice created successfully',
+        'invoice_details': invoice_details
+    }), 200
+ 
+# ----- Payment Posting -----
+def validate_payment(invoice, payment):
+    """Return an error message if `payment` cannot be posted against `invoice`."""
+    if invoice is None:
+        return 'Invoice not found'
+    # NaN and infinity pass both comparisons below
+    if not math.isfinite(payment):
+        return 'Payment must be a finite number'
+    if payment <= 0:
+        return 'Payment must be greater than 0'
+    if payment > invoice.due_amount:
+        return 'Payment exceeds due amount'
+    return None
+
+
+def post_payment(invoice, payment, payment_date=None, invoice_history=None):
+    """Apply one payment to an invoice, its Due log and its InvoiceHistory.
+
+    Everything is flushed, never committed, so a caller can post any number of
+    payments and commit them together (or roll them all back).
+    """
+    payment_date = payment_date or datetime.utcnow()
+    invoice.update_paid_amount(payment)
+
+    # Log the payment in Due table
+    due = Due(
+        invoice_id=invoice.id,
+        phone_model=invoice.phone.model_name if invoice.phone else None,
+        paid_amount=payment,
+        payment_date=payment_date
+    )
+    db.session.add(due)
+
+    # Totals are read from the invoice; the history only records the change time
+    if invoice_history is None:
+        invoice_history = InvoiceHistory.query.filter_by(invoice_id=invoice.id).first()
+    if invoice_history:
+        invoice_history.last_updated = datetime.utcnow()
+
+    db.session.flush()
+    return due
+
+
+def parse_payment_date(value):
+    """Parse a cash book date ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS')."""
+    if not value:
+        return None
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError("Invalid date format. Use 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'.")
+
+
+@app.route('/add_payment', methods=['GET'])
+def add_payment():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    invoice_id = request.args.get('invoice_id')
+    try:
+        payment = float(request.args.get('payment', 0.0))
+    except ValueError:
+        return jsonify({'error': 'Payment must be a number'}), 400
+
+    # Fetch invoice
+    invoice = Invoice.query.filter_by(id=invoice_id).first()
+    if not invoice:
+        return jsonify({'error': 'Invoice not found'}), 404
+
+    # Validate payment
+    error = validate_payment(invoice, payment)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # Invoice, Due and InvoiceHistory are written in one transaction
+    try:
+        post_payment(invoice, payment)
+        db.session.commit()
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Failed to add payment. Error: {str(e)}'}), 500
+
+    return jsonify({
+        'message': 'Payment added successfully',
+        'remaining_due': invoice.due_amount
+    }), 200
+
+
+@app.route('/add_payment/bulk', methods=['POST'])
+def add_payment_bulk():
+    """Post a day's collected payments in a single transaction.
+
+    Body: {"payments": [{"invoice_id": 1, "payment": 500, "payment_date": "2024-01-31"}, ...]}
+    (a bare JSON list is accepted as well). Every row is validated and gets its
+    own result. With `atomic=1` one invalid row rejects the whole batch,
+    otherwise the valid rows are posted and the invalid ones are reported.
+    """
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    data = request.get_json(silent=True)
+    rows = data.get('payments') if isinstance(data, dict) else data
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'error': 'A non-empty list of payments is required'}), 400
+    atomic = request.args.get('atomic', '0') == '1'
+
+    # Load every referenced invoice, its phone and its history with two queries
+    invoice_ids = set()
+    for row in rows:
         try:
-            return float(value) if value and value.strip() else default
-        except ValueError:
-            return default
+            invoice_ids.add(int(row.get('invoice_id')))
+        except (AttributeError, TypeError, ValueError):
+            continue
+    invoices = {
+        invoice.id: invoice
+        for invoice in Invoice.query.options(db.joinedload(Invoice.phone))
+        .filter(Invoice.id.in_(invoice_ids)).all()
+    } if invoice_ids else {}
+    histories = {
+        history.invoice_id: history
+        for history in InvoiceHistory.query.filter(InvoiceHistory.invoice_id.in_(invoice_ids)).all()
+    } if invoice_ids else {}
+
+    results = []
+    posted = 0
+    total_posted = 0.0
+    try:
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                results.append({'row': index, 'invoice_id': None, 'status': 'error', 'error': 'Invalid row'})
+                continue
+            result = {'row': index, 'invoice_id': row.get('invoice_id')}
+            try:
+                invoice = invoices.get(int(row.get('invoice_id')))
+                payment = float(row.get('payment'))
+                payment_date = parse_payment_date(row.get('payment_date'))
+            except (TypeError, ValueError) as e:
+                result.update({'status': 'error', 'error': str(e) or 'Invalid row'})
+                results.append(result)
+                continue
+
+            # Earlier rows of the batch are already applied in memory, so
+            # several payments against the same invoice are validated in order
+            error = validate_payment(invoice, payment)
+            if error:
+                result.update({'status': 'error', 'error': error})
+                results.append(result)
+                continue
+
+            post_payment(invoice, payment, payment_date, histories.get(invoice.id))
+            posted += 1
+            total_posted += payment
+            result.update({'status': 'posted', 'payment': payment, 'remaining_due': invoice.due_amount})
+            results.append(result)
+
+        failed = len(rows) - posted
+        if atomic and failed:
+            db.session.rollback()
+            for result in results:
+                if result['status'] == 'posted':
+                    result['status'] = 'rolled_back'
+                    result.pop('remaining_due', None)
+            return jsonify({
+                'message': 'Batch rejected, no payments were posted',
+                'posted': 0,
+                'failed': failed,
+                'results': results
+            }), 400
+
+        db.session.commit()
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Failed to post payments. Error: {str(e)}'}), 500
+
+    return jsonify({
+        'message': f'{posted} of {len(rows)} payments posted successfully',
+        'posted': posted,
+        'failed': len(rows) - posted,
+        'total_posted': total_posted,
+        'results': results
+    }), 200 if posted else 400
+
+@app.route('/invoice_history', methods=['GET'])
+@single_flight
+@use_report_snapshot
+@cross_shop_report('invoice_history')
+@archive_aware
+def invoice_history():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    return jsonify({'invoice_history': phone_invoice_list()}), 200
+    
+    
+
+
+@app.route('/repairingdevice/invoice', methods=['GET'])
+def generate_and_save_invoice():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    device_id = request.args.get('id')
+    shop_id = request.args.get('shop_id')
+
+    # Get the repairing device
+    repairing_device = RepairingDevice.query.filter_by(id=device_id).first()
+    if not repairing_device:
+        return jsonify({"message": "Repairing device not found"}), 404
+
+    # Get the shop details
+    shop = Shop.query.filter_by(id=shop_id).first()
+    if not shop:
+        return jsonify({"message": "Shop not found"}), 404
+
+    # Generate unique invoice ID
+    india_tz = timezone('Asia/Kolkata')
+    current_time_ist = datetime.now(india_tz)
+    
+    invoice_id = allocate_invoice_number(shop.id, 'repair')
+
+    # Automatically save the invoice to history
+    new_invoice = RepairingInvoice(
+        invoice_id=invoice_id,
+        repairing_device_id=device_id,
+        shop_id=shop.id,
+        customer_name=repairing_device.customer_name,
+        repairing_cost=repairing_device.repairing_cost,
+        advance_payment=repairing_device.advance_payment,
+        due_price=repairing_device.due_price,
+        bill_status=repairing_device.bill_status,
+        payment_method=repairing_device.payment_method,
+    )
+
+    try:
+        # Save the invoice history and render the printable copy in the background
+        db.session.add(new_invoice)
+        enqueue_job('render_invoice', kind='repair', invoice_id=invoice_id)
+        db.session.commit()
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": f"Failed to save invoice history. Error: {str(e)}"}), 500
+
+    # Convert and format date_added field to IST
+    date_added_ist = repairing_device.date_added.astimezone(india_tz).strftime('%Y-%m-%d %H:%M:%S')
+
+    # Full invoice details
+    invoice_details = {
+        "invoice_id": invoice_id,
+        "repairing_device_id": repairing_device.id,
+        "customer_name": repairing_device.customer_name,
+        "phone_number": repairing_device.phone_number,
+        "company": repairing_device.company,
+        "model": repairing_device.model,
+        "device_condition": repairing_device.device_condition,
+        "repairing_status": repairing_device.repairing_status,
+        "repairing_cost": repairing_device.repairing_cost,
+        "advance_payment": repairing_device.advance_payment,
+        "due_price": repairing_device.due_price,
+        "bill_status": repairing_device.bill_status,
+        "payment_method": repairing_device.payment_method,
+        "delivery_status": repairing_device.delivery_status,
+        "technician_name": repairing_device.technician_name,
+        "estimated_delivery_date": repairing_device.estimated_delivery_date.strftime('%Y-%m-%d') if repairing_device.estimated_delivery_date else None,
+        "date_added": date_added_ist,  # Date in IST formatted as string
+        "shop_details": {
+            "shop_id": shop.id,
+            "shop_name": shop.name,
+            "shop_address": shop.address,
+            "shop_phone": shop.phone,
+            "shop_email": shop.email,
+        }
+    }
+
+    # Return the full invoice details as JSON
+    return jsonify({"message": "Invoice generated and saved successfully", "invoice_details": invoice_details}), 200
+    
+    
+@app.route('/repairinginvoice/history', methods=['GET'])
+@single_flight
+@use_report_snapshot
+@cross_shop_report('invoices')
+@archive_aware
+def view_repairing_invoice_history():
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    return jsonify({
+        "message": "Repairing invoice history retrieved successfully",
+        "invoices": repairing_invoice_list(),
+    }), 200
+    
+@background_task('record_accessory_sale')
+def record_accessory_sale(accessory_id, quantity, sold_at):
+    # Sales bookkeeping that the invoice response does not depend on
+    accessory = db.session.get(Accessory, accessory_id)
+    if not accessory:
+        return
+    accessory.stock_out += quantity
+    accessory.last_purchase_quantity = quantity
+    accessory.last_purchase_date = datetime.fromisoformat(sold_at)
+
+
+@app.route('/generate_accessorie_invoice', methods=['GET'])
+def generate_accessorie_invoice():
+    # Check for authorization key
+    auth_key = request.args.get('auth_key')
+    if not auth_key or not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    # Extract parameters from the query string
+    user_name = request.args.get("user_name")
+    user_phone = request.args.get("user_phone")
+    accessory_id = request.args.get("accessory_id")
+    shop_id = request.args.get("shop_id")
+    quantity = request.args.get("quantity")
+
+    # Validation
+    if not all([user_name, user_phone, accessory_id, shop_id, quantity]):
+        return jsonify({"error": "All fields are required"}), 400
+
+    try:
+        # Convert quantity to integer
+        quantity = int(quantity)
+
+        # Fetch accessory details from the database
+        accessory = Accessory.query.get(accessory_id)
+        if not accessory:
+            return jsonify({"error": "Accessory not found"}), 404
+
+        # Fetch shop details from the database
+        shop = Shop.query.get(shop_id)
+        if not shop:
+            return jsonify({"error": "Shop not found"}), 404
+
+        # Check stock availability
+        if accessory.added_stock < quantity:
+            return jsonify({"error": "Insufficient stock available"}), 400
+
+        # Allocate the next invoice number for this shop
+        invoice_id = allocate_invoice_number(shop.id, 'accessory')
+
+        # Calculate total price
+        total_price = accessory.unit_price * quantity
+
+        # Update stock and sales details
+        accessory.added_stock -= quantity
+        accessory.times_sold += quantity
+
+        # Save invoice to the database
+        new_invoice = AccessorieInvoice(
+            invoice_id=invoice_id,
+            user_name=user_name,
+            user_phone=user_phone,
+            customer_id=resolve_customer(user_phone, user_name),
+            accessory_profile_id=accessory_profile_id(accessory),
+            unit_price=accessory.unit_price,
+            quantity=quantity,
+            total_price=total_price,
+            shop_profile_id=shop_profile_id(shop),
+        )
+        db.session.add(new_invoice)
+
+        # Sales bookkeeping and the printable copy are done in the background
+        enqueue_job('record_accessory_sale', accessory_id=accessory.id, quantity=quantity,
+                    sold_at=datetime.now(timezone('Asia/Kolkata')).isoformat())
+        enqueue_job('render_invoice', kind='accessory', invoice_id=invoice_id)
+        db.session.commit()
+
+        # Prepare invoice data for response
+        invoice_data = {
+            "invoice_id": invoice_id,
+            "user_name": user_name,
+            "user_phone": user_phone,
+            "accessory_details": {
+                "accessory_name": accessory.accessory_name,
+                "company": accessory.company,
+                "category": accessory.category,
+                "unit_price": accessory.unit_price,
+                "quantity": quantity,
+                "total_price": total_price,
+            },
+            "shop_details": {
+                "shop_name": shop.name,
+                "shop_address": shop.address,
+                "shop_phone": shop.phone,
+                "shop_email": shop.email,
+            },
+            "date": datetime.utcnow().isoformat(),
+        }
+
+        return jsonify({"status": "success", "invoice": invoice_data}), 200
+
+    except ValueError:
+        return jsonify({"error": "Invalid quantity format"}), 400
+
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/generate_accessorie_invoice/cart', methods=['POST'])
+def generate_accessorie_cart_invoice():
+    """Sell several accessories on one invoice.
+
+    Body: {"user_name": "...", "user_phone": "...", "shop_id": 1,
+           "items": [{"accessory_id": 3, "quantity": 2}, ...]}
+    Stock for every line is read with one query and decremented with one
+    conditional UPDATE in the invoice's transaction. If any line is short,
+    nothing is sold.
+    """
+    auth_key = request.args.get('auth_key')
+    if not auth_key or not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "A JSON object is required"}), 400
+    user_name = data.get("user_name")
+    user_phone = data.get("user_phone")
+    shop_id = data.get("shop_id")
+    items = data.get("items")
+    if not all([user_name, user_phone, shop_id]) or not isinstance(items, list) or not items:
+        return jsonify({"error": "user_name, user_phone, shop_id and a non-empty items list are required"}), 400
+
+    # Repeated accessories are merged into one line
+    quantities = {}
+    for item in items:
+        try:
+            accessory_id = int(item["accessory_id"])
+            quantity = int(item["quantity"])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"error": "Every item needs an integer accessory_id and quantity"}), 400
+        if quantity <= 0:
+            return jsonify({"error": "Quantity must be greater than 0"}), 400
+        quantities[accessory_id] = quantities.get(accessory_id, 0) + quantity
+
+    shop = db.session.get(Shop, shop_id)
+    if not shop:
+        return jsonify({"error": "Shop not found"}), 404
+
+    table = Accessory.__table__
+    accessories = {
+        row.id: row for row in db.session.execute(db.select(table).where(table.c.id.in_(quantities)))
+    }
+    missing = [accessory_id for accessory_id in quantities if accessory_id not in accessories]
+    if missing:
+        return jsonify({"error": "Accessory not found", "accessory_ids": missing}), 404
+    short = [
+        {"accessory_id": accessory_id, "requested": quantity, "available": accessories[accessory_id].added_stock}
+        for accessory_id, quantity in quantities.items()
+        if accessories[accessory_id].added_stock < quantity
+    ]
+    if short:
+        return jsonify({"error": "Insufficient stock available", "items": short}), 400
+
+    try:
+        # Reserved on its own connection, so before this transaction takes the write lock
+        invoice_id = allocate_invoice_number(shop.id, 'accessory')
+
+        # Every line in one statement; a line whose stock moved since the read does not match
+        sold_quantity = db.case(quantities, value=table.c.id)
+        sold = db.session.execute(
+            table.update()
+            .where(table.c.id.in_(quantities), table.c.added_stock >= sold_quantity)
+            .values(
+                added_stock=table.c.added_stock - sold_quantity,
+                times_sold=table.c.times_sold + sold_quantity,
+                stock_out=table.c.stock_out + sold_quantity,
+                last_purchase_quantity=sold_quantity,
+                last_purchase_date=datetime.now(timezone('Asia/Kolkata')),
+            )
+        ).rowcount
+        if sold != len(quantities):
+            db.session.rollback()
+            return jsonify({"error": "Stock changed while the invoice was created, please retry"}), 409
+        for row in db.session.execute(
+            db.select(table.c.id, table.c.accessory_name, table.c.added_stock, table.c.minimum_stock)
+            .where(table.c.id.in_(quantities))
+        ):
+            queue_change_event(
+                'stock_changed', item='accessory', id=row.id, name=row.accessory_name,
+                stock=row.added_stock, minimum_stock=row.minimum_stock,
+            )
+
+        total_price = sum(accessories[a].unit_price * q for a, q in quantities.items())
+        cart = AccessoryCartInvoice(
+            invoice_id=invoice_id,
+            user_name=user_name,
+            user_phone=user_phone,
+            customer_id=resolve_customer(user_phone, user_name),
+            shop_profile_id=shop_profile_id(shop),
+            total_price=total_price,
+        )
+        for accessory_id, quantity in quantities.items():
+            accessory = accessories[accessory_id]
+            cart.lines.append(AccessoryCartLine(
+                accessory_id=accessory_id,
+                accessory_profile_id=accessory_profile_id(accessory),
+                unit_price=accessory.unit_price,
+                quantity=quantity,
+                total_price=accessory.unit_price * quantity,
+            ))
+        db.session.add(cart)
+        enqueue_job('render_invoice', kind='accessory', invoice_id=invoice_id)
+        db.session.commit()
+    except ShopNotSelected:
+        raise
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    invoice_data = {
+        "invoice_id": invoice_id,
+        "user_name": user_name,
+        "user_phone": user_phone,
+        "items": [
+            {
+                "accessory_id": accessory_id,
+                "accessory_name": accessories[accessory_id].accessory_name,
+                "company": accessories[accessory_id].company,
+                "category": accessories[accessory_id].category,
+                "unit_price": accessories[accessory_id].unit_price,
+                "quantity": quantity,
+                "total_price": accessories[accessory_id].unit_price * quantity,
+            }
+            for accessory_id, quantity in quantities.items()
+        ],
+        "total_price": total_price,
+        "shop_details": {
+            "shop_name": shop.name,
+            "shop_address": shop.address,
+            "shop_phone": shop.phone,
+            "shop_email": shop.email,
+        },
+        "date": datetime.utcnow().isoformat(),
+    }
+    return jsonify({"status": "success", "invoice": invoice_data}), 200
+
+
+# ----- Invoice Documents -----
+def phone_invoice_document(invoice_id):
+    invoice = Invoice.query.filter_by(id=invoice_id).first()
+    if not invoice:
+        return None
+    phone = invoice.phone
+    shop = invoice.shop
+    return {
+        "title": "Invoice",
+        "number": str(invoice.id),
+        "date": invoice.date_created.strftime('%Y-%m-%d %H:%M:%S'),
+        "shop": {"name": shop.name, "address": shop.address, "phone": shop.phone, "email": shop.email},
+        "customer": {
+            "name": invoice.customer_name,
+            "phone": invoice.customer_phone,
+            "location": invoice.customer_location,
+        },
+        "details": [
+            ("IMEI", phone.imei),
+            ("Condition", "New" if phone.is_new else "Old"),
+        ],
+        "lines": [{
+            "description": f"{phone.company} {phone.model_name}",
+            "quantity": 1,
+            "unit_price": invoice.total_amount,
+            "total": invoice.total_amount,
+        }],
+        "totals": {"total": invoice.total_amount, "paid": invoice.paid_amount, "due": invoice.due_amount},
+    }
+
+
+def repair_invoice_document(invoice_id):
+    invoice = RepairingInvoice.query.filter_by(invoice_id=invoice_id).first()
+    if not invoice:
+        return None
+    device = invoice.repairing_device
+    shop = invoice.shop
+    return {
+        "title": "Repair Invoice",
+        "number": invoice.invoice_id,
+        "date": invoice.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        "shop": {"name": shop.name, "address": shop.address, "phone": shop.phone, "email": shop.email},
+        "customer": {"name": invoice.customer_name, "phone": device.phone_number, "location": None},
+        "details": [
+            ("Device", f"{device.company} {device.model}"),
+            ("Condition", device.device_condition),
+            ("Parts Replaced", device.parts_replaced),
+            ("Technician", device.technician_name),
+            ("Payment Method", invoice.payment_method),
+            ("Bill Status", invoice.bill_status),
+        ],
+        "lines": [{
+            "description": f"Repair of {device.company} {device.model}",
+            "quantity": 1,
+            "unit_price": invoice.repairing_cost,
+            "total": invoice.repairing_cost,
+        }],
+        "totals": {
+            "total": invoice.repairing_cost,
+            "paid": invoice.advance_payment,
+            "due": invoice.due_price,
+        },
+    }
+
+
+def accessory_invoice_document(invoice_id):
+    invoice = AccessorieInvoice.query.filter_by(invoice_id=invoice_id).first()
+    if not invoice:
+        return accessory_cart_document(invoice_id)
+    return {
+        "title": "Invoice",
+        "number": invoice.invoice_id,
+        "date": invoice.date.strftime('%Y-%m-%d %H:%M:%S'),
+        "shop": {
+            "name": invoice.shop_name,
+            "address": invoice.shop_address,
+            "phone": invoice.shop_phone,
+            "email": invoice.shop_email,
+        },
+        "customer": {"name": invoice.user_name, "phone": invoice.user_phone, "location": None},
+        "details": [],
+        "lines": [{
+            "description": f"{invoice.accessory_name} ({invoice.company}, {invoice.category})",
+            "quantity": invoice.quantity,
+            "unit_price": invoice.unit_price,
+            "total": invoice.total_price,
+        }],
+        "totals": {"total": invoice.total_price, "paid": invoice.total_price, "due": 0.0},
+    }
+
 
-    repairing_cost = handle_missing_numeric(request.args.get('repairing_cost'))
-    due_price = handle_missing_numeric(request.args.get('due_price'))
-    advance_payment = handle_missing_numeric(request.args.get('advance_payment'))
+def accessory_cart_document(invoice_id):
+    invoice = AccessoryCartInvoice.query.filter_by(invoice_id=invoice_id).first()
+    if not invoice:
+        return None
+    return {
+        "title": "Invoice",
+        "number": invoice.invoice_id,
+        "date": invoice.date.strftime('%Y-%m-%d %H:%M:%S'),
+        "shop": {
+            "name": invoice.shop_name,
+            "address": invoice.shop_address,
+            "phone": invoice.shop_phone,
+            "email": invoice.shop_email,
+        },
+        "customer": {"name": invoice.user_name, "phone": invoice.user_phone, "location": None},
+        "details": [],
+        "lines": [{
+            "description": f"{line.accessory_name} ({line.company}, {line.category})",
+            "quantity": line.quantity,
+            "unit_price": line.unit_price,
+            "total": line.total_price,
+        } for line in invoice.lines],
+        "totals": {"total": invoice.total_price, "paid": invoice.total_price, "due": 0.0},
+    }
 
-    # Handle date fields
-    estimated_delivery_date = request.args.get('estimated_delivery_date')
-    if estimated_delivery_date:
-        try:
-            estimated_delivery_date = datetime.strptime(estimated_delivery_date, '%Y-%m-%d').date()
-        except ValueError:
-            return jsonify({"message": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
 
-    # Validate if the user is authorized
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
+INVOICE_DOCUMENT_LOADERS = {
+    "phone": phone_invoice_document,
+    "repair": repair_invoice_document,
+    "accessory": accessory_invoice_document,
+}
 
-    # Creating the new repairing device object
-    repairing_device = RepairingDevice(
-        customer_name=customer_name,
-        phone_number=phone_number,
-        received_by=received_by,
-        company=company,
-        model=model,
-        device_condition=device_condition,
-        repairing_status=repairing_status,
-        repairing_cost=repairing_cost,
-        estimated_delivery_date=estimated_delivery_date,
-        parts_replaced=parts_replaced,
-        bill_status=bill_status,
-        due_price=due_price,
-        advance_payment=advance_payment,
-        payment_method=payment_method,
-        delivery_status=delivery_status,
-        technician_name=technician_name,
-    )
+INVOICE_MIMETYPES = {"html": "text/html; charset=utf-8", "pdf": "application/pdf"}
 
-    try:
-        db.session.add(repairing_device)
-        db.session.commit()
-        return jsonify({"message": "Repairing device added successfully"}), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"error": f"Failed to add repairing device. Error: {str(e)}"}), 500
-        
-        
-@app.route('/repairingdevice/view', methods=['GET'])
-def view_repairing_devices():
-    # Extract auth key from the request
-    auth_key = request.args.get('auth_key')
 
-    # Verify if the user is authorized
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
+class InvoiceRenderer:
+    """Renders invoice documents into a content-addressed on-disk cache.
 
-    # Query all repairing devices from the database
-    repairing_devices = RepairingDevice.query.all()
+    A cached file is keyed by invoice kind, invoice ID and a digest of the
+    invoice data plus the template source, so a reprint of an unchanged invoice
+    is served as static bytes and any change (a new payment, an edited
+    template) produces a new version that replaces the older ones on disk.
+    PDF rendering is slow and runs on a small background thread pool, off the
+    request path.
+    """
 
-    # Prepare the list of repairing devices
-    device_list = [
-        {
-            "id": device.id,
-            "customer_name": device.customer_name,
-            "phone_number": device.phone_number,
-            "received_by": device.received_by,
-            "company": device.company,
-            "model": device.model,
-            "device_condition": device.device_condition,
-            "repairing_status": device.repairing_status,
-            "repairing_cost": device.repairing_cost,
-            "estimated_delivery_date": device.estimated_delivery_date,
-            "parts_replaced": device.parts_replaced,
-            "bill_status": device.bill_status,
-            "due_price": device.due_price,
-            "advance_payment": device.advance_payment,
-            "payment_method": device.payment_method,
-            "delivery_status": device.delivery_status,
-            "technician_name": device.technician_name,
-            "date_added": device.date_added
-        }
-        for device in repairing_devices
-    ]
+    template_name = 'invoice.html'
 
-    # Return the list of repairing devices in the response
-    return jsonify({"repairing_devices": device_list}), 200
-    
-@app.route('/repairingdevice/delete', methods=['GET'])
-def delete_repairing_device():
+    def __init__(self, cache_dir, max_workers=2):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._pending = {}  # (kind, invoice_id, fmt) -> Future
+        self._template_digest = None
+
+    @property
+    def formats(self):
+        return ("html", "pdf") if WeasyHTML is not None else ("html",)
+
+    def _get_executor(self):
+        with self._lock:
+            # Threads do not survive a fork, so each worker process gets its own pool
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix='invoice-render'
+                )
+                self._pid = os.getpid()
+                self._pending = {}
+            return self._executor
+
+    def template_digest(self):
+        if self._template_digest is None:
+            source = app.jinja_env.loader.get_source(app.jinja_env, self.template_name)[0]
+            self._template_digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        return self._template_digest
+
+    def version(self, kind, doc):
+        payload = json.dumps([kind, doc, self.template_digest()], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def path_for(self, kind, doc, fmt):
+        number = "".join(ch if ch.isalnum() or ch in "-_" else "_" for ch in doc["number"])
+        return os.path.join(self.cache_dir, kind, number, f"{self.version(kind, doc)}.{fmt}")
+
+    def cached_path(self, kind, doc, fmt):
+        path = self.path_for(kind, doc, fmt)
+        return path if os.path.exists(path) else None
+
+    def render_bytes(self, doc, fmt):
+        # Flask's Jinja environment compiles the template once and keeps it cached
+        html = app.jinja_env.get_template(self.template_name).render(doc=doc)
+        if fmt == "pdf":
+            return WeasyHTML(string=html).write_pdf()
+        return html.encode('utf-8')
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name first so readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def render_to_cache(self, kind, doc, fmt):
+        path = self.path_for(kind, doc, fmt)
+        if os.path.exists(path):
+            return path
+        self._write(path, self.render_bytes(doc, fmt))
+        if fmt == "html":
+            self.precompressed(path)
+        self._prune(path)
+        return path
+
+    @staticmethod
+    def _prune(path):
+        """Remove the invoice's cached files of every version but the one at `path`."""
+        directory, name = os.path.split(path)
+        current = name.split('.')[0]
+        for other in os.listdir(directory):
+            # Other formats of the same version stay, as do files still being written
+            if other.split('.')[0] == current or other.endswith('.tmp'):
+                continue
+            try:
+                os.remove(os.path.join(directory, other))
+            except OSError:
+                pass
+
+    def precompressed(self, path):
+        """A gzip copy of a cached HTML document, compressed once at the highest level."""
+        gz_path = f"{path}.gz"
+        if not os.path.exists(gz_path):
+            with open(path, 'rb') as f:
+                self._write(gz_path, gzip.compress(f.read(), 9, mtime=0))
+        return gz_path
+
+    def _render_job(self, kind, invoice_id, fmt):
+        with app.app_context():
+            doc = INVOICE_DOCUMENT_LOADERS[kind](invoice_id)
+            if doc is None:
+                return None
+            return self.render_to_cache(kind, doc, fmt)
+
+    def submit(self, kind, invoice_id, fmt):
+        """Queue a render; concurrent requests for the same document share one job."""
+        key = (kind, str(invoice_id), fmt)
+        executor = self._get_executor()
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None or future.done():
+                future = executor.submit(self._render_job, kind, str(invoice_id), fmt)
+                self._pending[key] = future
+                future.add_done_callback(lambda f, key=key: self._forget(key, f))
+            return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+
+
+invoice_renderer = InvoiceRenderer(app.config['INVOICE_CACHE_DIR'], app.config['INVOICE_RENDER_WORKERS'])
+
+
+@background_task('render_invoice')
+def render_invoice(kind, invoice_id):
+    # Warm the document cache for a freshly created invoice
+    doc = INVOICE_DOCUMENT_LOADERS[kind](invoice_id)
+    if doc is None:
+        return
+    for fmt in invoice_renderer.formats:
+        invoice_renderer.render_to_cache(kind, doc, fmt)
+
+
+@app.route('/invoice/print', methods=['GET'])
+def print_invoice():
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
 
-    device_id = request.args.get('id')
-    repairing_device = RepairingDevice.query.filter_by(id=device_id).first()
-    if not repairing_device:
-        return jsonify({"message": "Repairing device not found"}), 404
+    kind = request.args.get('kind', 'phone')
+    invoice_id = request.args.get('invoice_id')
+    fmt = request.args.get('format', 'html')
+
+    if kind not in INVOICE_DOCUMENT_LOADERS:
+        return jsonify({"error": "kind must be one of phone, repair, accessory"}), 400
+    if fmt not in INVOICE_MIMETYPES:
+        return jsonify({"error": "format must be html or pdf"}), 400
+    if fmt not in invoice_renderer.formats:
+        return jsonify({"error": "PDF rendering is not available on this server (install WeasyPrint)"}), 501
+    if not invoice_id:
+        return jsonify({"error": "invoice_id is required"}), 400
+    try:
+        wait = float(request.args.get('wait', 0) or 0)
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
 
-    db.session.delete(repairing_device)
-    db.session.commit()
-    return jsonify({"message": f"Repairing device with ID {device_id} deleted successfully"}), 200
-    
-    
-@app.route('/repairingdevice/edit', methods=['GET'])
-def edit_repairing_device():
+    doc = INVOICE_DOCUMENT_LOADERS[kind](invoice_id)
+    if doc is None:
+        return jsonify({"error": "Invoice not found"}), 404
+
+    path = invoice_renderer.cached_path(kind, doc, fmt)
+    if path is None:
+        if fmt == 'html':
+            # HTML is cheap enough to render inline
+            path = invoice_renderer.render_to_cache(kind, doc, fmt)
+        else:
+            future = invoice_renderer.submit(kind, invoice_id, fmt)
+            try:
+                path = future.result(timeout=min(wait, 30)) if wait > 0 else None
+            except Exception as e:
+                if future.done():
+                    return jsonify({"error": f"Failed to render invoice. Error: {str(e)}"}), 500
+                path = None
+            if path is None:
+                response = jsonify({"status": "rendering", "message": "Invoice is being rendered, retry shortly"})
+                response.headers['Retry-After'] = '1'
+                return response, 202
+
+    etag = os.path.basename(path).split('.')[0]
+    if fmt == 'html' and request.accept_encodings.quality('gzip') > 0:
+        response = send_file(invoice_renderer.precompressed(path), mimetype=INVOICE_MIMETYPES[fmt],
+                             etag=f"{etag}-gzip", conditional=True, max_age=0)
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+    response = send_file(path, mimetype=INVOICE_MIMETYPES[fmt], etag=etag, conditional=True, max_age=0)
+    return response
+
+
+# ----- Ledger Export -----
+LEDGER_COLUMNS = [
+    "entry_type", "date", "reference", "shop", "customer_name", "customer_phone",
+    "description", "quantity", "amount", "paid", "due",
+]
+
+
+def parse_ledger_range(start, end):
+    """Turn 'YYYY-MM-DD' bounds into a half-open [start, end + 1 day) datetime range."""
+    start_dt = datetime.strptime(start, '%Y-%m-%d') if start else datetime(1970, 1, 1)
+    end_dt = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else datetime.utcnow() + timedelta(days=1)
+    return start_dt, end_dt
+
+
+def ledger_statements(start_dt, end_dt):
+    """One ordered Core SELECT per ledger source, all in LEDGER_COLUMNS order."""
+    phone_sales = (
+        db.select(
+            db.literal("phone_sale"), Invoice.date_created, db.cast(Invoice.id, db.String), Shop.name,
+            Invoice.customer_name, Invoice.customer_phone,
+            Phone.company + " " + Phone.model_name + " (IMEI " + Phone.imei + ")",
+            db.literal(1), Invoice.total_amount, Invoice.paid_amount,
+            Invoice.total_amount - Invoice.paid_amount,
+        )
+        .join(Phone, Phone.id == Invoice.phone_id)
+        .join(Shop, Shop.id == Invoice.shop_id)
+        .where(Invoice.date_created >= start_dt, Invoice.date_created < end_dt)
+        .order_by(Invoice.date_created)
+    )
+    phone_payments = (
+        db.select(
+            db.literal("phone_payment"), Due.payment_date, db.cast(Due.invoice_id, db.String), Shop.name,
+            Invoice.customer_name, Invoice.customer_phone, Due.phone_model,
+            db.literal(None), db.literal(None), Due.paid_amount, db.literal(None),
+        )
+        .join(Invoice, Invoice.id == Due.invoice_id)
+        .join(Shop, Shop.id == Invoice.shop_id)
+        .where(Due.payment_date >= start_dt, Due.payment_date < end_dt)
+        .order_by(Due.payment_date)
+    )
+    repairs = (
+        db.select(
+            db.literal("repair"), RepairingInvoice.created_at, RepairingInvoice.invoice_id, Shop.name,
+            RepairingInvoice.customer_name, RepairingDevice.phone_number,
+            "Repair: " + RepairingDevice.company + " " + RepairingDevice.model,
+            db.literal(1), RepairingInvoice.repairing_cost, RepairingInvoice.advance_payment,
+            RepairingInvoice.due_price,
+        )
+        .join(RepairingDevice, RepairingDevice.id == RepairingInvoice.repairing_device_id)
+        .join(Shop, Shop.id == RepairingInvoice.shop_id)
+        .where(RepairingInvoice.created_at >= start_dt, RepairingInvoice.created_at < end_dt)
+        .order_by(RepairingInvoice.created_at)
+    )
+    accessories = (
+        db.select(
+            db.literal("accessory_sale"), AccessorieInvoice.date, AccessorieInvoice.invoice_id,
+            ShopProfile.name, AccessorieInvoice.user_name, AccessorieInvoice.user_phone,
+            AccessoryProfile.accessory_name, AccessorieInvoice.quantity, AccessorieInvoice.total_price,
+            AccessorieInvoice.total_price, db.literal(0.0),
+        )
+        .join(ShopProfile, ShopProfile.id == AccessorieInvoice.shop_profile_id)
+        .join(AccessoryProfile, AccessoryProfile.id == AccessorieInvoice.accessory_profile_id)
+        .where(AccessorieInvoice.date >= start_dt, AccessorieInvoice.date < end_dt)
+        .order_by(AccessorieInvoice.date)
+    )
+    accessory_carts = (
+        db.select(
+            db.literal("accessory_sale"), AccessoryCartInvoice.date, AccessoryCartInvoice.invoice_id,
+            ShopProfile.name, AccessoryCartInvoice.user_name, AccessoryCartInvoice.user_phone,
+            AccessoryProfile.accessory_name, AccessoryCartLine.quantity, AccessoryCartLine.total_price,
+            AccessoryCartLine.total_price, db.literal(0.0),
+        )
+        .join(AccessoryCartInvoice, AccessoryCartInvoice.id == AccessoryCartLine.cart_invoice_id)
+        .join(ShopProfile, ShopProfile.id == AccessoryCartInvoice.shop_profile_id)
+        .join(AccessoryProfile, AccessoryProfile.id == AccessoryCartLine.accessory_profile_id)
+        .where(AccessoryCartInvoice.date >= start_dt, AccessoryCartInvoice.date < end_dt)
+        .order_by(AccessoryCartInvoice.date, AccessoryCartLine.id)
+    )
+    return [phone_sales, phone_payments, repairs, accessories, accessory_carts]
+
+
+def iter_ledger(start_dt, end_dt, chunk_size=None):
+    """Yield ledger rows as tuples in date order with bounded memory.
+
+    Each source is read with `yield_per`, which fetches `chunk_size` rows per
+    round trip, and the date-ordered streams are merged lazily.
+    """
+    chunk_size = chunk_size or app.config['LEDGER_EXPORT_CHUNK_SIZE']
+    # With partitioned shops every shop database contributes its own streams
+    streams = [
+        db.session.execute(stmt.execution_options(yield_per=chunk_size), bind_arguments={'bind': engine})
+        for _, engine in partition_targets()
+        for stmt in ledger_statements(start_dt, end_dt)
+    ]
+    try:
+        for row in heapq.merge(*streams, key=lambda row: row[1] or datetime.min):
+            yield tuple(row)
+    finally:
+        for result in streams:
+            result.close()
+
+
+def ledger_csv_chunks(rows, chunk_size):
+    """Encode ledger rows as CSV text, one chunk of `chunk_size` rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(LEDGER_COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(
+            [value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime) else value for value in row]
+        )
+        count += 1
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+LEDGER_PARQUET_SCHEMA = None if pa is None else pa.schema([
+    ("entry_type", pa.string()), ("date", pa.timestamp("us")), ("reference", pa.string()),
+    ("shop", pa.string()), ("customer_name", pa.string()), ("customer_phone", pa.string()),
+    ("description", pa.string()), ("quantity", pa.int64()), ("amount", pa.float64()),
+    ("paid", pa.float64()), ("due", pa.float64()),
+])
+
+
+def write_ledger_parquet(rows, path, chunk_size):
+    """Write ledger rows to a Parquet file, one row group per chunk."""
+    count = 0
+    with pq.ParquetWriter(path, LEDGER_PARQUET_SCHEMA, compression='zstd') as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                writer.write_table(pa.Table.from_pylist(
+                    [dict(zip(LEDGER_COLUMNS, r)) for r in batch], schema=LEDGER_PARQUET_SCHEMA
+                ))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(
+                [dict(zip(LEDGER_COLUMNS, r)) for r in batch], schema=LEDGER_PARQUET_SCHEMA
+            ))
+            count += len(batch)
+    return count
+
+
+class _CountingIterator:
+    # Counts rows flowing through a generator so throughput can be reported
+    def __init__(self, rows):
+        self.rows = rows
+        self.count = 0
+
+    def __iter__(self):
+        for row in self.rows:
+            self.count += 1
+            yield row
+
+
+@app.route('/ledger/export', methods=['GET'])
+def export_ledger():
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
 
-    device_id = request.args.get('id')
-    repairing_device = RepairingDevice.query.filter_by(id=device_id).first()
-    if not repairing_device:
-        return jsonify({"message": "Repairing device not found"}), 404
+    fmt = request.args.get('format', 'csv')
+    try:
+        start_dt, end_dt = parse_ledger_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return jsonify({"message": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
+    chunk_size = app.config['LEDGER_EXPORT_CHUNK_SIZE']
+    filename = f"ledger_{start_dt:%Y%m%d}_{(end_dt - timedelta(days=1)):%Y%m%d}"
+
+    include_archived = request.args.get('include_archived') == '1'
+    use_snapshot = app.config['REPORT_SNAPSHOT_ENABLED'] and request.args.get('fresh') != '1'
+
+    if fmt == 'csv':
+        headers = snapshot_headers() if use_snapshot else {}
+
+        def generate():
+            started = time.monotonic()
+            with snapshot_reads() if use_snapshot else nullcontext(), \
+                    archive_attached() if include_archived else nullcontext():
+                rows = _CountingIterator(iter_ledger(start_dt, end_dt, chunk_size))
+                yield from ledger_csv_chunks(rows, chunk_size)
+            elapsed = time.monotonic() - started
+            logger.info("Ledger CSV export: %d rows in %.2fs (%.0f rows/s)",
+                        rows.count, elapsed, rows.count / elapsed if elapsed else 0)
+
+        headers['Content-Disposition'] = f'attachment; filename={filename}.csv'
+        return Response(stream_with_context(generate()), mimetype='text/csv', headers=headers)
+
+    elif fmt == 'parquet':
+        if pq is None:
+            return jsonify({"error": "Parquet export is not available on this server (install pyarrow)"}), 501
+        # Parquet needs a seekable target, so it is spooled to a temporary file
+        tmp = tempfile.NamedTemporaryFile(suffix='.parquet', delete=False)
+        tmp.close()
+        started = time.monotonic()
+        try:
+            with snapshot_reads() if use_snapshot else nullcontext(), \
+                    archive_attached() if include_archived else nullcontext():
+                count = write_ledger_parquet(iter_ledger(start_dt, end_dt, chunk_size), tmp.name, chunk_size)
+                headers = snapshot_headers() if use_snapshot else {}
+        except Exception:
+            os.unlink(tmp.name)
+            raise
+        elapsed = time.monotonic() - started
+        response = send_file(tmp.name, mimetype='application/vnd.apache.parquet',
+                             as_attachment=True, download_name=f'{filename}.parquet')
+        response.call_on_close(lambda: os.unlink(tmp.name))
+        response.headers.update(headers)
+        response.headers['X-Export-Rows'] = str(count)
+        response.headers['X-Export-Rows-Per-Second'] = f"{count / elapsed if elapsed else 0:.0f}"
+        return response
+
+    return jsonify({"error": "format must be csv or parquet"}), 400
+
+
+@app.cli.command('export-ledger')
+@click.option('--start', help="First day to export (YYYY-MM-DD).")
+@click.option('--end', help="Last day to export (YYYY-MM-DD).")
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'parquet']), default='csv')
+@click.option('--output', '-o', required=True, help="File to write.")
+@click.option('--chunk-size', type=int, default=None, help="Rows per fetch and per Parquet row group.")
+@click.option('--include-archived', is_flag=True, help="Include records moved to the archive database.")
+def export_ledger_command(start, end, fmt, output, chunk_size, include_archived):
+    """Export the sales ledger for a date range to CSV or Parquet."""
+    chunk_size = chunk_size or app.config['LEDGER_EXPORT_CHUNK_SIZE']
+    start_dt, end_dt = parse_ledger_range(start, end)
+    started = time.monotonic()
+    with archive_attached() if include_archived else nullcontext():
+        rows = _CountingIterator(iter_ledger(start_dt, end_dt, chunk_size))
+        if fmt == 'parquet':
+            if pq is None:
+                raise click.ClickException("Parquet export requires pyarrow")
+            write_ledger_parquet(rows, output, chunk_size)
+        else:
+            with open(output, 'w', newline='', encoding='utf-8') as f:
+                for chunk in ledger_csv_chunks(rows, chunk_size):
+                    f.write(chunk)
+    elapsed = time.monotonic() - started
+    click.echo(f"Exported {rows.count} rows to {output} in {elapsed:.2f}s "
+               f"({rows.count / elapsed if elapsed else 0:.0f} rows/s)")
+
+
+# ----- Inventory Analytics -----
+INVENTORY_MODELS = (Phone, Accessory, RepairingAccessory)
+INVENTORY_TABLES = {model.__tablename__ for model in INVENTORY_MODELS}
+
+
+def _group_rows(rows, keys, values):
+    return [dict(zip(keys + values, (*row[:len(keys)], *(round(v or 0, 2) for v in row[len(keys):]))))
+            for row in rows]
+
+
+def inventory_aggregates():
+    """Stock value per group, one GROUP BY per inventory table."""
+    phones = db.session.execute(
+        db.select(Phone.company, Phone.is_new, db.func.count(), db.func.sum(Phone.price))
+        .where(Phone.status == "Available")
+        .group_by(Phone.company, Phone.is_new)
+        .order_by(Phone.company, Phone.is_new)
+    ).all()
+    by_condition = {}
+    for _, is_new, units, value in phones:
+        totals = by_condition.setdefault("new" if is_new else "used", [0, 0.0])
+        totals[0] += units
+        totals[1] += value or 0
+
+    accessories = db.session.execute(
+        db.select(
+            Accessory.category, Accessory.company, db.func.count(),
+            db.func.sum(Accessory.added_stock),
+            db.func.sum(Accessory.added_stock * Accessory.unit_price),
+            db.func.sum(db.case((Accessory.added_stock < Accessory.minimum_stock, 1), else_=0)),
+        )
+        .group_by(Accessory.category, Accessory.company)
+        .order_by(Accessory.category, Accessory.company)
+    ).all()
+
+    parts = db.session.execute(
+        db.select(
+            RepairingAccessory.type, db.func.count(),
+            db.func.sum(RepairingAccessory.current_stock),
+            db.func.sum(RepairingAccessory.current_stock * RepairingAccessory.repairing_cost),
+            db.func.sum(RepairingAccessory.current_stock * RepairingAccessory.selling_cost),
+        )
+        .group_by(RepairingAccessory.type)
+        .order_by(RepairingAccessory.type)
+    ).all()
+    part_groups = _group_rows(parts, ["type"], ["items", "units", "cost_value", "retail_value"])
+    for group in part_groups:
+        group["margin_value"] = round(group["retail_value"] - group["cost_value"], 2)
+        group["margin_pct"] = round(group["margin_value"] / group["retail_value"] * 100, 2) if group["retail_value"] else None
+
+    return {
+        "phones": {
+            "by_company": [
+                {"company": company, "condition": "new" if is_new else "used", "units": units,
+                 "stock_value": round(value or 0, 2)}
+                for company, is_new, units, value in phones
+            ],
+            "by_condition": [
+                {"condition": condition, "units": units, "stock_value": round(value, 2)}
+                for condition, (units, value) in sorted(by_condition.items())
+            ],
+            "stock_value": round(sum(value for _, value in by_condition.values()), 2),
+        },
+        "accessories": {
+            "by_category": _group_rows(
+                accessories, ["category", "company"], ["items", "units", "stock_value", "below_minimum"]
+            ),
+            "stock_value": round(sum(row[4] or 0 for row in accessories), 2),
+        },
+        "repair_parts": {
+            "by_type": part_groups,
+            "cost_value": round(sum(group["cost_value"] for group in part_groups), 2),
+            "retail_value": round(sum(group["retail_value"] for group in part_groups), 2),
+        },
+    }
 
-    # Optional fields for editing
-    customer_name = request.args.get('customer_name')
-    phone_number = request.args.get('phone_number')
-    received_by = request.args.get('received_by')
-    company = request.args.get('company')
-    model = request.args.get('model')
-    device_condition = request.args.get('device_condition')
-    repairing_status = request.args.get('repairing_status')
-    repairing_cost = request.args.get('repairing_cost')
-    estimated_delivery_date = request.args.get('estimated_delivery_date')
-    parts_replaced = request.args.get('parts_replaced')
-    bill_status = request.args.get('bill_status')
-    due_price = request.args.get('due_price')
-    advance_payment = request.args.get('advance_payment')
-    payment_method = request.args.get('payment_method')
-    delivery_status = request.args.get('delivery_status')
-    technician_name = request.args.get('technician_name')
 
-    # Update fields if provided
-    if customer_name: repairing_device.customer_name = customer_name
-    if phone_number: repairing_device.phone_number = phone_number
-    if received_by: repairing_device.received_by = received_by
-    if company: repairing_device.company = company
-    if model: repairing_device.model = model
-    if device_condition: repairing_device.device_condition = device_condition
-    if repairing_status: repairing_device.repairing_status = repairing_status
-    if repairing_cost: repairing_device.repairing_cost = repairing_cost
-    if estimated_delivery_date:
-        try:
-            repairing_device.estimated_delivery_date = datetime.strptime(estimated_delivery_date, '%Y-%m-%d').date()
-        except ValueError:
-            return jsonify({"message": "Invalid date format. Use 'YYYY-MM-DD'."}), 400
-    if parts_replaced: repairing_device.parts_replaced = parts_replaced
-    if bill_status: repairing_device.bill_status = bill_status
-    if due_price: repairing_device.due_price = due_price
-    if advance_payment: repairing_device.advance_payment = advance_payment
-    if payment_method: repairing_device.payment_method = payment_method
-    if delivery_status: repairing_device.delivery_status = delivery_status
-    if technician_name: repairing_device.technician_name = technician_name
+def part_margin_metrics():
+    """Spread of repair part margins.
+
+    Percentiles are beyond SQLite, so they are computed from column arrays,
+    vectorized with NumPy when it is installed.
+    """
+    rows = db.session.execute(
+        db.select(
+            RepairingAccessory.id, RepairingAccessory.name, RepairingAccessory.repairing_cost,
+            RepairingAccessory.selling_cost, RepairingAccessory.current_stock,
+        ).where(RepairingAccessory.repairing_cost.is_not(None), RepairingAccessory.selling_cost.is_not(None))
+    ).all()
+    if not rows:
+        return {"priced_parts": 0}
+    ids, names, cost, price, stock = zip(*rows)
+
+    if np is not None:
+        cost, price = np.array(cost, dtype=float), np.array(price, dtype=float)
+        stock = np.nan_to_num(np.array(stock, dtype=float))
+        margin = price - cost
+        quartiles = np.percentile(margin, [25, 50, 75]).tolist()
+        stock_price = float(price @ stock)
+        stock_margin = float(margin @ stock)
+        negative = np.flatnonzero(margin < 0)
+        negative = negative[np.argsort(margin[negative], kind='stable')].tolist()
+        margin = margin.tolist()
+    else:
+        stock = [units or 0 for units in stock]
+        margin = [p - c for p, c in zip(price, cost)]
+        quartiles = statistics.quantiles(margin, n=4, method='inclusive') if len(margin) > 1 else margin * 3
+        stock_price = sum(p * units for p, units in zip(price, stock))
+        stock_margin = sum(m * units for m, units in zip(margin, stock))
+        negative = sorted((i for i, m in enumerate(margin) if m < 0), key=margin.__getitem__)
+
+    return {
+        "priced_parts": len(rows),
+        "unit_margin": {"p25": round(quartiles[0], 2), "median": round(quartiles[1], 2), "p75": round(quartiles[2], 2)},
+        "stock_weighted_margin_pct": round(stock_margin / stock_price * 100, 2) if stock_price else None,
+        "negative_margin_count": len(negative),
+        "negative_margin_parts": [
+            {"id": ids[i], "name": names[i], "unit_margin": round(margin[i], 2)} for i in negative[:20]
+        ],
+    }
 
-    db.session.commit()
-    return jsonify({"message": f"Repairing device with ID {device_id} updated successfully"}), 200
 
+class InventoryAnalytics:
+    """Caches the analytics result until the inventory changes.
 
-@app.route('/add_shop', methods=['GET'])
-def add_shop():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
+    A commit that touched phones, accessories or repair parts in this process
+    invalidates the cache at once. Writes by other processes are caught by
+    the version key: the newest `updated_at` of those tables and the newest
+    sync tombstone, read with one indexed query. Results older than
+    `max_age` are recomputed as a backstop.
+    """
 
-    name = request.args.get('name')
-    address = request.args.get('address')
-    phone = request.args.get('phone')
-    email = request.args.get('email')
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._results = {}  # shop_id -> (generation, version, computed_at, result)
 
-    if not name or not address or not phone:
-        return jsonify({'error': 'Name, address, and phone are required'}), 400
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
 
-    shop = Shop(name=name, address=address, phone=phone, email=email)
-    db.session.add(shop)
-    db.session.commit()
+    @staticmethod
+    def version():
+        newest = [db.select(db.func.max(model.updated_at)).scalar_subquery() for model in INVENTORY_MODELS]
+        newest.append(db.select(db.func.max(SyncTombstone.id)).scalar_subquery())
+        return tuple(db.session.execute(db.select(*newest)).one())
 
-    return jsonify({'message': 'Shop added successfully', 'shop_id': shop.id}), 200
-    
-    
-@app.route('/generate_invoice', methods=['GET'])
-def generate_invoice():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
-        
-    user_name = request.args.get('name')
-    user_phone = request.args.get('phone')
-    user_location = request.args.get('location')
-    imei = request.args.get('imei')
-    shop_id = request.args.get('shop_id')  # Shop ID provided by the user
-    paid_amount = float(request.args.get('paid_amount', 0.0))
+    def get(self, fresh=False):
+        """(result, served from cache) for the selected shop."""
+        shop_id = current_shop_id.get()
+        generation = self._generation
+        version = self.version()
+        cached = self._results.get(shop_id)
+        if (not fresh and cached is not None and cached[:2] == (generation, version)
+                and time.monotonic() - cached[2] < self.max_age):
+            return cached[3], True
+        result = inventory_aggregates()
+        result["repair_parts"]["margins"] = part_margin_metrics()
+        result["generated_at"] = datetime.utcnow().isoformat()
+        with self._lock:
+            self._results[shop_id] = (generation, version, time.monotonic(), result)
+        return result, False
 
-    # Validate shop
-    shop = Shop.query.filter_by(id=shop_id).first()
-    if not shop:
-        return jsonify({'error': 'Shop not found'}), 404
 
-    # Find phone details by IMEI
-    phone = Phone.query.filter_by(imei=imei).first()
-    if not phone:
-        return jsonify({'error': 'Phone with given IMEI not found'}), 404
+inventory_analytics = InventoryAnalytics(app.config['ANALYTICS_CACHE_MAX_AGE'])
 
-    # Check if phone is already sold
-    if phone.status == "Sold Out":
-        return jsonify({'error': 'Phone is already sold out'}), 400
 
-    total_amount = phone.price
-    due_amount = total_amount - paid_amount
+@event.listens_for(db.session, 'after_flush')
+def _note_inventory_flush(session, flush_context):
+    if any(isinstance(obj, INVENTORY_MODELS) for obj in list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info['inventory_changed'] = True
 
-    # Create Invoice
-    invoice = Invoice(
-    customer_name=user_name,
-    customer_phone=user_phone,
-    customer_location=user_location,
-    phone_id=phone.id,
-    shop_id=shop.id,
-    total_amount=total_amount,
-    paid_amount=paid_amount,
-)
-    db.session.add(invoice)
-    db.session.commit()  # Commit to get the invoice_id
 
-    # Add Initial Due Record (Make sure invoice_id is available)
-    due = Due(
-        invoice_id=invoice.id,
-        phone_model=phone.model_name,
-        customer_name=user_name,
-        paid_amount=paid_amount,
-        payment_date=datetime.utcnow()  # Set payment_date as current time
-    )
-    db.session.add(due)
+@event.listens_for(db.session, 'do_orm_execute')
+def _note_inventory_statement(orm_execute_state):
+    # Bulk and Core statements bypass the flush, e.g. the cart's stock update
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        tables = {table.name for table in find_tables(orm_execute_state.statement, include_crud=True)}
+        if tables & INVENTORY_TABLES:
+            orm_execute_state.session.info['inventory_changed'] = True
 
-    # Add Invoice History
-    invoice_history = InvoiceHistory(
-        invoice_id=invoice.id,
-        customer_name=user_name,
-        customer_phone=user_phone,
-        customer_location=user_location,
-        total_paid=paid_amount,
-        total_due=due_amount,
-        total_amount=total_amount
-    )
-    db.session.add(invoice_history)
 
-    # Update phone status to "Sold Out"
-    phone.update_status(False)
-    db.session.commit()
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_inventory_analytics(session):
+    if not session.in_nested_transaction() and session.info.pop('inventory_changed', False):
+        inventory_analytics.invalidate()
 
-    # Fetch the created invoice details
-    invoice_details = {
-        'invoice_id': invoice.id,
-        'customer_name': invoice.customer_name,
-        'customer_phone': invoice.customer_phone,
-        'customer_location': invoice.customer_location,
-        'total_amount': invoice.total_amount,
-        'paid_amount': invoice.paid_amount,
-        'due_amount': invoice.due_amount,
-        'date_created': invoice.date_created.strftime('%Y-%m-%d %H:%M:%S'),
-        'phone': {
-            'model_name': phone.model_name,
-            'company': phone.company,
-            'imei': phone.imei,
-            'price': phone.price
-        },
-        'shop': {
-            'name': shop.name,
-            'address': shop.address,
-            'phone': shop.phone,
-            'email': shop.email
-        },
-        'due': {
-            'phone_model': due.phone_model,
-            'customer_name': due.customer_name,
-            'paid_amount': due.paid_amount,
-            'payment_date': due.payment_date.strftime('%Y-%m-%d %H:%M:%S')  # Format payment_date
-        },
-        'invoice_history': {
-            'total_paid': invoice_history.total_paid,
-            'total_due': invoice_history.total_due,
-            'total_amount': invoice_history.total_amount,
-            'last_updated': invoice_history.last_updated.strftime('%Y-%m-%d %H:%M:%S')  # Format last_updated
-        }
-    }
 
-    return jsonify({
-        'message': 'Invoice created successfully',
-        'invoice_details': invoice_details
-    }), 200
- 
-@app.route('/add_payment', methods=['GET'])
-def add_payment():
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_inventory_change(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('inventory_changed', None)
+
+
+@app.route('/analytics/inventory', methods=['GET'])
+@single_flight
+def view_inventory_analytics():
+    """Stock value by phone company and condition, accessory category and part type, plus part margins.
+
+    Served from cache until the inventory changes; `fresh=1` recomputes.
+    """
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
 
-    invoice_id = request.args.get('invoice_id')
-    payment = float(request.args.get('payment', 0.0))
+    result, cached = inventory_analytics.get(fresh=request.args.get('fresh') == '1')
+    return jsonify({**result, "cached": cached}), 200
 
-    # Fetch invoice
-    invoice = Invoice.query.filter_by(id=invoice_id).first()
-    if not invoice:
-        return jsonify({'error': 'Invoice not found'}), 404
 
-    # Validate payment
-    if payment <= 0:
-        return jsonify({'error': 'Payment must be greater than 0'}), 400
-    if payment > invoice.due_amount:
-        return jsonify({'error': 'Payment exceeds due amount'}), 400
+# ----- Reorder Forecast -----
+def _daily_sales(start):
+    """(item_type, item_id, day, quantity) rows of every recorded sale or use since `start`."""
+    day = db.func.date(AccessorieInvoice.date, type_=db.Date)
+    single = (
+        db.select(db.literal('accessory'), AccessoryProfile.accessory_id, day, db.func.sum(AccessorieInvoice.quantity))
+        .join(AccessoryProfile, AccessoryProfile.id == AccessorieInvoice.accessory_profile_id)
+        .where(AccessorieInvoice.date >= start)
+        .group_by(AccessoryProfile.accessory_id, day)
+    )
+    day = db.func.date(AccessoryCartInvoice.date, type_=db.Date)
+    cart = (
+        db.select(db.literal('accessory'), AccessoryCartLine.accessory_id, day, db.func.sum(AccessoryCartLine.quantity))
+        .join(AccessoryCartInvoice, AccessoryCartInvoice.id == AccessoryCartLine.cart_invoice_id)
+        .where(AccessoryCartInvoice.date >= start)
+        .group_by(AccessoryCartLine.accessory_id, day)
+    )
+    day = db.func.date(RepairPartUsage.used_at, type_=db.Date)
+    parts = (
+        db.select(db.literal('repairing_accessory'), RepairPartUsage.repairing_accessory_id, day,
+                  db.func.sum(RepairPartUsage.quantity))
+        .where(RepairPartUsage.used_at >= start)
+        .group_by(RepairPartUsage.repairing_accessory_id, day)
+    )
+    return db.session.execute(db.union_all(single, cart, parts)).all()
 
-    # Update invoice payment
-    invoice.update_paid_amount(payment)
 
-    # Log the payment in Due table
-    due = Due(
-        invoice_id=invoice.id,
-        phone_model=invoice.phone.model_name,
-        customer_name=invoice.customer_name,
-        paid_amount=payment,
-        payment_date=datetime.utcnow()
+def _forecast_catalog():
+    """(item_type, item_id, name, stock, minimum_stock) of every accessory and repair part."""
+    accessories = db.select(
+        db.literal('accessory'), Accessory.id, Accessory.accessory_name,
+        db.func.coalesce(Accessory.added_stock, 0), db.func.coalesce(Accessory.minimum_stock, 0),
     )
-    db.session.add(due)
-
-    # Update InvoiceHistory
-    invoice_history = InvoiceHistory.query.filter_by(invoice_id=invoice_id).first()
-    if invoice_history:
-        invoice_history.total_paid += payment
-        invoice_history.total_due = invoice.due_amount
+    parts = db.select(
+        db.literal('repairing_accessory'), RepairingAccessory.id, RepairingAccessory.name,
+        db.func.coalesce(RepairingAccessory.current_stock, 0), db.func.coalesce(RepairingAccessory.minimum_stock, 0),
+    )
+    return db.session.execute(db.union_all(accessories, parts)).all()
+
+
+def forecast_reorders(sales, stock, minimum):
+    """Demand and reorder suggestions for the whole catalog at once.
+
+    `sales` is an items x days matrix of units sold, oldest day first;
+    `stock` and `minimum` are per-item vectors. Returns a dict of per-item
+    vectors.
+    """
+    config = app.config
+    days = sales.shape[1]
+    recent = sales[:, -min(config['FORECAST_WINDOW_DAYS'], days):]
+    moving_average = recent.mean(axis=1)
+    demand_std = recent.std(axis=1)
+
+    # Exponential smoothing as one matrix-vector product: day weights decay with age
+    alpha = config['FORECAST_SMOOTHING']
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1)
+    daily_demand = sales @ weights / weights.sum()
+
+    lead_time = config['FORECAST_LEAD_TIME_DAYS']
+    safety_stock = config['FORECAST_SERVICE_Z'] * demand_std * math.sqrt(lead_time)
+    reorder_point = np.maximum(daily_demand * lead_time + safety_stock, minimum)
+    target = np.maximum(daily_demand * (lead_time + config['FORECAST_REVIEW_DAYS']) + safety_stock, reorder_point)
+    suggested = np.where(stock <= reorder_point, np.ceil(np.maximum(target - stock, 0)), 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_of_cover = np.where(daily_demand > 0, np.maximum(stock, 0) / daily_demand, np.nan)
+
+    return {
+        "daily_demand": daily_demand,
+        "moving_average": moving_average,
+        "demand_std": demand_std,
+        "days_of_cover": days_of_cover,
+        "reorder_point": reorder_point,
+        "suggested_quantity": suggested,
+    }
 
-    db.session.commit()
 
-    return jsonify({
-        'message': 'Payment added successfully',
-        'remaining_due': invoice.due_amount
-    }), 200
+def refresh_reorder_forecast():
+    """Recompute the forecast table of the selected shop (or the only database)."""
+    catalog = _forecast_catalog()
+    today = datetime.utcnow().date()
+    days = app.config['FORECAST_HISTORY_DAYS']
+    start = today - timedelta(days=days - 1)
+
+    index = {(item_type, item_id): i for i, (item_type, item_id, *_) in enumerate(catalog)}
+    rows, columns, quantities = [], [], []
+    for item_type, item_id, day, quantity in _daily_sales(datetime.combine(start, datetime.min.time())):
+        row = index.get((item_type, item_id))
+        offset = (day - start).days if day else -1
+        if row is not None and 0 <= offset < days:
+            rows.append(row)
+            columns.append(offset)
+            quantities.append(quantity or 0)
+    sales = np.zeros((len(catalog), days))
+    np.add.at(sales, (np.array(rows, dtype=int), np.array(columns, dtype=int)), quantities)
+
+    stock = np.array([item[3] for item in catalog], dtype=float)
+    minimum = np.array([item[4] for item in catalog], dtype=float)
+    result = {name: values.tolist() for name, values in forecast_reorders(sales, stock, minimum).items()}
+
+    computed_at = datetime.utcnow()
+    records = [
+        {
+            "item_type": item_type, "item_id": item_id, "name": name,
+            "current_stock": int(item_stock), "minimum_stock": int(item_minimum),
+            **{key: values[i] for key, values in result.items()},
+            "suggested_quantity": int(result["suggested_quantity"][i]),
+            "days_of_cover": None if math.isnan(result["days_of_cover"][i]) else result["days_of_cover"][i],
+            "computed_at": computed_at,
+        }
+        for i, (item_type, item_id, name, item_stock, item_minimum) in enumerate(catalog)
+    ]
+    table = ReorderForecast.__table__
+    db.session.execute(table.delete(), bind_arguments={'mapper': ReorderForecast})
+    if records:
+        db.session.execute(table.insert(), records, bind_arguments={'mapper': ReorderForecast})
+    return len(records)
+
+
+@background_task('refresh_reorder_forecast')
+def refresh_reorder_forecast_task(reschedule=True):
+    for shop_id, _ in partition_targets():
+        with shop_context(shop_id):
+            count = refresh_reorder_forecast()
+            db.session.commit()
+        logger.info("Reorder forecast refreshed for %s items (shop %s)", count, shop_id)
+    if reschedule:
+        _schedule_reorder_forecast(delay=app.config['FORECAST_REFRESH_HOURS'] * 3600)
 
-@app.route('/invoice_history', methods=['GET'])
-def invoice_history():
-    auth_key = request.args.get('auth_key')
-    if not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
 
-    invoices = Invoice.query.all()  # Fetch all invoices
-    result = []
-    for invoice in invoices:
-        # Fetch the corresponding phone
-        phone = Phone.query.filter_by(id=invoice.phone_id).first()
-        if not phone:
-            continue
+def _schedule_reorder_forecast(delay=0):
+    # One pending refresh is enough, whichever process queued it
+    pending = BackgroundJob.query.filter_by(name='refresh_reorder_forecast', status='queued').first()
+    if pending is None:
+        enqueue_job('refresh_reorder_forecast', delay=delay)
+    return pending is None
 
-        # Fetch the corresponding shop
-        shop = Shop.query.filter_by(id=invoice.shop_id).first()
-        if not shop:
-            continue
 
-        # Fetch the corresponding invoice history
-        history = InvoiceHistory.query.filter_by(invoice_id=invoice.id).first()
-        if not history:
-            continue
+# Set once this process has made sure a refresh is queued
+reorder_forecast_scheduled = threading.Event()
 
-        # Fetch all dues for this invoice
-        due = Due.query.filter_by(invoice_id=invoice.id).all()
 
-        # Add details to the result
-        result.append({
-            'invoice_id': invoice.id,
-            'customer_name': invoice.customer_name,
-            'customer_phone': invoice.customer_phone,
-            'customer_location': invoice.customer_location,
-            'total_paid': invoice.paid_amount,
-            'total_due': invoice.due_amount,
-            'total_amount': invoice.total_amount,
-            'date_created': invoice.date_created.strftime('%Y-%m-%d %H:%M:%S'),
-            'phone_details': {
-                'model_name': phone.model_name,
-                'company': phone.company,
-                'imei': phone.imei,
-                'price': phone.price,
-                'status': phone.status,
-                'is_new': phone.is_new,
-                'date_added': phone.date_added.strftime('%Y-%m-%d %H:%M:%S')
-            },
-            'shop_details': {
-                'name': shop.name,
-                'address': shop.address,
-                'phone': shop.phone,
-                'email': shop.email
-            },
-            'invoice_history': {
-                'invoice_id': history.invoice_id,
-                'customer_name': history.customer_name,
-                'customer_phone': history.customer_phone,
-                'customer_location': history.customer_location,
-                'total_paid': history.total_paid,
-                'total_due': history.total_due,
-                'total_amount': history.total_amount,
-                'last_updated': history.last_updated.strftime('%Y-%m-%d %H:%M:%S')
-            },
-            'due_details': [
-                {
-                    'phone_model': due_item.phone_model,
-                    'customer_name': due_item.customer_name,
-                    'paid_amount': due_item.paid_amount,
-                    'payment_date': due_item.payment_date.strftime('%Y-%m-%d %H:%M:%S')
-                }
-                for due_item in due
-            ]
-        })
+@app.before_request
+def start_reorder_forecast_schedule():
+    if (np is None or not app.config['FORECAST_ENABLED'] or not app.config['JOB_QUEUE_ENABLED']
+            or reorder_forecast_scheduled.is_set()):
+        return
+    reorder_forecast_scheduled.set()
+    with shop_context(None):
+        if _schedule_reorder_forecast():
+            db.session.commit()
 
-    return jsonify({'invoice_history': result}), 200
-    
-    
 
+@app.route('/forecast/reorder', methods=['GET'])
+def view_reorder_forecast():
+    """Precomputed demand forecast and reorder suggestions, most urgent first.
 
-@app.route('/repairingdevice/invoice', methods=['GET'])
-def generate_and_save_invoice():
+    `item_type` limits the list to accessories or repair parts and
+    `needs_reorder=1` to items with a suggested quantity. `refresh=1` queues
+    a recomputation instead of waiting for the schedule.
+    """
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
+    if np is None:
+        return jsonify({"error": "Forecasting is not available on this server (install numpy)"}), 501
 
-    device_id = request.args.get('id')
-    shop_id = request.args.get('shop_id')
+    if request.args.get('refresh') == '1':
+        enqueue_job('refresh_reorder_forecast', max_attempts=1, reschedule=False)
+        db.session.commit()
+        return jsonify({"message": "Forecast refresh queued"}), 202
+
+    query = ReorderForecast.query
+    item_type = request.args.get('item_type')
+    if item_type:
+        query = query.filter_by(item_type=item_type)
+    if request.args.get('needs_reorder') == '1':
+        query = query.filter(ReorderForecast.suggested_quantity > 0)
+    # Items that run out first lead; items that do not sell come last
+    forecasts = query.order_by(
+        ReorderForecast.days_of_cover.is_(None), ReorderForecast.days_of_cover, ReorderForecast.item_type,
+        ReorderForecast.item_id,
+    ).all()
+    return jsonify({
+        "computed_at": forecasts[0].computed_at.isoformat() if forecasts else None,
+        "forecasts": [forecast.to_dict() for forecast in forecasts],
+    }), 200
 
-    # Get the repairing device
-    repairing_device = RepairingDevice.query.filter_by(id=device_id).first()
-    if not repairing_device:
-        return jsonify({"message": "Repairing device not found"}), 404
 
-    # Get the shop details
-    shop = Shop.query.filter_by(id=shop_id).first()
-    if not shop:
-        return jsonify({"message": "Shop not found"}), 404
+# ----- Delta Sync -----
+# Entity name in /sync responses -> model
+SYNC_ENTITIES = {
+    model.__tablename__: model
+    for model in (
+        Shop, Customer, Phone, Accessory, RepairingAccessory, RepairingProduct, RepairingDevice, RepairingInvoice,
+        Invoice, Due, InvoiceHistory, ShopProfile, AccessoryProfile, AccessorieInvoice,
+        AccessoryCartInvoice, AccessoryCartLine, RepairPartUsage,
+    )
+}
 
-    # Generate unique invoice ID
-    india_tz = timezone('Asia/Kolkata')
-    current_time_ist = datetime.now(india_tz)
-    
-    invoice_id = f"INV-{device_id}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
 
-    # Automatically save the invoice to history
-    new_invoice = RepairingInvoice(
-        invoice_id=invoice_id,
-        repairing_device_id=device_id,
-        shop_id=shop.id,
-        customer_name=repairing_device.customer_name,
-        repairing_cost=repairing_device.repairing_cost,
-        advance_payment=repairing_device.advance_payment,
-        due_price=repairing_device.due_price,
-        bill_status=repairing_device.bill_status,
-        payment_method=repairing_device.payment_method,
-    )
+@event.listens_for(db.session, 'before_flush')
+def _record_sync_tombstones(session, flush_context, instances):
+    for obj in list(session.deleted):
+        if isinstance(obj, SyncTracked) and obj.id is not None:
+            session.add(SyncTombstone(entity=obj.__tablename__, entity_id=obj.id))
 
-    try:
-        # Save the invoice history
-        db.session.add(new_invoice)
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"error": f"Failed to save invoice history. Error: {str(e)}"}), 500
 
-    # Convert and format date_added field to IST
-    date_added_ist = repairing_device.date_added.astimezone(india_tz).strftime('%Y-%m-%d %H:%M:%S')
+def encode_sync_token(state):
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode().rstrip('=')
 
-    # Full invoice details
-    invoice_details = {
-        "invoice_id": invoice_id,
-        "repairing_device_id": repairing_device.id,
-        "customer_name": repairing_device.customer_name,
-        "phone_number": repairing_device.phone_number,
-        "company": repairing_device.company,
-        "model": repairing_device.model,
-        "device_condition": repairing_device.device_condition,
-        "repairing_status": repairing_device.repairing_status,
-        "repairing_cost": repairing_device.repairing_cost,
-        "advance_payment": repairing_device.advance_payment,
-        "due_price": repairing_device.due_price,
-        "bill_status": repairing_device.bill_status,
-        "payment_method": repairing_device.payment_method,
-        "delivery_status": repairing_device.delivery_status,
-        "technician_name": repairing_device.technician_name,
-        "estimated_delivery_date": repairing_device.estimated_delivery_date.strftime('%Y-%m-%d') if repairing_device.estimated_delivery_date else None,
-        "date_added": date_added_ist,  # Date in IST formatted as string
-        "shop_details": {
-            "shop_id": shop.id,
-            "shop_name": shop.name,
-            "shop_address": shop.address,
-            "shop_phone": shop.phone,
-            "shop_email": shop.email,
+
+def decode_sync_token(token):
+    """Parse a token from an earlier /sync response; raises ValueError if it is not one."""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        watermark = datetime.fromisoformat(state['w']) if state.get('w') else None
+        cursors = {
+            entity: (datetime.fromisoformat(at), int(row_id))
+            for entity, (at, row_id) in state.get('c', {}).items() if entity in SYNC_ENTITIES
         }
-    }
+        return watermark, cursors, int(state.get('d', 0))
+    except (KeyError, TypeError, ValueError, json.JSONDecodeError) as e:
+        raise ValueError("Invalid sync token") from e
 
-    # Return the full invoice details as JSON
-    return jsonify({"message": "Invoice generated and saved successfully", "invoice_details": invoice_details}), 200
-    
-    
-@app.route('/repairinginvoice/history', methods=['GET'])
-def view_repairing_invoice_history():
+
+_tombstones_purged = {}  # partition (shop id or None) -> monotonic time of the last purge
+
+
+def _purge_sync_tombstones(now):
+    shop_id = current_shop_id.get()
+    if time.monotonic() - _tombstones_purged.get(shop_id, float('-inf')) < 3600:
+        return
+    _tombstones_purged[shop_id] = time.monotonic()
+    table = SyncTombstone.__table__
+    cutoff = now - timedelta(days=app.config['SYNC_TOMBSTONE_RETENTION_DAYS'])
+    db.session.execute(table.delete().where(table.c.deleted_at < cutoff), bind_arguments={'mapper': SyncTombstone})
+    db.session.commit()
+
+
+def _sync_row(row):
+    return {key: value.isoformat() if hasattr(value, 'isoformat') else value for key, value in row._mapping.items()}
+
+
+@app.route('/sync', methods=['GET'])
+def delta_sync():
+    """Rows changed and deleted since the client's last token.
+
+    Without `since` every row is returned (the first sync). Each entity is
+    read through its `updated_at` index in pages of SYNC_PAGE_SIZE; when a
+    page is full the token remembers where that entity stopped and
+    `has_more` asks the client to call again at once. Changes younger than
+    SYNC_OVERLAP_SECONDS may be sent twice, so clients apply rows by id.
+    """
     auth_key = request.args.get('auth_key')
     if not verify_auth_key(auth_key):
         return jsonify({"message": "Unauthorized access"}), 403
 
-    # Fetch all invoices from the database
-    invoices = RepairingInvoice.query.all()
+    since = request.args.get('since')
+    try:
+        watermark, cursors, last_tombstone = decode_sync_token(since) if since else (None, {}, 0)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    now = datetime.utcnow()
+    if watermark is not None and watermark < now - timedelta(days=app.config['SYNC_TOMBSTONE_RETENTION_DAYS']):
+        return jsonify({"message": "Sync token expired, sync again without since"}), 410
+
+    page_size = app.config['SYNC_PAGE_SIZE']
+    changes, deleted, next_cursors = {}, {}, {}
+    for entity, model in SYNC_ENTITIES.items():
+        table = model.__table__
+        query = db.select(table).order_by(table.c.updated_at, table.c.id).limit(page_size + 1)
+        if entity in cursors:
+            at, row_id = cursors[entity]
+            query = query.where(db.or_(table.c.updated_at > at, db.and_(table.c.updated_at == at, table.c.id > row_id)))
+        elif watermark is not None:
+            query = query.where(table.c.updated_at > watermark)
+        rows = db.session.execute(query, bind_arguments={'mapper': model}).all()
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursors[entity] = [rows[-1].updated_at.isoformat(), rows[-1].id]
+        if rows:
+            changes[entity] = [_sync_row(row) for row in rows]
+
+    table = SyncTombstone.__table__
+    if since:
+        tombstones = db.session.execute(
+            db.select(table.c.id, table.c.entity, table.c.entity_id)
+            .where(table.c.id > last_tombstone).order_by(table.c.id).limit(page_size + 1),
+            bind_arguments={'mapper': SyncTombstone},
+        ).all()
+        more_tombstones = len(tombstones) > page_size
+        for tombstone in tombstones[:page_size]:
+            deleted.setdefault(tombstone.entity, []).append(tombstone.entity_id)
+            last_tombstone = tombstone.id
+    else:
+        # A first sync has nothing to delete
+        more_tombstones = False
+        last_tombstone = db.session.execute(
+            db.select(db.func.coalesce(db.func.max(table.c.id), 0)), bind_arguments={'mapper': SyncTombstone}
+        ).scalar()
+    _purge_sync_tombstones(now)
+
+    # Rows stamped before this point have committed by now; later ones are read next time
+    next_watermark = now - timedelta(seconds=app.config['SYNC_OVERLAP_SECONDS'])
+    if watermark is not None:
+        next_watermark = max(next_watermark, watermark)
+    token = encode_sync_token({'w': next_watermark.isoformat(), 'c': next_cursors, 'd': last_tombstone})
+    return jsonify({
+        "token": token,
+        "has_more": bool(next_cursors) or more_tombstones,
+        "changes": changes,
+        "deleted": deleted,
+    }), 200
 
-    # Prepare the list of invoices with related details
-    invoice_history = [
-        {
-            "invoice_id": invoice.invoice_id,
-            "repairing_device_id": invoice.repairing_device.id,
-            "customer_name": invoice.customer_name,
-            "repairing_cost": invoice.repairing_cost,
-            "advance_payment": invoice.advance_payment,
-            "due_price": invoice.due_price,
-            "bill_status": invoice.bill_status,
-            "payment_method": invoice.payment_method,
-            "created_at": invoice.created_at.strftime('%Y-%m-%d %H:%M:%S'),
-            "shop_details": {
-                "shop_id": invoice.shop.id,
-                "shop_name": invoice.shop.name,
-                "shop_address": invoice.shop.address,
-                "shop_phone": invoice.shop.phone,
-                "shop_email": invoice.shop.email,
-            }
-        }
-        for invoice in invoices
-    ]
 
-    # Return the history as JSON
-    return jsonify({"message": "Repairing invoice history retrieved successfully", "invoices": invoice_history}), 200
-    
-import requests
+# ----- Change Stream -----
+class ChangeSubscription:
+    """The bounded buffer of one /events client.
 
-@app.route('/generate_accessorie_invoice', methods=['GET'])
-def generate_accessorie_invoice():
-    # Check for authorization key
-    auth_key = request.args.get('auth_key')
-    if not auth_key or not verify_auth_key(auth_key):
-        return jsonify({"message": "Unauthorized access"}), 403
+    A client that falls `size` events behind does not hold up the hub or
+    grow without bound: its buffer is dropped and it is told to resync.
+    """
 
-    # Extract parameters from the query string
-    user_name = request.args.get("user_name")
-    user_phone = request.args.get("user_phone")
-    accessory_id = request.args.get("accessory_id")
-    shop_id = request.args.get("shop_id")
-    quantity = request.args.get("quantity")
+    def __init__(self, shop_id, size):
+        self.shop_id = shop_id
+        self.size = size
+        self.events = deque()
+        self.overflowed = False
+        self._ready = threading.Condition()
 
-    # Validation
-    if not all([user_name, user_phone, accessory_id, shop_id, quantity]):
-        return jsonify({"error": "All fields are required"}), 400
+    def wants(self, shop_id):
+        return self.shop_id is None or shop_id is None or shop_id == self.shop_id
 
-    try:
-        # Convert quantity to integer
-        quantity = int(quantity)
+    def push(self, event):
+        with self._ready:
+            if self.overflowed:
+                return
+            if len(self.events) >= self.size:
+                self.events.clear()
+                self.overflowed = True
+            else:
+                self.events.append(event)
+            self._ready.notify()
+
+    def take(self, timeout):
+        """Buffered events, waiting up to `timeout` seconds for one; returns (events, overflowed)."""
+        with self._ready:
+            if not self.events and not self.overflowed:
+                self._ready.wait(timeout)
+            events, self.events = list(self.events), deque()
+            overflowed, self.overflowed = self.overflowed, False
+        return events, overflowed
+
+
+class ChangeHub:
+    """In-process publish/subscribe for committed changes.
+
+    Events are published from the session's after_commit hook, so clients
+    only hear about data that is stored. Event ids are `<epoch>-<sequence>`
+    and the last `history` events are kept, so a client reconnecting with
+    Last-Event-ID gets what it missed. An id from before a restart or older
+    than the history is answered with a resync event instead. Only clients
+    connected to this process are reached.
+    """
+
+    def __init__(self, history=1000, buffer=256):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.buffer = buffer
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+
+    def event_id(self, sequence):
+        return f"{self.epoch}-{sequence}"
 
-        # Fetch accessory details from the database
-        accessory = Accessory.query.get(accessory_id)
-        if not accessory:
-            return jsonify({"error": "Accessory not found"}), 404
+    @property
+    def last_event_id(self):
+        return self.event_id(self._sequence)
 
-        # Fetch shop details from the database
-        shop = Shop.query.get(shop_id)
-        if not shop:
-            return jsonify({"error": "Shop not found"}), 404
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    def publish(self, events):
+        with self._lock:
+            for name, shop_id, data in events:
+                self._sequence += 1
+                event = (self._sequence, name, shop_id, data)
+                self._history.append(event)
+                for subscription in self._subscribers:
+                    if subscription.wants(shop_id):
+                        subscription.push(event)
+
+    def subscribe(self, shop_id=None, last_event_id=None, limit=None):
+        """Register a client, replaying the events it missed after `last_event_id`.
+
+        Returns None when `limit` clients are already subscribed.
+        """
+        subscription = ChangeSubscription(shop_id, self.buffer)
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return None
+            if last_event_id:
+                missed = self._missed_since(last_event_id)
+                if missed is None:
+                    subscription.overflowed = True
+                for event in missed or ():
+                    if subscription.wants(event[2]):
+                        subscription.push(event)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def _missed_since(self, last_event_id):
+        epoch, _, sequence = last_event_id.partition('-')
+        if epoch != self.epoch or not sequence.isdigit() or int(sequence) > self._sequence:
+            return None
+        sequence = int(sequence)
+        oldest = self._history[0][0] if self._history else self._sequence + 1
+        if sequence < oldest - 1:
+            return None
+        return [event for event in self._history if event[0] > sequence]
+
+
+change_hub = ChangeHub(app.config['CHANGE_STREAM_HISTORY'], app.config['CHANGE_STREAM_BUFFER'])
+
+
+def queue_change_event(name, /, session=None, **data):
+    """Publish an /events event once the current transaction commits."""
+    session = session or db.session()
+    session.info.setdefault('change_events', []).append(
+        (session.get_nested_transaction(), name, current_shop_id.get(), data)
+    )
 
-        # Check stock availability
-        if accessory.added_stock < quantity:
-            return jsonify({"error": "Insufficient stock available"}), 400
 
-        # Generate unique invoice ID
-        invoice_id = str(uuid.uuid4())
+def _changed(obj, *attributes):
+    state = db.inspect(obj)
+    return any(state.attrs[attribute].history.has_changes() for attribute in attributes)
 
-        # Calculate total price
-        total_price = accessory.unit_price * quantity
 
-        # Update stock and sales details
-        accessory.added_stock -= quantity
-        accessory.times_sold += quantity
-        db.session.commit()
+@event.listens_for(db.session, 'after_flush')
+def _collect_change_events(session, flush_context):
+    for obj in list(session.new) + list(session.dirty):
+        inserted = obj in session.new
+        if isinstance(obj, Phone) and (inserted or _changed(obj, 'status')):
+            queue_change_event(
+                'phone_sold' if obj.status == "Sold Out" else 'phone_available', session=session,
+                id=obj.id, imei=obj.imei, model_name=obj.model_name, company=obj.company, price=obj.price,
+            )
+        elif isinstance(obj, Accessory) and (inserted or _changed(obj, 'added_stock', 'minimum_stock')):
+            queue_change_event(
+                'stock_changed', session=session, item='accessory', id=obj.id, name=obj.accessory_name,
+                stock=obj.added_stock, minimum_stock=obj.minimum_stock,
+            )
+        elif isinstance(obj, RepairingAccessory) and (inserted or _changed(obj, 'current_stock', 'minimum_stock')):
+            queue_change_event(
+                'stock_changed', session=session, item='repairing_accessory', id=obj.id, name=obj.name,
+                stock=obj.current_stock, minimum_stock=obj.minimum_stock,
+            )
+        elif isinstance(obj, RepairingDevice) and (inserted or _changed(obj, 'repairing_status', 'delivery_status')):
+            queue_change_event(
+                'repair_status_updated', session=session, id=obj.id, customer_name=obj.customer_name,
+                company=obj.company, model=obj.model, repairing_status=obj.repairing_status,
+                delivery_status=obj.delivery_status, technician_name=obj.technician_name,
+            )
 
-        # Save invoice to the database
-        new_invoice = AccessorieInvoice(
-            invoice_id=invoice_id,
-            user_name=user_name,
-            user_phone=user_phone,
-            accessory_name=accessory.accessory_name,
-            company=accessory.company,
-            category=accessory.category,
-            unit_price=accessory.unit_price,
-            quantity=quantity,
-            total_price=total_price,
-            shop_name=shop.name,
-            shop_address=shop.address,
-            shop_phone=shop.phone,
-            shop_email=shop.email,
-        )
-        db.session.add(new_invoice)
-        db.session.commit()
 
-        # Prepare invoice data for response
-        invoice_data = {
-            "invoice_id": invoice_id,
-            "user_name": user_name,
-            "user_phone": user_phone,
-            "accessory_details": {
-                "accessory_name": accessory.accessory_name,
-                "company": accessory.company,
-                "category": accessory.category,
-                "unit_price": accessory.unit_price,
-                "quantity": quantity,
-                "total_price": total_price,
-            },
-            "shop_details": {
-                "shop_name": shop.name,
-                "shop_address": shop.address,
-                "shop_phone": shop.phone,
-                "shop_email": shop.email,
-            },
-            "date": datetime.utcnow().isoformat(),
-        }
+@event.listens_for(db.session, 'after_commit')
+def _publish_change_events(session):
+    if session.in_nested_transaction():
+        return
+    events = session.info.pop('change_events', None)
+    if events:
+        change_hub.publish([(name, shop_id, data) for _, name, shop_id, data in events])
+
+
+def _inside(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
 
-        # Make an API call to update the accessory
-        update_url = "http://localhost:5000/accessory"
-        update_params = {
-            "action": "update",
-            "auth_key": auth_key,
-            "id": accessory_id,
-            "last_purchase_quantity": quantity
-        }
 
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_change_events(session, previous_transaction):
+    events = session.info.get('change_events')
+    if not events:
+        return
+    if not previous_transaction.nested:
+        session.info.pop('change_events')
+        return
+    # A rolled back savepoint (a failed /batch operation) drops only its own events
+    session.info['change_events'] = [e for e in events if not _inside(e[0], previous_transaction)]
+
+
+def _sse(name, data, event_id):
+    return f"id: {event_id}\nevent: {name}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def stream_changes(subscription, names, keepalive):
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            events, overflowed = subscription.take(keepalive)
+            if overflowed:
+                yield _sse('resync', {"message": "Events were missed, reload the data"}, change_hub.last_event_id)
+            for sequence, name, shop_id, data in events:
+                if names is None or name in names:
+                    yield _sse(name, data, change_hub.event_id(sequence))
+            if not events and not overflowed:
+                yield ": keepalive\n\n"
+    finally:
+        change_hub.unsubscribe(subscription)
+
+
+@app.route('/events', methods=['GET'])
+def change_events():
+    """Server-Sent Events stream of phone sales, stock changes and repair status updates.
+
+    Replaces polling /phone/view and /repairingdevice/view. `events` limits
+    the stream to a comma separated list of event names. Browsers resume
+    with the Last-Event-ID header on reconnect (or `last_event_id` can be
+    given); a `resync` event means events were missed and the client should
+    reload, for example with /sync. Deletions are only reported by /sync.
+    """
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    names = request.args.get('events')
+    names = set(names.split(',')) if names else None
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscription = change_hub.subscribe(current_shop_id.get(), last_event_id,
+                                        limit=app.config['CHANGE_STREAM_MAX_CLIENTS'])
+    if subscription is None:
+        return jsonify({"message": "Too many event streams open, poll instead"}), 503
+    response = Response(
+        stream_changes(subscription, names, app.config['CHANGE_STREAM_KEEPALIVE']),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+    # The generator's own cleanup never runs if the response is closed before it starts
+    response.call_on_close(lambda: change_hub.unsubscribe(subscription))
+    return response
+
+
+# ----- Batch -----
+# Endpoints that stream, render files or manage their own connections
+BATCH_EXCLUDED_ENDPOINTS = {'run_batch', 'export_ledger', 'print_invoice', 'change_events'}
+
+
+def run_batch_operation(operation, auth_key):
+    """Run one /batch operation through its route handler; returns (status, JSON body)."""
+    if not isinstance(operation, dict) or not isinstance(operation.get('path'), str):
+        return 400, {"error": "Every operation needs a path"}
+    method = str(operation.get('method', 'GET')).upper()
+    args = operation.get('args') or {}
+    if not isinstance(args, dict):
+        return 400, {"error": "args must be an object"}
+    try:
+        endpoint, view_args = app.url_map.bind('').match(operation['path'], method=method)
+    except HTTPException as e:
+        return e.code, {"error": e.description}
+    if endpoint in BATCH_EXCLUDED_ENDPOINTS:
+        return 400, {"error": f"{operation['path']} cannot run inside a batch"}
+    if str(args.get('include_archived')) == '1':
+        # Attaching the archive needs a connection outside the batch's transaction
+        return 400, {"error": "include_archived reads cannot run inside a batch"}
+    if app.config['RATE_LIMIT_ENABLED']:
+        # Every operation spends a token of its own class; the batch's slot bounds how many run at once
+        wait = rate_limiter.take(rate_limit_client(), rate_limit_class(endpoint))
+        if wait:
+            return 429, {"message": "Too many requests, slow down", "retry_after": math.ceil(wait)}
+
+    query = {**args, 'auth_key': auth_key}
+    with app.test_request_context(operation['path'], method=method, query_string=query,
+                                  json=operation.get('body')):
         try:
-            response = requests.get(update_url, params=update_params)
-            if response.status_code != 200:
-                return jsonify({"error": "Failed to update accessory"}), response.status_code
-        except Exception as e:
-            return jsonify({"error": f"Failed to update accessory: {str(e)}"}), 500
+            response = app.make_response(app.view_functions[endpoint](**view_args))
+        except HTTPException as e:
+            return e.code, {"error": e.description}
+        except (ShopNotSelected, ArchiveUnavailable) as e:
+            return 400, {"message": str(e)}
+        return response.status_code, response.get_json(silent=True)
+
+
+@app.route('/batch', methods=['POST'])
+def run_batch():
+    """Run many operations in one request and one transaction.
+
+    Body: {"operations": [{"path": "/accessory", "args": {"action": "update", "id": 3, ...}}, ...]}
+    (a bare JSON list is accepted as well). Each operation runs the existing
+    handler of its path with `args` as the query string (plus `method` and
+    `body` for POST routes). The caller is authenticated once, every
+    operation runs in a savepoint and the batch commits once. With `atomic=1`
+    the first failing operation rolls the whole batch back; otherwise failed
+    operations are rolled back alone and reported.
+    """
+    auth_key = request.args.get('auth_key')
+    if not verify_auth_key(auth_key):
+        return jsonify({"message": "Unauthorized access"}), 403
 
-        return jsonify({"status": "success", "invoice": invoice_data}), 200
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else data
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'error': 'A non-empty list of operations is required'}), 400
+    if len(operations) > app.config['BATCH_MAX_OPERATIONS']:
+        return jsonify({'error': f"At most {app.config['BATCH_MAX_OPERATIONS']} operations per batch"}), 400
+    atomic = request.args.get('atomic', '0') == '1'
+
+    # pysqlite only opens a transaction before DML, and releasing a savepoint
+    # outside one commits it; BEGIN IMMEDIATE also takes the write lock up front
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite' and not connection.connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    results = []
+    failed = 0
+    auth_token = batch_auth_key.set(auth_key)
+    try:
+        for index, operation in enumerate(operations):
+            savepoint = db.session.begin_nested()
+            token = batch_savepoint.set(savepoint)
+            try:
+                status, body = run_batch_operation(operation, auth_key)
+            except Exception as e:
+                status, body = 500, {"error": str(e)}
+            finally:
+                batch_savepoint.reset(token)
+            ok = status < 400
+            if savepoint.is_active:
+                if ok:
+                    savepoint.commit()
+                else:
+                    savepoint.rollback()
+            results.append({'index': index, 'status': status, 'response': body})
+            if not ok:
+                failed += 1
+                if atomic:
+                    break
+    finally:
+        batch_auth_key.reset(auth_token)
+
+    if atomic and failed:
+        db.session.rollback()
+        for result in results[:-1]:
+            result['rolled_back'] = True
+        return jsonify({
+            'message': 'Batch rejected, no operations were applied',
+            'succeeded': 0,
+            'failed': failed,
+            'results': results,
+        }), 400
 
-    except ValueError:
-        return jsonify({"error": "Invalid quantity format"}), 400
+    db.session.commit()
+    return jsonify({
+        'message': f"{len(results) - failed} of {len(results)} operations applied",
+        'succeeded': len(results) - failed,
+        'failed': failed,
+        'results': results,
+    }), 200
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    
-    
-    
 
 # Run the application
 if __name__ == '__main__':
@@ -0,0 +1,73 @@
+"""Regression tests for POST /batch transactions.
+
+Run with `python -m pytest -q server`. The app is imported against a
+temporary database, so the tracked instance files are never touched.
+"""
+import importlib
+import os
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    database = tmp_path_factory.mktemp('batch') / 'shop.db'
+    os.environ['DATABASE_URL'] = f"sqlite:///{database}"
+    try:
+        module = importlib.import_module('app')
+    finally:
+        del os.environ['DATABASE_URL']
+    module.app.config.update(
+        JOB_QUEUE_ENABLED=False, BACKUP_ENABLED=False, REPORT_SNAPSHOT_ENABLED=False,
+        FORECAST_ENABLED=False, RATE_LIMIT_ENABLED=False,
+    )
+    client = module.app.test_client()
+    auth_key = client.get('/register', query_string={'username': 'batch', 'password': 'p'}).get_json()['auth_key']
+    client.get('/add_shop', query_string={'auth_key': auth_key, 'name': 'S', 'address': 'A', 'phone': '1'})
+    return client, auth_key, str(database)
+
+
+def add_phone(imei):
+    return {"path": "/phone/add", "args": {
+        "imei": imei, "model_name": "X", "company": "C", "is_new": 1, "price": 10, "is_available": 1,
+    }}
+
+
+def committed_imeis(database):
+    # A separate connection only sees what the batch really committed
+    with sqlite3.connect(database) as conn:
+        return {imei for imei, in conn.execute("SELECT imei FROM phone")}
+
+
+def run_batch(server, operations, atomic):
+    client, auth_key, _ = server
+    response = client.post('/batch', query_string={'auth_key': auth_key, 'atomic': '1' if atomic else '0'},
+                           json={"operations": operations})
+    return response.status_code, response.get_json()
+
+
+def test_atomic_batch_rolls_back_operations_before_the_failure(server):
+    status, body = run_batch(server, [add_phone('100'), add_phone('101'), add_phone('100')], atomic=True)
+
+    assert status == 400
+    assert [result['status'] for result in body['results']] == [201, 201, 400]
+    assert all(result['rolled_back'] for result in body['results'][:-1])
+    assert not committed_imeis(server[2]) & {'100', '101'}
+
+
+def test_released_savepoints_commit_with_the_batch(server):
+    status, body = run_batch(server, [add_phone('200'), add_phone('200'), add_phone('201')], atomic=False)
+
+    assert status == 200
+    assert [result['status'] for result in body['results']] == [201, 400, 201]
+    assert {'200', '201'} <= committed_imeis(server[2])
+
+
+def test_archived_reads_are_rejected_inside_a_batch(server):
+    operations = [add_phone('300'), {"path": "/invoice_history", "args": {"include_archived": "1"}}]
+    status, body = run_batch(server, operations, atomic=True)
+
+    assert status == 400
+    assert body['results'][-1]['status'] == 400
+    assert '300' not in committed_imeis(server[2])